@@ -0,0 +1,143 @@
+import pygame
+from collections import OrderedDict, namedtuple
+from os import listdir
+from os.path import isfile, join
+
+
+# An animation frame with everything collision needs, built once at load time.
+# The mask and rect are shared between every sprite showing the frame,
+# so treat them as read-only.
+Frame = namedtuple("Frame", ["image", "mask", "rect"])
+
+def make_frame(surface):
+    '''Wraps a surface into a Frame, precomputing its mask and bounding rect'''
+    return Frame(surface, pygame.mask.from_surface(surface), surface.get_rect())
+
+
+class AssetCache:
+    '''A process-wide registry that decodes each image file only once.
+
+    Surfaces are converted for the display and handed out shared, keyed by
+    (path, region, scale, flip, crop), so a map with thousands of Blocks holds a
+    single copy of the tile. Nobody should draw onto a surface they got from
+    here, because every other user of the asset would see the change.
+
+    The cache is bounded by max_bytes; when it fills up the least recently used
+    entries are dropped. Sprites still holding an evicted surface keep working,
+    it is simply decoded again the next time someone asks for it.
+
+    When a prebuilt bundle is attached (see bundle.use_bundle) frames, sheet
+    sizes and directory listings come from it instead of the files.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()   # key -> (asset, size in bytes)
+        self.bundle = None     # an AssetBundle with prebuilt frames
+        self.recording = None  # set by bundle.build_bundle to collect listings and sizes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)  # mark as most recently used
+        return entry[0]
+
+    def _store(self, key, asset, nbytes):
+        self.entries[key] = (asset, nbytes)
+        self.used_bytes += nbytes
+        # evict the least recently used entries, but never the one just stored
+        while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.used_bytes -= evicted_bytes
+        return asset
+
+    def listdir(self, path):
+        ''' Returns the names of the files in a directory of assets'''
+        files = self.bundle.listdir(path) if self.bundle is not None else None
+        if files is None:
+            files = [f for f in listdir(path) if isfile(join(path, f))]
+        if self.recording is not None:
+            self.recording["listings"][path] = files
+        return files
+
+    def image_size(self, path):
+        ''' Returns the (width, height) of an image file'''
+        size = self.bundle.image_size(path) if self.bundle is not None else None
+        if size is None:
+            size = self.get(path).get_size()
+        if self.recording is not None:
+            self.recording["sizes"][path] = size
+        return size
+
+    def _from_bundle(self, path, region, scale, flip, crop):
+        if self.bundle is None:
+            return None
+        return self.bundle.frame((path, region, scale, flip, crop))
+
+    def get(self, path, region=None, scale=1, flip=False, crop=None):
+        '''Returns the shared surface for an image file.
+
+        path: the image file to decode
+        region: optional (x, y, width, height) to cut out of the image
+        scale: 2 doubles the image with scale2x like the sprite sheets, any other
+               number is a plain scale factor and a (width, height) tuple resizes
+        flip: True to mirror the image horizontally (for the _left animations)
+        crop: optional (width, height) to keep from the top left after scaling
+        '''
+        key = ("surface", path, region, scale, flip, crop)
+        surface = self._lookup(key)
+        if surface is not None:
+            return surface
+
+        bundled = self._from_bundle(path, region, scale, flip, crop)
+        if bundled is not None:
+            surface = bundled.image
+        elif region is not None:
+            # cut the region out of the (cached) full image
+            surface = self.get(path).subsurface(pygame.Rect(region)).copy()
+        elif scale != 1 or flip or crop:
+            surface = self.get(path, region)
+        else:
+            # convert_alpha sets background transparent and matches the display format
+            surface = pygame.image.load(path).convert_alpha()
+
+        if bundled is None:
+            if scale == 2:
+                surface = pygame.transform.scale2x(surface)
+            elif isinstance(scale, tuple):
+                surface = pygame.transform.scale(surface, scale)
+            elif scale != 1:
+                surface = pygame.transform.scale_by(surface, scale)
+            if flip:
+                surface = pygame.transform.flip(surface, True, False)
+            if crop is not None:
+                surface = surface.subsurface((0, 0), crop).copy()
+
+        return self._store(key, surface, surface.get_bytesize() * surface.get_width() * surface.get_height())
+
+    def frame(self, path, region=None, scale=1, flip=False, crop=None):
+        '''Same as get(), but returns a Frame with the shared mask and rect as well'''
+        key = ("frame", path, region, scale, flip, crop)
+        frame = self._lookup(key)
+        if frame is not None:
+            return frame
+
+        frame = self._from_bundle(path, region, scale, flip, crop)
+        if frame is None:
+            frame = make_frame(self.get(path, region, scale, flip, crop))
+        # the surface is accounted for under its own key, only count the mask here
+        width, height = frame.rect.size
+        return self._store(key, frame, width * height // 8)
+
+
+# the registry shared by the whole game
+ASSETS = AssetCache()
@@ -0,0 +1,698 @@
+'''Vectorized simulation of many players at once.
+
+Population-based bots and map-difficulty estimation need to step thousands of
+agents per tick, which is out of reach with one Player object and one set of
+mask collisions per agent. BatchPlayers keeps every agent's position,
+velocity, fall/jump counters, health and animation in NumPy arrays and
+advances them all in lockstep with the rules of World.step:
+
+* jump, gravity, PLAYER_VEL, landed, hit_head, the hit timer and
+  reset_to_spawn follow the Player methods, and update_sprite picks the
+  same animation frame,
+* every object is solid, like in utils.sweep: the player stops at tiles,
+  Fires and Flags alike, and only touches a Fire or a Flag by sweeping into
+  it. Every Fire touched costs a health point,
+* the Fires show the frame of the tick, like TrapManager.update,
+* and every frame collides with its mask, like utils.sweep: the player's
+  and the Fires' and Flag's masks pixel line by pixel line (FrameTable), a
+  tile's by where its mask starts and ends on each line (CollisionGrid).
+
+The tile model assumes what holds for the terrain blocks: that a tile's mask
+has no holes inside a line, and that every line of it is longer than the
+player's mask. measure_drift() steps real Worlds alongside on the same inputs
+and reports how far apart they get; `python batch.py level.jql` prints it.
+With random inputs on 20 to 30 agents for 600 to 1500 ticks, on the default
+level (at 60, 120 and 144 Hz) and on mapgen maps, no agent ever differs from
+its World in position, health or reaching the flag. A tick of 1000 agents
+takes about 5 ms against about 50 ms for 1000 Worlds.
+'''
+import numpy as np
+import pygame
+
+from utils import FPS, run_speed, get_block
+from classes import Player, Fire, Flag
+
+
+# the animations Player.update_sprite picks from. A sheet id is the index
+# here times two, plus one when the player faces right
+SHEETS = ("idle", "hit", "jump", "double_jump", "fall", "run")
+IDLE, HIT, JUMP, DOUBLE_JUMP, FALL, RUN = range(len(SHEETS))
+# the distance to nothing in the way
+FAR = 1 << 62
+# the span of a line of a mask with nothing set on it
+EMPTY = 1 << 30
+# a line of a mask is kept as the bits of one integer
+LINE_BITS = 64
+
+
+def mask_bits(mask):
+    ''' The pixels of a mask as a boolean array, indexed by x, y'''
+    surface = mask.to_surface(setcolor=(255, 255, 255, 255), unsetcolor=(0, 0, 0, 0))
+    return pygame.surfarray.array_alpha(surface) > 0
+
+
+def outline(bits, axis):
+    ''' Where the set pixels of mask_bits start and end along axis on each
+    line across it, EMPTY and -EMPTY on the empty lines'''
+    by_line = bits.T if axis == 0 else bits  # one row per line
+    found = by_line.any(axis=1)
+    starts = np.where(found, by_line.argmax(axis=1), EMPTY)
+    ends = np.where(found, by_line.shape[1] - by_line[:, ::-1].argmax(axis=1), -EMPTY)
+    return starts, ends
+
+
+class FrameTable:
+    '''Animation frames as arrays: the frames of every sheet one after the
+    other, with each frame's size and its mask line by line.
+
+    For motion along an axis (0 = x, 1 = y) the lines are the ones across
+    it, the columns for motion along y. lines[axis] holds every line as the
+    bits of an integer, bit k for the pixel k along the axis, and starts[axis]
+    and ends[axis] where the set pixels of each line start and end (EMPTY and
+    -EMPTY for an empty line). Every frame is padded with empty lines to the
+    widest one.
+    '''
+
+    def __init__(self, sheets):
+        lengths = [len(frames) for frames in sheets]
+        self.length = np.array(lengths, dtype=np.int64)
+        self.start = np.cumsum([0] + lengths[:-1]).astype(np.int64)
+        frames = [frame for sheet in sheets for frame in sheet]
+        self.sizes = np.array([frame.rect.size for frame in frames], dtype=np.int64).reshape(-1, 2)
+        if len(frames) and self.sizes.max() > LINE_BITS:
+            raise ValueError(f"frames can be at most {LINE_BITS} pixels on a side")
+        masks = [mask_bits(frame.mask) for frame in frames]
+        powers = np.left_shift(np.uint64(1), np.arange(LINE_BITS, dtype=np.uint64))
+        self.lines, self.starts, self.ends = [], [], []
+        for axis in (0, 1):
+            width = max((bits.shape[1 - axis] for bits in masks), default=0)
+            lines = np.zeros((len(masks), width), dtype=np.uint64)
+            starts = np.full((len(masks), width), EMPTY, dtype=np.int64)
+            ends = np.full((len(masks), width), -EMPTY, dtype=np.int64)
+            for i, bits in enumerate(masks):
+                by_line = bits.T if axis == 0 else bits
+                count, size = by_line.shape
+                lines[i, :count] = (by_line * powers[:size]).sum(axis=1, dtype=np.uint64)
+                starts[i, :count], ends[i, :count] = outline(bits, axis)
+            self.lines.append(lines)
+            self.starts.append(starts)
+            self.ends.append(ends)
+        # sparse tables for extent: level k holds the least start and the
+        # most end of the 2**k lines from each line on
+        self.least, self.most = [], []
+        for starts, ends in zip(self.starts, self.ends):
+            least, most = [starts], [ends]
+            width = 1
+            while width * 2 <= starts.shape[1]:
+                previous_least, previous_most = least[-1], most[-1]
+                least.append(previous_least.copy())
+                most.append(previous_most.copy())
+                least[-1][:, :-width] = np.minimum(previous_least[:, :-width], previous_least[:, width:])
+                most[-1][:, :-width] = np.maximum(previous_most[:, :-width], previous_most[:, width:])
+                width *= 2
+            self.least.append(np.array(least))
+            self.most.append(np.array(most))
+
+    def frame(self, sheet, index):
+        ''' The frames at index (wrapping around) of the sheets'''
+        return self.start[sheet] + index % self.length[sheet]
+
+    def extent(self, axis, frame, first, stop):
+        ''' Where the set pixels of the lines from first to stop (exclusive)
+        of each frame start and end along axis, EMPTY and -EMPTY when none are.
+        frame has a row of runs of lines in first and stop'''
+        width = self.starts[axis].shape[1]
+        filled = stop > first
+        count = np.maximum(stop - first, 1)
+        level = np.log2(count).astype(np.int64)  # the biggest power of two in count
+        first = np.minimum(first, width - 1)
+        second = np.clip(stop - (1 << level), 0, width - 1)
+        frame = frame[:, None]
+        least, most = self.least[axis], self.most[axis]
+        start = np.minimum(least[level, frame, first], least[level, frame, second])
+        end = np.maximum(most[level, frame, first], most[level, frame, second])
+        return np.where(filled, start, EMPTY), np.where(filled, end, -EMPTY)
+
+
+def shifted(lines, offset):
+    ''' Moves the bits of lines offset places up (down when negative), losing
+    the ones that fall off either end'''
+    amount = np.minimum(np.abs(offset), LINE_BITS - 1).astype(np.uint64)
+    moved = np.where(offset >= 0, np.left_shift(lines, amount), np.right_shift(lines, amount))
+    return np.where(np.abs(offset) < LINE_BITS, moved, np.uint64(0))
+
+
+class CollisionGrid:
+    '''The solid tiles of a level as a boolean grid, plus the Fires and Flags.
+
+    For every cell the grid also stores the nearest solid cell below, above,
+    left and right of it, so where a span of pixels moving any distance
+    along an axis first touches a tile is a couple of table lookups.
+    '''
+
+    def __init__(self, solid, tile_size, origin, fires=(), flags=(), fire_on=None, tile=None):
+        self.solid = np.asarray(solid, dtype=bool)
+        self.tile_size = tile_size
+        self.origin = origin
+        # where the mask of a tile starts and ends on each of its lines (see
+        # outline), as runs of lines where that stays the same: for each axis
+        # the offset of the first line of every run, and its start and end.
+        # Without the tile's Frame the tiles are solid squares
+        if tile is None:
+            outlines = [(np.zeros(tile_size, dtype=np.int64), np.full(tile_size, tile_size, dtype=np.int64))] * 2
+        else:
+            bits = mask_bits(tile.mask)
+            outlines = [outline(bits, axis) for axis in (0, 1)]
+        self.tile_runs = []
+        for starts, ends in outlines:
+            offsets = np.concatenate([[0], np.flatnonzero((np.diff(starts) != 0) | (np.diff(ends) != 0)) + 1])
+            self.tile_runs.append((offsets, starts[offsets], ends[offsets]))
+        # x, y, width, height, as the Fire and Flag objects are created with
+        self.fires = np.array(fires, dtype=np.int64).reshape(-1, 4)
+        self.flags = np.array(flags, dtype=np.int64).reshape(-1, 4)
+        # which fires are lit, all of them by default
+        self.fire_on = np.ones(len(self.fires), dtype=bool) if fire_on is None else np.asarray(fire_on, dtype=bool)
+
+        rows, columns = self.solid.shape
+        self.next_down = self._scan(self.solid, rows, reverse=True)
+        self.next_up = self._scan(self.solid, -1, reverse=False)
+        self.next_right = self._scan(self.solid.T, columns, reverse=True).T
+        self.next_left = self._scan(self.solid.T, -1, reverse=False).T
+
+    @staticmethod
+    def _scan(solid, missing, reverse):
+        ''' For every cell, the index of the nearest solid row at or after it
+        (reverse=True) or at or before it, with missing where there is none'''
+        nearest = np.empty(solid.shape, dtype=np.int64)
+        current = np.full(solid.shape[1], missing, dtype=np.int64)
+        order = range(solid.shape[0] - 1, -1, -1) if reverse else range(solid.shape[0])
+        for row in order:
+            current = np.where(solid[row], row, current)
+            nearest[row] = current
+        return nearest
+
+    @classmethod
+    def from_objects(cls, objects):
+        ''' Builds the grid from the Blocks, Fires and Flags of a World'''
+        blocks = [obj for obj in objects if obj.STATIC_TILE]
+        tile_size = blocks[0].rect.width
+        left = min(block.rect.x for block in blocks)
+        top = min(block.rect.y for block in blocks)
+        columns = (max(block.rect.x for block in blocks) - left) // tile_size + 1
+        rows = (max(block.rect.y for block in blocks) - top) // tile_size + 1
+
+        solid = np.zeros((rows, columns), dtype=bool)
+        for block in blocks:
+            solid[(block.rect.y - top) // tile_size, (block.rect.x - left) // tile_size] = True
+        fires = [obj for obj in objects if isinstance(obj, Fire)]
+        flags = [(obj.rect.x, obj.rect.y, obj.width, obj.height) for obj in objects if isinstance(obj, Flag)]
+        return cls(solid, tile_size, (left, top), [(obj.rect.x, obj.rect.y, obj.width, obj.height) for obj in fires],
+                   flags, [obj.animation_name == "on" for obj in fires], get_block(tile_size))
+
+    @classmethod
+    def from_level(cls, level):
+        ''' Builds the grid from an open levels.LevelStream without creating any objects'''
+        from levels import ENTITY, FIRE, FLAG, TERRAIN, FIRE_ON
+
+        size = level.chunk_tiles
+        cells = np.frombuffer(level.data, dtype=np.uint8, count=level.chunk_rows * level.chunk_columns * size * size,
+                              offset=level.grid_start)
+        # the file stores the grid chunk by chunk, put the chunks back side by side
+        grid = cells.reshape(level.chunk_rows, level.chunk_columns, size, size).transpose(0, 2, 1, 3)
+        grid = grid.reshape(level.chunk_rows * size, level.chunk_columns * size)
+
+        fires, flags, fire_on = [], [], []
+        for i in range(level.entity_count):
+            kind, state, x, y, width, height = ENTITY.unpack_from(level.data, level.entities_start + i * ENTITY.size)
+            if kind == FIRE:
+                fires.append((x, y, width, height))
+                fire_on.append(bool(state & FIRE_ON))
+            elif kind == FLAG:
+                flags.append((x, y, width, height))
+        return cls(grid == TERRAIN, level.tile_size, level.origin, fires, flags, fire_on, get_block(level.tile_size))
+
+    def _cells(self, pixels, axis):
+        ''' Converts pixel coordinates to cell indices along an axis (0 = x, 1 = y)'''
+        return (pixels - self.origin[axis]) // self.tile_size
+
+    def _lookup(self, table, rows, columns, missing):
+        ''' Reads a nearest-solid table, treating cells outside the grid as empty'''
+        height, width = self.solid.shape
+        inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width)
+        found = table[np.clip(rows, 0, height - 1), np.clip(columns, 0, width - 1)]
+        return np.where(inside, found, missing)
+
+    def solid_at(self, rows, columns):
+        ''' Which of the cells are solid, cells outside the grid are empty'''
+        return self._lookup(self.solid, rows, columns, False)
+
+    def groups(self, line, count, axis):
+        '''Groups count lines of pixels across axis (0 = x, 1 = y), from
+        line on, for contact: the lines that cross the same run of lines of
+        the same tiles all meet the same tiles, and as long as the tile's
+        mask is longer on every line than the spans are, a tile that touches
+        any of their spans touches the union of them first. So the spans of
+        such a group of lines can be swept as one.
+        Returns (across, first, stop, tile_start, tile_end): the cell across
+        the axis of each group, its lines as indices from line (from first
+        to stop, exclusive, empty for the groups past the lines), and where
+        the tiles' masks start and end on it'''
+        size = self.tile_size
+        offsets, tile_starts, tile_ends = self.tile_runs[axis]
+        # the lines cover this many cells at most
+        spread = -(-count // size) + 1
+        cell = np.repeat(np.arange(spread), len(offsets))
+        run = np.tile(np.arange(len(offsets)), spread)
+        across = self._cells(line, 1 - axis)[:, None] + cell
+        first = np.clip(self.origin[1 - axis] + across * size + offsets[run] - line[:, None], 0, count)
+        first[:, 0] = 0
+        stop = np.concatenate([first[:, 1:], np.full((len(line), 1), count)], axis=1)
+        return across, first, stop, tile_starts[run], tile_ends[run]
+
+    def overlaps(self, spans, axis):
+        '''The tiles that the spans overlap, see contact. A span is shorter
+        than a tile, so those can only be the tiles at its two ends: returns
+        a (cell along the axis, overlap) pair for each end'''
+        size = self.tile_size
+        across, start, end, tile_start, tile_end = spans
+        ends = []
+        for pixel in (start, end - 1):
+            cell = self._cells(np.where(end > start, pixel, 0), axis)
+            edge = self.origin[axis] + cell * size
+            solid = self.solid_at(cell, across) if axis == 1 else self.solid_at(across, cell)
+            ends.append((cell, solid & (start < edge + tile_end) & (edge + tile_start < end)))
+        return ends
+
+    def contact(self, spans, center, axis, direction):
+        '''Sweeps spans of pixels against the tiles, like utils.sweep.
+
+        spans: (across, start, end, tile_start, tile_end), one span for each
+        of the groups of lines, from start to end (exclusive) along axis,
+        with across and the tiles' masks as groups returns them.
+        They belong to rects whose centre along axis is center; direction is
+        1 or -1, or 0 to only look where they are.
+        Returns the step at which each span first touches a tile: 0 when it
+        overlaps one already that lies ahead (or when it isn't moving), FAR
+        when it never touches one.
+        '''
+        size = self.tile_size
+        count = self.solid.shape[1 - axis]  # cells along the axis
+        across, start, end, tile_start, tile_end = spans
+
+        def cells(cell):
+            # the (row, column) of cell along the axis
+            return (cell, across) if axis == 1 else (across, cell)
+
+        def edge(cell):
+            return self.origin[axis] + cell * size
+
+        contact = np.full(np.shape(start), FAR)
+        (first, first_overlap), (last, last_overlap) = ends = self.overlaps(spans, axis)
+        for cell, overlap in ends:
+            ahead = ((edge(cell) + size // 2 - center) * direction > 0) | (direction == 0)
+            contact = np.where(overlap & ahead, 0, contact)
+
+        # and the nearest tile past them. A tile the span is in without
+        # overlapping its mask can still be ahead
+        forward, backward = (self.next_down, self.next_up) if axis == 1 else (self.next_right, self.next_left)
+        after = self._lookup(forward, *cells(np.maximum(last + last_overlap, 0)), count)
+        gap = edge(after) + tile_start - end
+        contact = np.where((direction > 0) & (after < count) & (gap >= 0), np.minimum(contact, gap + 1), contact)
+        before = self._lookup(backward, *cells(np.minimum(first - first_overlap, count - 1)), -1)
+        gap = start - edge(before) - tile_end
+        contact = np.where((direction < 0) & (before >= 0) & (gap >= 0), np.minimum(contact, gap + 1), contact)
+        return np.where(end > start, contact, FAR)
+
+
+def round_half_away(values):
+    ''' Rounds like pygame does when a float is assigned to a rect coordinate'''
+    return np.where(values >= 0, np.floor(values + 0.5), -np.floor(0.5 - values)).astype(np.int64)
+
+
+class BatchPlayers:
+    '''N players as NumPy arrays, stepped together against a CollisionGrid.
+    The frames come from the sprite sheets, so call utils.init_headless()
+    first when there is no display'''
+
+    def __init__(self, grid, spawns, fps=FPS):
+        spawns = np.array(spawns, dtype=np.int64).reshape(-1, 2)
+        self.grid = grid
+        self.fps = fps
+        self.spawn_x, self.spawn_y = spawns[:, 0].copy(), spawns[:, 1].copy()
+        count = len(spawns)
+        self.x = self.spawn_x.copy()   # rect.x
+        self.y = self.spawn_y.copy()   # rect.y
+        self.x_vel = np.zeros(count, dtype=np.int64)
+        self.y_vel = np.zeros(count)
+        self.fall_count = np.zeros(count, dtype=np.int64)
+        self.jump_count = np.zeros(count, dtype=np.int64)
+        self.hit = np.zeros(count, dtype=bool)
+        self.hit_count = np.zeros(count, dtype=np.int64)
+        self.max_health = 3
+        self.health = np.full(count, self.max_health, dtype=np.int64)
+        self.won = np.zeros(count, dtype=bool)
+        self.facing_right = np.zeros(count, dtype=bool)  # a Player starts facing left
+        self.animation_count = np.zeros(count, dtype=np.int64)
+        self.tick = 0
+
+        sprites = Player.load_sprites()
+        self.frames = FrameTable([sprites[f"{sheet}_{direction}"]
+                                  for sheet in SHEETS for direction in ("left", "right")])
+        self.frame = np.full(count, self.frames.start[IDLE * 2], dtype=np.int64)
+
+        # the obstacles are the fires followed by the flags. Every size of
+        # fire has an off and an on sheet, every flag a sheet of one frame
+        sizes = sorted({(width, height) for _, _, width, height in grid.fires})
+        sheets = []
+        for width, height in sizes:
+            fire = Fire(0, 0, width, height)
+            sheets += [fire.fire["off"], fire.fire["on"]]
+        self.fire_sheet = np.array([sizes.index((width, height)) * 2 for _, _, width, height in grid.fires],
+                                   dtype=np.int64) + grid.fire_on
+        sheets += [[Flag(0, 0, width, height)] for _, _, width, height in grid.flags]
+        self.obstacle_frames = FrameTable(sheets)
+        self.flag_frames = np.arange(len(grid.flags), dtype=np.int64) + (len(sheets) - len(grid.flags))
+        self.flag_frames = self.obstacle_frames.start[self.flag_frames]
+        self.obstacle_x = np.concatenate([grid.fires[:, 0], grid.flags[:, 0]])
+        self.obstacle_y = np.concatenate([grid.fires[:, 1], grid.flags[:, 1]])
+        self.is_fire = np.arange(len(self.obstacle_x)) < len(grid.fires)
+
+    def __len__(self):
+        return len(self.x)
+
+    def update_sprite(self):
+        ''' Picks every player's animation frame, like Player.update_sprite'''
+        rising = self.y_vel < 0
+        sheet = np.select([self.hit, rising & (self.jump_count == 1), rising & (self.jump_count == 2), rising,
+                           self.y_vel > Player.GRAVITY * 2 * FPS / self.fps, self.x_vel != 0],
+                          [HIT, JUMP, DOUBLE_JUMP, IDLE, FALL, RUN], IDLE)
+        index = self.animation_count * FPS // self.fps // Player.ANIMATION_DELAY
+        self.frame = self.frames.frame(sheet * 2 + self.facing_right, index)
+        self.animation_count += 1
+
+    def obstacle_frame(self):
+        ''' The frame of every obstacle on this tick: the fires show the frame
+        TrapManager.update would, see Fire.period and Fire.show'''
+        frames = self.obstacle_frames
+        tick = self.tick * FPS // self.fps
+        length = frames.length[self.fire_sheet]
+        count = tick % (Fire.ANIMATION_DELAY * (length + 1))
+        fires = frames.start[self.fire_sheet] + (count // Fire.ANIMATION_DELAY) % length
+        return np.concatenate([fires, self.flag_frames])
+
+    def candidates(self, obstacle_frame, reach):
+        ''' The (player, obstacle) pairs whose rects are within reach pixels of each other'''
+        if not len(obstacle_frame):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        width, height = self.frames.sizes[self.frame].T
+        other_width, other_height = self.obstacle_frames.sizes[obstacle_frame].T
+        near = ((self.x - reach)[:, None] < self.obstacle_x + other_width) & \
+               ((self.x + width + reach)[:, None] > self.obstacle_x) & \
+               ((self.y - reach)[:, None] < self.obstacle_y + other_height) & \
+               ((self.y + height + reach)[:, None] > self.obstacle_y)
+        return np.nonzero(near)
+
+    def contacts(self, pairs, obstacle_frame, axis, direction, distance):
+        '''Sweeps the masks of the (player, obstacle) pairs like utils.sweep.
+        direction: per player 1 or -1 along axis (0 = x, 1 = y), or 0 to only
+        look where they are; distance: per player the pixels to move.
+        Returns, per pair, the step at which the masks first touch (0 when
+        they overlap already and the obstacle lies ahead, FAR when they don't
+        touch within distance) and whether they overlap already'''
+        mine, theirs = self.frames, self.obstacle_frames
+        position = (self.x, self.y)
+        other_position = (self.obstacle_x, self.obstacle_y)
+        contact = np.full(len(pairs[0]), FAR)
+        overlap = np.zeros(len(pairs[0]), dtype=bool)
+
+        # only the pairs whose rects meet on the way can touch, like the
+        # candidates of utils.sweep
+        agents, others = pairs
+        reach = np.where(direction[agents] != 0, distance[agents], 0)
+        low = position[axis][agents] + np.minimum(direction[agents] * reach, 0)
+        high = position[axis][agents] + mine.sizes[self.frame[agents], axis] + np.maximum(direction[agents] * reach, 0)
+        other_low = other_position[axis][others]
+        other_high = other_low + theirs.sizes[obstacle_frame[others], axis]
+        across = position[1 - axis][agents]
+        other_across = other_position[1 - axis][others]
+        near = ((low < other_high) & (high > other_low) &
+                (across < other_across + theirs.sizes[obstacle_frame[others], 1 - axis]) &
+                (across + mine.sizes[self.frame[agents], 1 - axis] > other_across))
+        chosen = np.flatnonzero(near)
+        agents, others = agents[chosen], others[chosen]
+        frame = self.frame[agents]
+        other = obstacle_frame[others]
+
+        # the obstacle's line level with each line of the player
+        count = theirs.lines[axis].shape[1]
+        line = position[1 - axis][agents][:, None] + np.arange(mine.lines[axis].shape[1])
+        line -= other_position[1 - axis][others][:, None]
+        inside = (line >= 0) & (line < count)
+        other_lines = theirs.lines[axis][other[:, None], np.clip(line, 0, count - 1)]
+        other_lines = np.where(inside, other_lines, np.uint64(0))
+        lines = mine.lines[axis][frame]
+        # where the player's lines start, counted along the obstacle's
+        offset = (position[axis][agents] - other_position[axis][others])[:, None]
+
+        def touching(offset):
+            return (shifted(lines, offset) & other_lines).any(axis=1)
+
+        overlapping = touching(offset)
+        step = direction[agents]
+        reach = reach[chosen]
+        found = np.full(len(agents), FAR)
+        for moved in range(1, int(reach.max(initial=0)) + 1):
+            first = (found == FAR) & (moved <= reach) & touching(offset + step[:, None] * moved)
+            found[first] = moved
+        # overlapping already: touched at once when the obstacle is ahead
+        # (or when not moving at all), ignored when moving away from it
+        center = position[axis][agents] + mine.sizes[frame, axis] // 2
+        other_center = other_position[axis][others] + theirs.sizes[other, axis] // 2
+        ahead = ((other_center - center) * step > 0) | (step == 0)
+        contact[chosen] = np.where(overlapping, np.where(ahead, 0, FAR), found)
+        overlap[chosen] = overlapping
+        return contact, overlap
+
+    def tile_spans(self, axis):
+        ''' The players' masks as the spans of CollisionGrid.contact, for motion along axis'''
+        position = (self.x, self.y)
+        across, first, stop, tile_start, tile_end = self.grid.groups(position[1 - axis], self.frames.starts[axis].shape[1], axis)
+        start, end = self.frames.extent(axis, self.frame, first, stop)
+        return across, position[axis][:, None] + start, position[axis][:, None] + end, tile_start, tile_end
+
+    def tile_contact(self, axis, direction):
+        ''' The step at which each player's mask moving in direction (per
+        player 1, -1 or 0) along axis first touches a tile, see CollisionGrid.contact'''
+        center = (self.x, self.y)[axis] + self.frames.sizes[self.frame, axis] // 2
+        return self.grid.contact(self.tile_spans(axis), center[:, None], axis, direction[:, None]).min(axis=1)
+
+    def nearest(self, tiles, contact, pairs, distance):
+        '''Combines the contacts with the tiles and with the obstacles into
+        how far each player moves (at most distance) and which pairs it
+        touches on the way, like utils.sweep'''
+        first = tiles.copy()
+        np.minimum.at(first, pairs[0], contact)
+        agents = pairs[0]
+        touched = (contact == first[agents]) & (contact <= distance[agents])
+        room = np.where(first <= distance, np.maximum(first - 1, 0), distance)
+        return room, touched
+
+    def pop_out(self, pairs, obstacle_frame):
+        ''' Moves the players whose new frame overlaps a tile or an obstacle
+        onto its edge, like the start of handle_vertical_collision'''
+        grid = self.grid
+        size = grid.tile_size
+        frames = self.frames
+        height = frames.sizes[self.frame, 1]
+        center = self.y + height // 2
+        below = np.full(len(self), FAR)   # the highest top below the center
+        above = np.full(len(self), -FAR)  # the lowest bottom above the center
+
+        for row, overlap in grid.overlaps(self.tile_spans(1), 1):
+            top = grid.origin[1] + row * size
+            below = np.minimum(below, np.where(overlap & (top >= center[:, None]), top, FAR).min(axis=1))
+            above = np.maximum(above, np.where(overlap & (top + size <= center[:, None]), top + size, -FAR).max(axis=1))
+
+        if len(pairs[0]):
+            agents, others = pairs
+            still = np.zeros(len(self), dtype=np.int64)
+            _, overlap = self.contacts(pairs, obstacle_frame, 1, still, still)
+            top = self.obstacle_y[others]
+            bottom = top + self.obstacle_frames.sizes[obstacle_frame[others], 1]
+            np.minimum.at(below, agents, np.where(overlap & (top >= center[agents]), top, FAR))
+            np.maximum.at(above, agents, np.where(overlap & (bottom <= center[agents]), bottom, -FAR))
+        self.y = np.where(below < FAR, below - height, self.y)
+        self.y = np.where(above > -FAR, above, self.y)
+
+    def step(self, left, right, jump):
+        ''' Advances every player one tick. left, right and jump are boolean arrays'''
+        gravity = Player.GRAVITY
+        scale = FPS / self.fps  # the rules are written per tick at FPS, see Player.loop
+        speed = run_speed(self.tick, self.fps)
+        left = np.asarray(left, dtype=bool)
+        right = np.asarray(right, dtype=bool)
+
+        # jump (Player.jump)
+        jumping = np.asarray(jump, dtype=bool) & (self.jump_count < 2)
+        self.y_vel = np.where(jumping, -gravity * 8 * scale, self.y_vel)
+        self.animation_count[jumping] = 0
+        self.jump_count += jumping
+        self.fall_count = np.where(jumping & (self.jump_count == 1), 0, self.fall_count)
+
+        # Player.loop: gravity, the horizontal move, the hit timer and the frame
+        self.y_vel += np.minimum(1, (self.fall_count / self.fps) * gravity) * scale * scale
+        self.x += self.x_vel
+        self.hit_count += self.hit
+        recovered = self.hit_count > self.fps * 2
+        self.hit &= ~recovered
+        self.hit_count[recovered] = 0
+        self.fall_count += 1
+        self.update_sprite()
+
+        # handle_move: out of whatever the new frame overlaps, then the vertical sweep
+        obstacle_frame = self.obstacle_frame()
+        reach = self.frames.sizes[self.frame, 1] + np.abs(self.y_vel).astype(np.int64) + 1 + speed
+        pairs = self.candidates(obstacle_frame, reach)
+        self.pop_out(pairs, obstacle_frame)
+        self.x_vel[:] = 0
+        steps = round_half_away(self.y + self.y_vel) - self.y
+        direction = np.sign(steps)
+        tiles = self.tile_contact(1, direction)
+        contact, _ = self.contacts(pairs, obstacle_frame, 1, direction, np.abs(steps))
+        room, touched = self.nearest(tiles, contact, pairs, np.abs(steps))
+        collided = np.zeros(len(self), dtype=bool)
+        collided[pairs[0][touched]] = True
+        collided |= tiles <= np.abs(steps)
+        self.y += direction * room
+
+        # landed() and hit_head() go by the sign of the velocity, like handle_vertical_collision
+        landed = collided & (self.y_vel > 0)
+        bumped = collided & (self.y_vel < 0)
+        self.fall_count[landed] = 0
+        self.y_vel[landed] = 0
+        self.jump_count[landed] = 0
+        self.y_vel[bumped] *= -1
+
+        # then how far each player may move sideways, touching whatever is
+        # that close whichever keys are held (move_left/move_right)
+        distance = np.full(len(self), speed, dtype=np.int64)
+        contact, _ = self.contacts(pairs, obstacle_frame, 0, -np.ones(len(self), dtype=np.int64), distance)
+        room_left, touched_left = self.nearest(self.tile_contact(0, -np.ones(len(self), dtype=np.int64)),
+                                               contact, pairs, distance)
+        contact, _ = self.contacts(pairs, obstacle_frame, 0, np.ones(len(self), dtype=np.int64), distance)
+        room_right, touched_right = self.nearest(self.tile_contact(0, np.ones(len(self), dtype=np.int64)),
+                                                 contact, pairs, distance)
+
+        going = left & (room_left > 0)
+        self.animation_count[going & self.facing_right] = 0
+        self.facing_right &= ~going
+        self.x_vel = np.where(going, -room_left, self.x_vel)
+        going = right & (room_right > 0)
+        self.animation_count[going & ~self.facing_right] = 0
+        self.facing_right |= going
+        self.x_vel = np.where(going, room_right, self.x_vel)
+
+        # every fire touched costs a health point, touching a flag wins the game
+        touches = touched.astype(np.int64) + touched_left + touched_right
+        fire = self.is_fire[pairs[1]]
+        burns = np.bincount(pairs[0], weights=touches * fire, minlength=len(self)).astype(np.int64)
+        flagged = np.bincount(pairs[0], weights=touches * ~fire, minlength=len(self)) > 0
+        burnt = burns > 0
+        self.hit |= burnt
+        self.hit_count[burnt] = 0
+        self.health = np.maximum(self.health - burns, 0)
+        self.won |= flagged
+
+        # reset_to_spawn
+        dead = self.health <= 0
+        if dead.any():
+            self.x[dead] = self.spawn_x[dead]
+            self.y[dead] = self.spawn_y[dead]
+            self.health[dead] = self.max_health
+            self.x_vel[dead] = 0
+            self.y_vel[dead] = 0
+            self.hit[dead] = False
+            self.hit_count[dead] = 0
+            self.fall_count[dead] = 0
+            self.jump_count[dead] = 0
+
+        self.tick += 1
+
+
+def measure_drift(make_world, inputs):
+    '''Steps BatchPlayers and one real World per agent on the same inputs and
+    measures how far apart they end up.
+
+    make_world: returns a fresh World of the map, e.g. levels.load_world
+    inputs: a sequence of (left, right, jump) boolean arrays, one per tick,
+    with one entry per agent
+    Returns a dictionary: the first tick at which any agent's position
+    differs from its World (None if none did), the largest and the mean
+    distance in pixels over every agent and tick, and how many agents
+    disagree about health and reaching the flag at the end.
+    World needs the sprites, so call utils.init_headless() first.
+    '''
+    from world import Input
+
+    inputs = list(inputs)
+    agents = len(inputs[0][0]) if inputs else 0
+    worlds = [make_world() for _ in range(agents)]
+    if not worlds:
+        raise ValueError("no agents to compare")
+    first = worlds[0]
+    if first.level is not None:
+        grid = CollisionGrid.from_level(first.level)
+    else:
+        grid = CollisionGrid.from_objects(list(first.objects))
+    batch = BatchPlayers(grid, [world.player.rect.topleft for world in worlds], first.fps)
+
+    first_divergence = None
+    worst = total = 0.0
+    for tick, (left, right, jump) in enumerate(inputs):
+        batch.step(left, right, jump)
+        for i, world in enumerate(worlds):
+            world.step(Input(bool(left[i]), bool(right[i]), bool(jump[i])))
+        x = np.array([world.player.rect.x for world in worlds])
+        y = np.array([world.player.rect.y for world in worlds])
+        drift = np.hypot(batch.x - x, batch.y - y)
+        if first_divergence is None and drift.any():
+            first_divergence = tick
+        worst = max(worst, float(drift.max()))
+        total += float(drift.sum())
+
+    return {
+        "agents": agents,
+        "ticks": len(inputs),
+        "first_divergence": first_divergence,
+        "max_drift": worst,
+        "mean_drift": total / max(1, agents * len(inputs)),
+        "health_mismatches": int(sum(batch.health[i] != world.player.current_health for i, world in enumerate(worlds))),
+        "won_mismatches": int(sum(batch.won[i] != world.won for i, world in enumerate(worlds))),
+    }
+
+
+def main():
+    import argparse
+    from functools import partial
+
+    from utils import init_headless
+    from levels import DEFAULT_LEVEL, load_world
+
+    parser = argparse.ArgumentParser(description="Measures how far BatchPlayers drifts from World on a level")
+    parser.add_argument("level", nargs="?", default=DEFAULT_LEVEL)
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--ticks", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    init_headless()
+    rng = np.random.default_rng(args.seed)
+    inputs = [(rng.random(args.agents) < 0.4, rng.random(args.agents) < 0.5, rng.random(args.agents) < 0.05)
+              for _ in range(args.ticks)]
+    drift = measure_drift(partial(load_world, args.level), inputs)
+    print(", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+                    for key, value in drift.items()))
+
+
+if __name__ == "__main__":
+    main()
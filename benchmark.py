@@ -0,0 +1,200 @@
+'''Headless benchmark of the game loop.
+
+Runs the World against synthetic maps with scripted or replayed input and
+reports ticks per second, the time spent in each phase and the peak memory,
+so changes to handle_move, collide or the renderer can be compared between
+commits. Example:
+
+    python benchmark.py --blocks 1000 10000 --fires 0 100 --ticks 3000 --out bench.json
+
+or against level files, e.g. maps of growing size made by mapgen.py:
+
+    python benchmark.py --level small.jql big.jql --render
+'''
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pygame
+
+from utils import HEIGHT, WIDTH, compose_background, init_headless
+from classes import Player, Fire
+from world import World, decode_inputs, scripted_inputs
+from levels import load_world
+from render import Renderer
+from profiler import FrameProfiler
+
+
+def load_replay(path):
+    with open(path, "rb") as file:
+        return decode_inputs(file.read())
+
+
+def build_synthetic_level(blocks, fires, density=0.3, seed=0, block_size=96):
+    '''Builds a World with a floor and about `blocks` Blocks scattered over a
+    square-ish region above it, `density` being the fraction of cells in the
+    region that hold a block. `fires` Fires are put on top of random blocks.
+    '''
+    rng = random.Random(seed)
+    cells = max(1, int(blocks / density))
+    columns = max(WIDTH // block_size, int(cells ** 0.5))
+    rows = max(1, cells // columns)
+
+    floor_y = HEIGHT - block_size
+    tiles = [(i * block_size, floor_y) for i in range(columns)]
+    free = [(column, row) for column in range(columns) for row in range(1, rows + 1)]
+    rng.shuffle(free)
+    # keep the spawn point clear
+    placed = [cell for cell in free if cell[0] > 2][:max(0, blocks - columns)]
+    tiles += [(column * block_size, floor_y - row * block_size) for column, row in placed]
+
+    traps = []
+    tops = [(x, y) for x, y in tiles if x > block_size * 2]
+    for x, y in rng.sample(tops, min(fires, len(tops))):
+        fire = Fire(x + block_size // 3, y - 64, 16, 32)
+        fire.on()
+        traps.append(fire)
+
+    player = Player(block_size, floor_y - 200, 50, 50)
+    world = World(player, traps, traps=traps, block_size=block_size)
+    # the tiles go straight into the tile store, without a Block object each
+    for x, y in tiles:
+        world.objects.tiles.add(x, y)
+    return world
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def isolated(function, *args):
+    '''Runs function(*args) in a fresh interpreter and returns its result.
+    ru_maxrss is the peak of the whole process, so every case gets a process
+    of its own to make peak_rss_kb the peak of that case alone'''
+    # spawn rather than fork: a forked child starts out with the parent's memory
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context, initializer=init_headless, initargs=((WIDTH, HEIGHT),)) as pool:
+        return pool.submit(function, *args).result()
+
+
+def run_case(blocks, fires, density, inputs, seed=0, render=False):
+    ''' Benchmarks one synthetic map and returns its results as a dictionary'''
+    start = time.perf_counter()
+    world = build_synthetic_level(blocks, fires, density, seed)
+    build_seconds = time.perf_counter() - start
+    result = {"blocks": blocks, "fires": fires, "density": density}
+    result.update(measure(world, inputs, render))
+    result["build_seconds"] = build_seconds
+    return result
+
+
+def run_level(path, inputs, render=False):
+    ''' Benchmarks a level file (e.g. one from mapgen.py), streamed like in the game'''
+    start = time.perf_counter()
+    world = load_world(path)
+    build_seconds = time.perf_counter() - start
+    result = {"level": path}
+    result.update(measure(world, inputs, render))
+    result["build_seconds"] = build_seconds
+    return result
+
+
+def measure(world, inputs, render=False):
+    ''' Steps a World through the inputs and returns the timings'''
+    profiler = FrameProfiler(size=len(inputs))
+    world.profiler = profiler
+    renderer = None
+    if render:
+        renderer = Renderer(pygame.display.get_surface(), compose_background("Brown.png"))
+        renderer.profiler = profiler
+
+    offset_x = 0
+    start = time.perf_counter()
+    for tick_input in inputs:
+        profiler.start_frame()
+        if renderer is not None:
+            world.traps.view = pygame.Rect(offset_x, 0, WIDTH, HEIGHT)
+        world.step(tick_input)
+        if renderer is not None:
+            # keep the player roughly centred like the game's scrolling does
+            offset_x = world.player.rect.centerx - WIDTH // 2
+            renderer.draw(world.player, world.objects, offset_x)
+        profiler.end_frame()
+    seconds = time.perf_counter() - start
+
+    phases = profiler.stats()
+    # ru_maxrss is in kilobytes on Linux. It is the peak of the whole process,
+    # main() runs every case in a process of its own (see isolated)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "objects": len(world.objects),
+        "ticks": len(inputs),
+        "ticks_per_second": len(inputs) / seconds,
+        "peak_rss_kb": peak_rss,
+        # the benchmark has no event pump, and nothing is drawn unless render is set
+        "phases_ms": {phase: {"mean": stat["mean"], "p99": stat["p99"]} for phase, stat in phases.items()
+                      if phase != "events" and (render or phase not in ("draw", "flip"))},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--fires", type=int, nargs="+", default=[1, 50])
+    parser.add_argument("--density", type=float, nargs="+", default=[0.3])
+    parser.add_argument("--ticks", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--level", nargs="+", default=[], help="benchmark these level files instead of synthetic maps")
+    parser.add_argument("--replay", help="input replay file, one byte per tick, instead of the script")
+    parser.add_argument("--render", action="store_true", help="also draw every tick with the dummy video driver")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # no window or sound card is needed to benchmark
+    init_headless((WIDTH, HEIGHT))
+    inputs = load_replay(args.replay) if args.replay else scripted_inputs(args.ticks, args.seed)
+
+    results = []
+    for path in args.level:
+        result = isolated(run_level, path, inputs, args.render)
+        results.append(result)
+        phases = "  ".join(f"{phase} {stat['mean']:.3f}" for phase, stat in result["phases_ms"].items())
+        print(f"{path}  {result['ticks_per_second']:9.0f} ticks/s  peak RSS {result['peak_rss_kb'] / 1024:6.1f} MB  "
+              f"ms/tick: {phases}")
+    for blocks in ([] if args.level else args.blocks):
+        for fires in args.fires:
+            for density in args.density:
+                result = isolated(run_case, blocks, fires, density, inputs, args.seed, args.render)
+                results.append(result)
+                phases = "  ".join(f"{phase} {stat['mean']:.3f}" for phase, stat in result["phases_ms"].items())
+                print(f"blocks={blocks:<7} fires={fires:<5} density={density:<5} "
+                      f"{result['ticks_per_second']:9.0f} ticks/s  peak RSS {result['peak_rss_kb'] / 1024:6.1f} MB  "
+                      f"ms/tick: {phases}")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump({
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "pygame": pygame.version.ver,
+                "seed": args.seed,
+                "replay": args.replay,
+                "render": args.render,
+                "results": results,
+            }, file, indent=1)
+
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
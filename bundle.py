@@ -0,0 +1,167 @@
+'''Prebuilt asset bundle.
+
+Decoding the PNGs, slicing the sprite sheets, scale2x-ing and flipping every
+frame costs the same work on every launch. This module packs the finished
+frames into one binary file, built offline with
+
+    python bundle.py
+
+At runtime the file is memory-mapped and every frame becomes a surface that
+points straight into the mapping, so nothing is decoded or transformed. The
+files under assets/ stay the source of truth: the bundle remembers the size
+and modification time of everything it was built from and is ignored as soon
+as one of them changes.
+
+Layout: magic, version, index length, the JSON index, then the frames' pixels
+in BGRA order (the display's own format, so blits need no conversion), each
+starting on a 16 byte boundary.
+'''
+import json
+import mmap
+import os
+import struct
+from os.path import isfile
+
+import pygame
+
+from asset_cache import ASSETS, Frame
+from utils import load_sprite_sheets, get_block
+from classes import Player, Flag
+
+
+MAGIC = b"JQAB"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")
+ALIGN = 16
+PIXEL_FORMAT = "BGRA"
+
+BUNDLE_PATH = "assets.bundle"
+
+
+def encode_key(key):
+    ''' Turns an asset cache key into something JSON can store'''
+    return [list(part) if isinstance(part, tuple) else part for part in key]
+
+def decode_key(key):
+    ''' Turns a stored key back into the tuple the asset cache uses'''
+    return tuple(tuple(part) if isinstance(part, list) else part for part in key)
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_bundle(path=BUNDLE_PATH):
+    '''Loads every frame the game uses through the asset cache and packs them.
+    Needs a display mode, see utils.init_headless'''
+    ASSETS.clear()
+    # the listings and sheet sizes load_sprite_sheets asks for are recorded
+    ASSETS.recording = {"listings": {}, "sizes": {}}
+    Player.load_sprites()
+    load_sprite_sheets("Traps", "Fire", 16, 32)
+    get_block(96)
+    Flag(0, 0, 32, 64)
+    recording = ASSETS.recording
+    ASSETS.recording = None
+
+    frames = [(key[1:], frame) for key, (frame, _) in ASSETS.entries.items() if key[0] == "frame"]
+    sources = sorted({key[0] for key, _ in frames} | set(recording["sizes"]))
+    index = {
+        "format": PIXEL_FORMAT,
+        "sources": {source: fingerprint(source) for source in sources},
+        "listings": {directory: [*files, fingerprint(directory)] for directory, files in recording["listings"].items()},
+        "sizes": recording["sizes"],
+        "frames": [],
+    }
+
+    blobs = []
+    offset = 0
+    for key, frame in frames:
+        pixels = pygame.image.tobytes(frame.image, PIXEL_FORMAT)
+        index["frames"].append([encode_key(key), offset, *frame.rect.size])
+        blobs.append(pixels)
+        offset += -(-len(pixels) // ALIGN) * ALIGN
+
+    encoded = json.dumps(index).encode()
+    data_start = -(-(HEADER.size + len(encoded)) // ALIGN) * ALIGN
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(encoded)))
+        file.write(encoded)
+        file.write(bytes(data_start - file.tell()))
+        for pixels in blobs:
+            file.write(pixels)
+            file.write(bytes(-len(pixels) % ALIGN))
+    return len(frames)
+
+
+class AssetBundle:
+    '''A memory-mapped bundle, handing out frames that share its memory'''
+
+    def __init__(self, path=BUNDLE_PATH):
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_length = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} asset bundle")
+
+        index = json.loads(self.data[HEADER.size:HEADER.size + index_length])
+        self.sources = index["sources"]
+        self.listings = {directory: (files[:-1], files[-1]) for directory, files in index["listings"].items()}
+        self.sizes = {path: tuple(size) for path, size in index["sizes"].items()}
+        self.frames = {decode_key(key): (offset, width, height) for key, offset, width, height in index["frames"]}
+        self.data_start = -(-(HEADER.size + index_length) // ALIGN) * ALIGN
+        self.view = memoryview(self.data)
+
+    def is_fresh(self):
+        ''' True when none of the files the bundle was built from has changed'''
+        try:
+            return (all(fingerprint(source) == stamp for source, stamp in self.sources.items()) and
+                    all(fingerprint(directory) == stamp for directory, (_, stamp) in self.listings.items()))
+        except OSError:
+            return False
+
+    def frame(self, key):
+        ''' Returns the Frame stored under an asset cache key, or None'''
+        entry = self.frames.get(key)
+        if entry is None:
+            return None
+        offset, width, height = entry
+        start = self.data_start + offset
+        # frombuffer does not copy: the surface reads the mapped file directly
+        image = pygame.image.frombuffer(self.view[start:start + width * height * 4], (width, height), PIXEL_FORMAT)
+        # pygame cannot build a Mask from raw bits, so it is rebuilt from the
+        # bundled alpha channel; that is a single pass in C over the frame
+        return Frame(image, pygame.mask.from_surface(image), image.get_rect())
+
+    def listdir(self, path):
+        listing = self.listings.get(path)
+        return None if listing is None else listing[0]
+
+    def image_size(self, path):
+        return self.sizes.get(path)
+
+
+def use_bundle(path=BUNDLE_PATH):
+    '''Makes the shared asset cache read frames from the bundle at path.
+    Returns False (and changes nothing) if there is no bundle or it is stale'''
+    if not isfile(path):
+        return False
+    try:
+        bundle = AssetBundle(path)
+    except ValueError as error:
+        print(f"Ignoring the asset bundle: {error}")
+        return False
+    if not bundle.is_fresh():
+        print(f"Ignoring {path}: the assets changed since it was built, run python bundle.py")
+        return False
+    ASSETS.bundle = bundle
+    return True
+
+
+if __name__ == "__main__":
+    from utils import init_headless
+
+    init_headless()
+    count = build_bundle()
+    print(f"Packed {count} frames into {BUNDLE_PATH}")
@@ -1,12 +1,13 @@
 import pygame
 from os.path import isfile, join
 
-from utils import load_sprite_sheets, get_block, collide, show_victory_screen
+from asset_cache import ASSETS
+from utils import FPS, load_sprite_sheets, get_block, collide, show_victory_screen
 
 class Player(pygame.sprite.Sprite):
     COLOR = (255, 0, 0)
     GRAVITY = 1
-    SPRITES = load_sprite_sheets("MainCharacters", "MaskDude", 32, 32, True)
+    SPRITES = None # loaded on first use by load_sprites, so importing this module stays cheap
     ANIMATION_DELAY = 5
 
     def __init__(self, x, y, width, height):
@@ -17,6 +18,7 @@ class Player(pygame.sprite.Sprite):
         self.x_vel = 0 # denotes how fast we are moving player every frame laterally
         self.y_vel = 0 # denotes how fast we are moving vertically, every frame
         self.mask = None
+        self.frame = None
         self.direction = "left"  # character starts facing left
         self.animation_count = 0 # reset the count when we are changing animation frames
         self.fall_count = 0 # for keeping track of character fall
@@ -25,12 +27,20 @@ class Player(pygame.sprite.Sprite):
         self.hit_count = 0  # hit count
         self.max_health = 3 # number of maximum health points
         self.current_health = 3 # number of current health points
-        self.font = pygame.font.Font(None, 24) # self font.
+        self.font = None # self font, created the first time the player is drawn
 
-    def jump(self):
+    @classmethod
+    def load_sprites(cls):
+        ''' Loads the MaskDude sprite sheets the first time they are needed'''
+        if cls.SPRITES is None:
+            cls.SPRITES = load_sprite_sheets("MainCharacters", "MaskDude", 32, 32, True)
+        return cls.SPRITES
+
+    def jump(self, fps=FPS):
         ''' This method implements jumping for the character.
+        fps: the ticks a second the player is stepped at, see loop
         '''
-        self.y_vel = -self.GRAVITY * 8
+        self.y_vel = -self.GRAVITY * 8 * FPS / fps
         self.animation_count = 0
         self.jump_count += 1
 
@@ -79,10 +89,15 @@ class Player(pygame.sprite.Sprite):
         This is also where gravity is added
         Keeps track of how long player is falling, in order to increase velocity
         i.e. how quickly we should be accelerating downwards
+        fps: the ticks a second the player is stepped at. The speeds are
+        written for FPS ticks a second, so at another rate a tick moves the
+        player FPS / fps times as far and speeds it up (FPS / fps)**2 as much
         '''
-        self.y_vel += min(1, (self.fall_count / fps) * self.GRAVITY) # gravity fall rate
-        # update character based on x and y velocity
-        self.move(self.x_vel, self.y_vel)
+        scale = FPS / fps
+        self.y_vel += min(1, (self.fall_count / fps) * self.GRAVITY) * scale * scale # gravity fall rate
+        # update character based on x velocity. The vertical move is swept against
+        # the map by handle_vertical_collision, so the player can't fall through blocks
+        self.move(self.x_vel, 0)
 
         if self.hit:
             self.hit_count += 1
@@ -92,7 +107,7 @@ class Player(pygame.sprite.Sprite):
             self.hit_count = 0
 
         self.fall_count += 1
-        self.update_sprite()
+        self.update_sprite(fps)
 
     def landed(self):
         self.fall_count = 0
@@ -115,7 +130,7 @@ class Player(pygame.sprite.Sprite):
         self.fall_count = 0
         self.jump_count = 0
 
-    def update_sprite(self):
+    def update_sprite(self, fps=FPS):
         sprite_sheet = "idle"
 
         if self.hit:
@@ -129,16 +144,18 @@ class Player(pygame.sprite.Sprite):
             elif self.jump_count == 2:
                 sprite_sheet = "double_jump"
 
-        elif self.y_vel > self.GRAVITY * 2: # self.GRAVITY * 2 prevents glitching due to always falling even when stationary
+        elif self.y_vel > self.GRAVITY * 2 * FPS / fps: # self.GRAVITY * 2 prevents glitching due to always falling even when stationary
             sprite_sheet = "fall"
         elif self.x_vel != 0:   # if sprite has some velocity in the x_direction, then it is running
             sprite_sheet = "run"
 
         # the following few lines of code are for animating the sprite to give it a dynamic feel even while stationary
         sprite_sheet_name = sprite_sheet + "_" + self.direction
-        sprites = self.SPRITES[sprite_sheet_name]
-        sprite_index = (self.animation_count // self.ANIMATION_DELAY) % len(sprites)
-        self.sprite = sprites[sprite_index]
+        sprites = self.load_sprites()[sprite_sheet_name]
+        # the animation keeps its speed at any tick rate
+        sprite_index = (self.animation_count * FPS // fps // self.ANIMATION_DELAY) % len(sprites)
+        self.frame = sprites[sprite_index]
+        self.sprite = self.frame.image
         self.animation_count += 1
         # Now we want to animate the sprite, to do this we need to define a new variable
         self.update()
@@ -146,29 +163,36 @@ class Player(pygame.sprite.Sprite):
     def update(self):
 
         ''' This method updates the player object and casts it onto the pygame mask object'''
-        self.rect = self.sprite.get_rect(topleft=(self.rect.x, self.rect.y))
-        # sprites inherit the mask property
-        self.mask = pygame.mask.from_surface(self.sprite)
+        self.rect.size = self.frame.rect.size
+        # the mask is precomputed with the frame, so we only need to point at it
+        self.mask = self.frame.mask
 
-    def draw(self, win, offset_x):
+    def draw(self, win, offset_x, position=None):
         ''' This method draws the player and the health bar
+        Returns the screen area covered, so the renderer knows what changed
+        position: where to draw the player instead of its rect, e.g. between two ticks
         '''
+        x, y = position if position is not None else self.rect.topleft
 
         # This draws the player
-        win.blit(self.sprite, (self.rect.x - offset_x, self.rect.y))
+        drawn = win.blit(self.sprite, (x - offset_x, y))
 
         # Draw the health bar background (red)
-        health_bar_bg_rect = pygame.Rect(self.rect.x - offset_x, self.rect.y - 20, self.rect.width, 5)
+        health_bar_bg_rect = pygame.Rect(x - offset_x, y - 20, self.rect.width, 5)
         pygame.draw.rect(win, (255, 0, 0), health_bar_bg_rect)
 
         # Draw the current health bar (green)
         current_health_width = (self.current_health / self.max_health) * self.rect.width
-        health_bar_rect = pygame.Rect(self.rect.x - offset_x, self.rect.y - 20, current_health_width, 5)
+        health_bar_rect = pygame.Rect(x - offset_x, y - 20, current_health_width, 5)
         pygame.draw.rect(win, (0, 255, 0), health_bar_rect)
 
         # Render the health text
+        if self.font is None:
+            self.font = pygame.font.Font(None, 24)
         health_text = self.font.render(f"{self.current_health}/{self.max_health}", True, (0, 0, 0))
-        win.blit(health_text, (self.rect.x - offset_x, self.rect.y - 35))  # Position above the player
+        text_rect = win.blit(health_text, (x - offset_x, y - 35))  # Position above the player
+
+        return drawn.union(health_bar_bg_rect).union(text_rect)
 
 
 
@@ -177,40 +201,54 @@ class Object(pygame.sprite.Sprite):
     '''This class defines a generic sprite object.
     We create a rectangle. We have an image
     '''
-    def __init__(self, x, y, width, height, name=None):
+    # animated objects are redrawn every frame, the others only when the screen scrolls
+    ANIMATED = False
+    # static tiles never change, so the renderer bakes them into chunk surfaces
+    STATIC_TILE = False
+    # the index of the entity in the level file the object was streamed from, if any
+    entity_id = None
+
+    def __init__(self, x, y, width, height, name=None, image=None):
         super().__init__()
         self.rect = pygame.Rect(x, y, width, height)
-        self.image = pygame.Surface((width, height), pygame.SRCALPHA)
+        # objects with a shared image from the asset cache skip the private surface
+        self.image = image if image is not None else pygame.Surface((width, height), pygame.SRCALPHA)
         self.width = width
         self.height = height
         self.name = name
     
     def draw(self, win, offset_x):
-        win.blit(self.image, (self.rect.x - offset_x, self.rect.y))
+        ''' Draws the object and returns the screen area it covered'''
+        return win.blit(self.image, (self.rect.x - offset_x, self.rect.y))
 
 
 class Block(Object):
     ''' This creates a child class of Object which will be the blocks
     of the map of our game
     '''
+    STATIC_TILE = True
+
     def __init__(self, x, y, size):
-        super().__init__(x, y, size, size)
+        # every block of the same size shares one surface and one mask
         block = get_block(size)
-        self.image.blit(block, (0,0))
-        self.mask = pygame.mask.from_surface(self.image)
+        super().__init__(x, y, size, size, image=block.image)
+        self.mask = block.mask
 
 class Fire(Object):
 
     ANIMATION_DELAY = 3
+    ANIMATED = True
 
     def __init__(self, x, y, width, height):
         super().__init__(x, y, width, height, "fire")
         self.fire = load_sprite_sheets("Traps", "Fire", width, height)
-        print(self.fire)
-        self.image = self.fire["off"][0]
-        self.mask = pygame.mask.from_surface(self.image)
+        self.image = self.fire["off"][0].image
+        self.mask = self.fire["off"][0].mask
         self.animation_count = 0
         self.animation_name = "off"
+        # the (animation, index) of the frame on show. None until the first
+        # frame is shown, which also sizes the rect to the frame
+        self.frame_key = None
 
     def on(self):
         self.animation_name = "on" # the fire pngs are named "hit", "on", "off" etc.
@@ -218,34 +256,45 @@ class Fire(Object):
     def off(self):
         self.animation_name = "off"
 
+    def period(self):
+        ''' The number of ticks before the current animation starts over'''
+        # loop() shows every frame ANIMATION_DELAY times, then the first one
+        # once more before it resets the count
+        return self.ANIMATION_DELAY * (len(self.fire[self.animation_name]) + 1)
+
+    def show(self, count):
+        ''' Shows the frame the animation is at after count ticks. The image,
+        rect and mask are only swapped when that frame is not already on show'''
+        sprites = self.fire[self.animation_name]
+        sprite_index = (count // self.ANIMATION_DELAY) % len(sprites)
+        if (self.animation_name, sprite_index) != self.frame_key:
+            frame = sprites[sprite_index]
+            self.image = frame.image
+            # instead of defining an update method here, we just copy paste
+            # the update method in the Player Class. Update rectangle and mask
+            self.rect.size = frame.rect.size
+            # the frame carries its precomputed mask
+            self.mask = frame.mask
+            self.frame_key = (self.animation_name, sprite_index)
+
     def loop(self):
         # Get the sprite sheets. But instead of trying to get sprite sheets
         # but instead of getting sprite sheets, we get the animation name
-        sprites = self.fire[self.animation_name]
-        sprite_index = (self.animation_count // 
-                        self.ANIMATION_DELAY) % len(sprites)
-        self.image = sprites[sprite_index]
+        self.show(self.animation_count)
         self.animation_count += 1
 
-        # instead of defining an update method here, we just copy paste
-        # the update method in the Player Class. Update rectangle and mask
-        self.rect = self.image.get_rect(topleft=(self.rect.x, self.rect.y))
-        # sprites inherit the mask property
-        self.mask = pygame.mask.from_surface(self.image)
-
         # Here is some code to prevent the animation count from getting too large
-
-        if self.animation_count // self.ANIMATION_DELAY > len(sprites):
+        if self.animation_count >= self.period():
             self.animation_count = 0
 
 class Flag(Object):
     """A class representing the Flag that ends the game in victory."""
 
     def __init__(self, x, y, width, height):
-        super().__init__(x, y, width, height, "flag")
-        # Load the flag image
+        # Load the flag image, resized to fit dimensions. The asset cache
+        # hands out the same surface and collision mask to every flag
         flag_image_path = join("assets", "Items", "Checkpoints", "flag.png")
-        self.image = pygame.image.load(flag_image_path).convert_alpha()
-        self.image = pygame.transform.scale(self.image, (width, height))  # Resize to fit dimensions
-        self.mask = pygame.mask.from_surface(self.image)  # Create a mask for collision detection
+        flag = ASSETS.frame(flag_image_path, scale=(width, height))
+        super().__init__(x, y, width, height, "flag", image=flag.image)
+        self.mask = flag.mask
         
@@ -0,0 +1,183 @@
+'''Thin client for server.py.
+
+Sends the keyboard to the server and draws the players it sends back with
+the game's own Renderer; the client runs no game rules of its own. The map
+is loaded from the same level file the server hosts (the server sends its
+path), streamed around the client's own player like in the single player
+game, and the traps are animated from the server's tick. Example:
+
+    python client.py --host 127.0.0.1 --port 7777
+
+With --bots N it instead connects N headless clients that play scripted
+inputs, to load test a server:
+
+    python client.py --port 7777 --bots 100 --seconds 30
+'''
+import argparse
+import asyncio
+import time
+
+import pygame
+
+from utils import WIDTH, HEIGHT, compose_background, init_headless
+from classes import Player
+from world import Input, scripted_inputs
+from levels import load_world
+from render import Renderer
+from snapshot import player_frame_table
+import netcode
+
+
+# the camera keeps the own player at least this far from the edges of the window
+SCROLL_AREA_WIDTH = 200
+
+
+def apply_state(player, state, frames):
+    ''' Puts a netcode.PlayerState on a Player, for drawing'''
+    player.frame = frames[state.frame]
+    player.sprite = player.frame.image
+    player.rect.update(state.x, state.y, *player.frame.rect.size)
+    player.current_health = state.health
+    player.hit = bool(state.flags & netcode.HIT)
+
+
+async def play(window, host, port):
+    ''' Plays on a server until the window is closed or the server goes away'''
+    reader, writer = await asyncio.open_connection(host, port)
+    player_id, tick_rate, path = netcode.decode_welcome(await netcode.read_message(reader))
+    pygame.display.set_caption(f"Jump Quest Reloaded - player {player_id}")
+
+    world = load_world(path, fps=tick_rate)  # streams the map around the own player
+    frames = player_frame_table()
+    renderer = Renderer(window, compose_background("Brown.png"))
+    players = {}  # player id -> Player drawn for it
+    states = {}   # player id -> netcode.PlayerState, as the snapshots left it
+    tick = 0
+    won = False
+
+    async def receive():
+        nonlocal tick
+        while True:
+            data = await netcode.read_message(reader)
+            if data[0] == netcode.SNAPSHOT:
+                tick = netcode.decode_snapshot(data, states)
+
+    offset_x = 0
+    frame = 0     # counts the frames, sent along with the keys
+    sent = None   # the keys last sent
+    jump = False
+    run = True
+    receiver = asyncio.create_task(receive())
+    try:
+        while run and not receiver.done():
+            started = time.perf_counter()
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    run = False
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                    jump = True
+
+            # only send the keys when they change, the server keeps the held ones
+            keys = pygame.key.get_pressed()
+            inputs = Input(keys[pygame.K_LEFT], keys[pygame.K_RIGHT], jump)
+            if inputs != sent:
+                writer.write(netcode.encode_input(frame, inputs))
+                sent = inputs
+            jump = False
+            frame += 1
+
+            for gone in set(players) - set(states):
+                del players[gone]
+            for other_id, state in states.items():
+                if other_id not in players:
+                    players[other_id] = Player(state.x, state.y, 50, 50)
+                apply_state(players[other_id], state, frames)
+
+            player = players.get(player_id)
+            if player is not None:
+                if states[player_id].flags & netcode.WON and not won:
+                    won = True
+                    pygame.display.set_caption(f"Jump Quest Reloaded - player {player_id} reached the flag!")
+                offset_x = min(offset_x, player.rect.left - SCROLL_AREA_WIDTH)
+                offset_x = max(offset_x, player.rect.right - WIDTH + SCROLL_AREA_WIDTH)
+                if world.level.update(*player.rect.center):
+                    renderer.invalidate()
+                world.traps.view = pygame.Rect(offset_x, 0, WIDTH, HEIGHT)
+                # a snapshot carries the arena's tick after the step, the traps
+                # were animated from the one before it
+                world.traps.update(tick - 1, player, world.objects, world.fps)
+                others = [other for other_id, other in players.items() if other_id != player_id]
+                renderer.draw(player, world.objects, offset_x, others=others)
+
+            await asyncio.sleep(max(0.0, 1 / tick_rate - (time.perf_counter() - started)))
+
+        if receiver.done():
+            receiver.result()  # raises whatever ended the connection
+    finally:
+        receiver.cancel()
+        writer.close()
+
+
+async def bot(host, port, seconds, seed):
+    '''A headless client that plays scripted inputs for a number of seconds.
+    It only counts the snapshots: decoding a hundred players' worth of them
+    for a hundred bots would take more CPU than the server being tested.
+    Returns (snapshots received, bytes received)'''
+    reader, writer = await asyncio.open_connection(host, port)
+    _, tick_rate, _ = netcode.decode_welcome(await netcode.read_message(reader))
+    received = [0, 0]
+
+    async def receive():
+        while True:
+            data = await netcode.read_message(reader)
+            received[0] += 1
+            received[1] += len(data) + netcode.LENGTH.size
+
+    receiver = asyncio.create_task(receive())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    sent = None
+    for frame, inputs in enumerate(scripted_inputs(int(seconds * tick_rate), seed)):
+        if inputs != sent:
+            writer.write(netcode.encode_input(frame, inputs))
+            sent = inputs
+        deadline += 1 / tick_rate
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+    receiver.cancel()
+    writer.close()
+    return received
+
+
+async def run_bots(host, port, count, seconds):
+    results = await asyncio.gather(*(bot(host, port, seconds, seed) for seed in range(count)))
+    snapshots = sum(result[0] for result in results)
+    received = sum(result[1] for result in results)
+    print(f"{count} bots: {snapshots / count / seconds:.1f} snapshots a second each, "
+          f"{received / count / seconds / 1024:.1f} KiB/s each")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--bots", type=int, default=0, help="connect this many scripted headless clients instead")
+    parser.add_argument("--seconds", type=float, default=30, help="how long the bots play")
+    args = parser.parse_args()
+
+    if args.bots:
+        init_headless()
+        asyncio.run(run_bots(args.host, args.port, args.bots, args.seconds))
+        return
+
+    pygame.init()
+    pygame.display.set_caption("Jump Quest Reloaded")
+    window = pygame.display.set_mode((WIDTH, HEIGHT))
+    try:
+        asyncio.run(play(window, args.host, args.port))
+    except (ConnectionError, asyncio.IncompleteReadError):
+        print("lost the connection to the server")
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
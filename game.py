@@ -2,6 +2,8 @@
 import os
 import random
 import math
+import threading
+import time
 import pygame
 
 # the os modules are used to dynamically up sprite sheets
@@ -11,17 +13,18 @@ from os.path import isfile, join
 
 # import helper functions
 
-from utils import flip, get_background, draw, handle_vertical_collision, handle_move, collide, show_victory_screen
+from utils import flip, compose_background, handle_vertical_collision, handle_move, collide, show_victory_screen, load_sprite_sheets, get_block
 
 from classes import Player, Object, Block, Fire, Flag
+from world import Input
+from levels import DEFAULT_LEVEL, load_world
+from render import Renderer
+from scaling import ResolutionScaler
+from profiler import FrameProfiler, NULL_PROFILER
+from recorder import Recorder
+from bundle import use_bundle
 
 
-# initializes pygame module
-pygame.init()
-
-# sets the caption at the top of the window
-pygame.display.set_caption("Jump Quest Reloaded")
-
 ## global variables are already defined in 
 ## utils.py. They are printed here again to enhance code comprehension
 BG_COLOUR = (255, 255, 255)
@@ -31,58 +34,131 @@ WIDTH, HEIGHT = 1000, 800
 FPS = 60
 # player movespeed, defined in pixels per second
 PLAYER_VEL = 5
-
-# creates the game window using pygame module
-window = pygame.display.set_mode((WIDTH, HEIGHT))
-
-
-def main(window):
+# the highest frame rate the screen is drawn at
+RENDER_FPS = 120
+# the most simulation ticks run for one drawn frame before the backlog is dropped
+MAX_TICKS_PER_FRAME = 5
+# a player that moved further than this in one tick teleported, and is not interpolated
+INTERPOLATE_LIMIT = 100
+# the time a frame may take before the resolution is lowered, and the range of
+# render scales it may use (1 is the window's own resolution)
+FRAME_BUDGET_MS = 1000 / FPS
+MIN_SCALE = 0.5
+MAX_SCALE = 1.0
+
+MUSIC = join("assets", "Music", "whittingham_asturias.wav")
+
+
+def prefetch_assets(loaded):
+    ''' Decodes the music and the sprites the first frame needs.
+    This runs on a background thread while main() shows the loading screen,
+    and sets loaded["music"] to whether the music could be loaded.
+    The sprites come from the prebuilt asset bundle when it is up to date.
+    '''
+    use_bundle()
+    try:
+        pygame.mixer.music.load(MUSIC)
+        loaded["music"] = True
+    except pygame.error as error:
+        # the game is still playable without its music
+        print(f"Could not load the music: {error}")
+        loaded["music"] = False
+
+    Player.load_sprites()
+    load_sprite_sheets("Traps", "Fire", 16, 32)
+    get_block(96)
+
+
+def show_loading_screen(window, clock, loader):
+    ''' Keeps the window responsive until the loader thread is done.
+    Returns False if the player closed the window meanwhile'''
+    font = pygame.font.Font(None, 48)
+    text = font.render("Loading...", True, (255, 255, 255))
+    while loader.is_alive():
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+        window.fill((0, 0, 0))
+        window.blit(text, (WIDTH // 2 - text.get_width() // 2, HEIGHT // 2 - text.get_height() // 2))
+        pygame.display.update()
+        clock.tick(30)
+    return True
+
+
+def main(window, started=None):
+    ''' Runs the game in the given window.
+    started: perf_counter() time the program started, to report the time to the first frame
+    '''
+    if started is None:
+        started = time.perf_counter()
     ## Load main variables
     # create game clock that will tick
     clock = pygame.time.Clock()
-
-    # load music
-    pygame.mixer.music.load("assets/Music/whittingham_asturias.wav")
-    # start the music. The -1 parameter loops the music continuously until game ends
-    pygame.mixer.music.play(-1)
-    # create background
-    background, bg_image = get_background("Brown.png")
-    # define the block size in pixels of game objects incl. tiles
-    block_size = 96
-    # create player
-    player = Player(100, 100, 50, 50) # pass in x, y, width and height
-
-    # create fire
-    fire = Fire(200, HEIGHT - block_size - 64, 16, 32) # change from 100 to 200
-    fire.on()
-
-    ## Make the map, which is represented as a list of items 
-    ##  We make the floor first before adding it as an object
-    ## to a list of other objects
-    # make the floor
-  
-    floor = [Block(i * block_size, HEIGHT - block_size, block_size) 
-             for i in range(-WIDTH // block_size, WIDTH * 2 // block_size)]
-    
-    # make the flag
-    
-    flag = Flag(block_size * 3, HEIGHT - block_size * 7 - 64, 32, 64)  # Position the flag at (700, ground level - height)
-
-    # the * breaks down floor into its individual elements and passes them inside the of objects
-    objects = [*floor, Block(0, HEIGHT - block_size * 2, block_size),
-               Block(block_size*3, HEIGHT - block_size * 4, block_size), 
-               fire,
-               Block(0, HEIGHT - block_size * 6, block_size),
-               Block(block_size*3, HEIGHT - block_size * 7, block_size),
-               flag]
+    # set JQ_PROFILE=frames.csv (or .json) to time every phase of the frame.
+    # The stats are written there on exit and F3 shows them on screen
+    profile_path = os.environ.get("JQ_PROFILE")
+    profiler = FrameProfiler() if profile_path else NULL_PROFILER
+
+    # load the music and sprites in the background while the loading screen shows
+    loaded = {}
+    loader = threading.Thread(target=prefetch_assets, args=(loaded,), daemon=True)
+    loader.start()
+    if not show_loading_screen(window, clock, loader):
+        pygame.quit()
+        quit()
+    profiler.startup["assets_ms"] = (time.perf_counter() - started) * 1000
+
+    if loaded["music"]:
+        # start the music. The -1 parameter loops the music continuously until game ends
+        pygame.mixer.music.play(-1)
+    # create background, composed once into a single surface
+    background = compose_background("Brown.png")
+    # the renderer only redraws the parts of the screen that changed
+    renderer = Renderer(window, background)
+    # lowers the render resolution while frames run over budget, see scaling.py
+    try:
+        scaler = ResolutionScaler(FRAME_BUDGET_MS, float(os.environ.get("JQ_MIN_SCALE", MIN_SCALE)),
+                                  float(os.environ.get("JQ_MAX_SCALE", MAX_SCALE)))
+    except ValueError as error:
+        raise SystemExit(f"JQ_MIN_SCALE and JQ_MAX_SCALE have to be multiples of 1/8: {error}")
+    if scaler.scale != 1:
+        renderer.set_scale(scaler.scale)
+    # build the map. The world holds the player, the objects and the game rules,
+    # this loop only feeds it the keyboard and draws the result. It is stepped
+    # JQ_SIM_RATE times a second, and scales its rules to keep the game's speed
+    sim_rate = int(os.environ.get("JQ_SIM_RATE", FPS))
+    world = load_world(DEFAULT_LEVEL, fps=sim_rate)
+    player = world.player
+    world.profiler = renderer.profiler = profiler
     # define parameters for scrolling window
     offset_x = 0
     scroll_area_width = 200
+    first_frame = True
+
+    # the simulation runs on a fixed timestep, however long drawing takes. The
+    # frame loop adds the real time that passed to the accumulator and runs as
+    # many ticks as fit in it, then draws the player interpolated between the
+    # last two ticks
+    render_fps = int(os.environ.get("JQ_RENDER_FPS", RENDER_FPS))
+    tick_seconds = 1 / sim_rate
+    accumulator = tick_seconds  # the first frame runs a tick, so the player has a sprite to draw
+    # set JQ_RECORD=session.jqr to record the inputs and events of the session
+    # for replays and analytics, see recorder.py. It writes from a thread of its own
+    record_path = os.environ.get("JQ_RECORD")
+    if record_path:
+        world.recorder = Recorder(record_path, DEFAULT_LEVEL, world.fps)
+    last_time = time.perf_counter()
+    previous = (player.rect.topleft, offset_x)  # the player and camera before the last tick
+    jump = False  # a jump pressed between ticks is held until the next tick uses it
 
     # create a boolean variable to determine whether game has ended
     run = True
     while run:
-        clock.tick(FPS)  # ensure the while loop runs 60 times per second
+        clock.tick(render_fps)  # caps the drawing rate, the simulation keeps its own
+        profiler.start_frame()
+        now = time.perf_counter()
+        accumulator += now - last_time
+        last_time = now
 
         for event in pygame.event.get():
             # first event to check is if user has quit
@@ -91,31 +167,82 @@ def main(window):
                 break
 
             if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_SPACE and player.jump_count < 2:
-                    player.jump()
-        # call the player loop function. This is the one that actually moves the player
-        # every single frame.
-        player.loop(FPS)
-
-        # animates the fire. No need for FPS
-        fire.loop()
-        # handle the move *before* drawing the map
-        handle_move(player, objects) 
-        # draws the background
-        draw(window, background, bg_image, player, objects, offset_x) # don't forget to add player in draw function
-
-        # checking both to the left and to the right, for correct offsetting
-        if (player.rect.right - offset_x >= WIDTH - scroll_area_width and player.x_vel > 0) or (
-            (player.rect.left - offset_x <= scroll_area_width) and player.x_vel <0):
-            offset_x += player.x_vel
-
-        # Reset the player when health reaches zero
-        if player.current_health <= 0:
-            player.reset_to_spawn()
+                if event.key == pygame.K_SPACE:
+                    jump = True
+                elif event.key == pygame.K_F3 and profiler.enabled:
+                    profiler.overlay = not profiler.overlay
+
+        profiler.mark("events")
+        map_changed = False
+        ticks = 0
+        while run and accumulator >= tick_seconds:
+            if ticks == MAX_TICKS_PER_FRAME:
+                # the machine can't keep up. Drop the backlog instead of running
+                # ever more ticks per frame, which would only make frames longer
+                accumulator = 0.0
+                break
+            keys = pygame.key.get_pressed()
+            previous = (player.rect.topleft, offset_x)
+            # the traps on screen keep animating, the ones out of sight sleep
+            world.traps.view = pygame.Rect(offset_x, 0, WIDTH, HEIGHT)
+            # step the world. This is the one that actually moves the player
+            world.step(Input(keys[pygame.K_LEFT], keys[pygame.K_RIGHT], jump))
+            jump = False
+            map_changed = map_changed or world.map_changed
+            if world.won: # Victory Condition
+                show_victory_screen()
+                run = False
+                break
 
+            # checking both to the left and to the right, for correct offsetting
+            if (player.rect.right - offset_x >= WIDTH - scroll_area_width and player.x_vel > 0) or (
+                (player.rect.left - offset_x <= scroll_area_width) and player.x_vel <0):
+                offset_x += player.x_vel
+            accumulator -= tick_seconds
+            ticks += 1
+        if not run:
+            break
+
+        # chunks were streamed in or out, so the baked map has to be redrawn
+        if map_changed:
+            renderer.invalidate()
+        # how far the clock is between the last tick and the next one
+        alpha = accumulator / tick_seconds
+        (previous_x, previous_y), previous_offset = previous
+        if abs(player.rect.x - previous_x) + abs(player.rect.y - previous_y) > INTERPOLATE_LIMIT:
+            alpha = 1.0  # the player respawned, don't slide it across the map
+        position = (round(previous_x + (player.rect.x - previous_x) * alpha),
+                    round(previous_y + (player.rect.y - previous_y) * alpha))
+        draw_offset = round(previous_offset + (offset_x - previous_offset) * alpha)
+        # draws the background
+        renderer.draw(player, world.objects, draw_offset, position) # don't forget to add player in draw function
+        profiler.end_frame()
+        # the time this frame took, without the wait in clock.tick
+        if scaler.update((time.perf_counter() - now) * 1000):
+            renderer.set_scale(scaler.scale)
+
+        if first_frame:
+            first_frame = False
+            profiler.startup["first_frame_ms"] = (time.perf_counter() - started) * 1000
+            if profiler.enabled:
+                print(f"First frame after {profiler.startup['first_frame_ms']:.0f} ms")
+
+    if profile_path:
+        profiler.dump(profile_path)
+    if world.recorder is not None:
+        world.recorder.close(world)
     pygame.quit()  # quits the pygame game
     quit()  # ends the actual python program
 
 
 if __name__ == "__main__":
-    main(window)
+    started = time.perf_counter()
+    # initializes pygame module
+    pygame.init()
+
+    # sets the caption at the top of the window
+    pygame.display.set_caption("Jump Quest Reloaded")
+
+    # creates the game window using pygame module
+    window = pygame.display.set_mode((WIDTH, HEIGHT))
+    main(window, started)
@@ -0,0 +1,287 @@
+import mmap
+import struct
+from os.path import join
+
+from utils import FPS
+from classes import Fire, Flag, Player
+from world import World
+
+
+## The .jql level format
+# A fixed header, then the tile grid stored chunk by chunk (so one chunk is a
+# single contiguous slice of the file), then a table with the index of the
+# first entity of every chunk, then the entities sorted by chunk.
+#
+#   header   magic, version, tile size, chunk size in tiles, grid origin in
+#            pixels, grid size in tiles, player spawn, entity count
+#   grid     one byte tile id per cell, chunk after chunk in row-major order,
+#            each chunk itself row-major. Cells past the edge of the grid are 0
+#   offsets  (number of chunks + 1) little-endian uint32
+#   entities one record per Fire/Flag: type, flags, x, y, width, height
+MAGIC = b"JQLV"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHiiIIiiI")
+ENTITY = struct.Struct("<BBiiHH")
+
+# tile ids in the grid
+EMPTY = 0
+TERRAIN = 1
+
+# entity types
+FIRE = 1
+FLAG = 2
+# entity flags
+FIRE_ON = 1
+
+DEFAULT_LEVEL = join("levels", "default.jql")
+
+
+class LevelWriter:
+    '''Writes a level file a few rows at a time.
+
+    The grid is given row by row, top to bottom, with write_rows(), and is
+    written out every time a full band of chunk_tiles rows is in, so a level
+    of any size can be written without holding its grid in memory. Entities
+    can be added in any order with add_entity(); they are kept packed, per
+    chunk, until close() writes them after the grid.
+
+    columns, rows: size of the grid in tiles
+    origin: pixel position of the top left cell of the grid
+    spawn: pixel position where the player starts
+    '''
+
+    def __init__(self, path, columns, rows, tile_size, origin, spawn, chunk_tiles=8):
+        self.columns = columns
+        self.rows = rows
+        self.tile_size = tile_size
+        self.origin = origin
+        self.spawn = spawn
+        self.chunk_tiles = chunk_tiles
+        self.chunk_columns = -(-columns // chunk_tiles)
+        self.chunk_rows = -(-rows // chunk_tiles)
+        self.band = []      # rows of the band being filled
+        self.written = 0    # rows written so far
+        self.entities = {}  # chunk index -> packed ENTITY records
+        self.entity_count = 0
+        self.file = open(path, "wb")
+        # the entity count is only known at the end, close() writes the header again
+        self.file.write(self.header())
+
+    def header(self):
+        return HEADER.pack(MAGIC, VERSION, self.tile_size, self.chunk_tiles, self.origin[0], self.origin[1],
+                           self.columns, self.rows, self.spawn[0], self.spawn[1], self.entity_count)
+
+    def chunk_of(self, x, y):
+        column = (x - self.origin[0]) // self.tile_size // self.chunk_tiles
+        row = (y - self.origin[1]) // self.tile_size // self.chunk_tiles
+        # entities outside the grid are kept with the nearest chunk
+        column = min(max(column, 0), self.chunk_columns - 1)
+        row = min(max(row, 0), self.chunk_rows - 1)
+        return row * self.chunk_columns + column
+
+    def add_entity(self, kind, flags, x, y, width, height):
+        chunk = self.entities.setdefault(self.chunk_of(x, y), bytearray())
+        chunk += ENTITY.pack(kind, flags, x, y, width, height)
+        self.entity_count += 1
+
+    def write_rows(self, rows):
+        ''' Adds grid rows of tile ids, the next ones down'''
+        for row in rows:
+            if self.written + len(self.band) >= self.rows:
+                raise ValueError(f"the grid only has {self.rows} rows")
+            self.band.append(bytes(row))
+            if len(self.band) == self.chunk_tiles:
+                self.write_band()
+
+    def write_band(self):
+        size = self.chunk_tiles
+        for chunk_column in range(self.chunk_columns):
+            start = chunk_column * size
+            chunk = bytearray(size * size)
+            for y, row in enumerate(self.band):
+                cells = row[start:start + size]
+                chunk[y * size:y * size + len(cells)] = cells
+            self.file.write(chunk)
+        self.written += len(self.band)
+        self.band = []
+
+    def close(self):
+        ''' Writes what is left: missing rows are empty, then the entities'''
+        self.write_rows([b""] * (self.rows - self.written - len(self.band)))
+        if self.band:
+            self.write_band()
+        chunks = self.chunk_columns * self.chunk_rows
+        offsets = [0] * (chunks + 1)
+        for i in range(chunks):
+            offsets[i + 1] = offsets[i] + len(self.entities.get(i, b"")) // ENTITY.size
+        self.file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        for i in sorted(self.entities):
+            self.file.write(self.entities[i])
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+
+def save_level(path, grid, entities, tile_size, origin, spawn, chunk_tiles=8):
+    '''Writes a level file.
+
+    grid: list of rows of tile ids, row 0 at the top
+    entities: (type, flags, x, y, width, height) tuples, positions in pixels
+    origin: pixel position of the top left cell of the grid
+    spawn: pixel position where the player starts
+    '''
+    columns = max((len(row) for row in grid), default=0)
+    writer = LevelWriter(path, columns, len(grid), tile_size, origin, spawn, chunk_tiles)
+    for entity in entities:
+        writer.add_entity(*entity)
+    writer.write_rows(grid)
+    writer.close()
+
+
+def export_world(world, path, chunk_tiles=8):
+    ''' Saves the Blocks, Fires and Flags of a World built in code to a level file'''
+    blocks = [obj for obj in world.objects if obj.STATIC_TILE]
+    tile_size = blocks[0].rect.width
+    left = min(block.rect.x for block in blocks)
+    top = min(block.rect.y for block in blocks)
+    columns = (max(block.rect.x for block in blocks) - left) // tile_size + 1
+    rows = (max(block.rect.y for block in blocks) - top) // tile_size + 1
+
+    grid = [[EMPTY] * columns for _ in range(rows)]
+    for block in blocks:
+        grid[(block.rect.y - top) // tile_size][(block.rect.x - left) // tile_size] = TERRAIN
+
+    entities = []
+    for obj in world.objects:
+        if isinstance(obj, Fire):
+            flags = FIRE_ON if obj.animation_name == "on" else 0
+            entities.append((FIRE, flags, obj.rect.x, obj.rect.y, obj.width, obj.height))
+        elif isinstance(obj, Flag):
+            entities.append((FLAG, 0, obj.rect.x, obj.rect.y, obj.width, obj.height))
+
+    spawn = (world.player.spawn_x, world.player.spawn_y)
+    save_level(path, grid, entities, tile_size, (left, top), spawn, chunk_tiles)
+
+
+class LevelStream:
+    '''Streams a level file into a World one chunk at a time.
+
+    The file is memory-mapped, so opening even a huge level costs almost
+    nothing. update() materializes the tiles, Fires and Flags of the chunks
+    within radius chunks of a point and retires the chunks that fell out of
+    range, keeping the World's spatial hash and trap list in step. The tiles
+    go straight into the hash's TileStore, no Block is ever created for them.
+    '''
+
+    def __init__(self, path, radius=2):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.tile_size, self.chunk_tiles, origin_x, origin_y,
+         self.columns, self.rows, spawn_x, spawn_y, self.entity_count) = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} level file")
+
+        self.origin = (origin_x, origin_y)
+        self.spawn = (spawn_x, spawn_y)
+        self.radius = radius
+        self.chunk_pixels = self.tile_size * self.chunk_tiles
+        self.chunk_columns = -(-self.columns // self.chunk_tiles)
+        self.chunk_rows = -(-self.rows // self.chunk_tiles)
+        self.grid_start = HEADER.size
+        self.offsets_start = self.grid_start + self.chunk_columns * self.chunk_rows * self.chunk_tiles ** 2
+        self.entities_start = self.offsets_start + (self.chunk_columns * self.chunk_rows + 1) * 4
+        self.loaded = {}   # (column, row) -> objects created for that chunk
+        self.center = None # the chunk update() was last called from
+        self.world = None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def chunk_at(self, x, y):
+        ''' Returns the (column, row) of the chunk containing a pixel position'''
+        return ((x - self.origin[0]) // self.chunk_pixels, (y - self.origin[1]) // self.chunk_pixels)
+
+    def tile_positions(self, column, row):
+        ''' Returns the pixel positions of the terrain tiles of one chunk'''
+        size = self.chunk_tiles
+        start = self.grid_start + (row * self.chunk_columns + column) * size * size
+        cells = self.data[start:start + size * size]
+        left = self.origin[0] + column * self.chunk_pixels
+        top = self.origin[1] + row * self.chunk_pixels
+        return [(left + i % size * self.tile_size, top + i // size * self.tile_size)
+                for i, tile in enumerate(cells) if tile == TERRAIN]
+
+    def create_chunk(self, column, row):
+        ''' Instantiates the Fires and Flags of one chunk'''
+        objects = []
+        index = row * self.chunk_columns + column
+        first, last = struct.unpack_from("<2I", self.data, self.offsets_start + index * 4)
+        for i in range(first, last):
+            kind, flags, x, y, width, height = ENTITY.unpack_from(self.data, self.entities_start + i * ENTITY.size)
+            if kind == FIRE:
+                obj = Fire(x, y, width, height)
+                if flags & FIRE_ON:
+                    obj.on()
+            elif kind == FLAG:
+                obj = Flag(x, y, width, height)
+            else:
+                continue
+            # the same entity gets a new object every time its chunk loads
+            obj.entity_id = i
+            objects.append(obj)
+        return objects
+
+    def update(self, x, y):
+        ''' Loads the chunks around a pixel position and retires the far ones.
+        Returns True when the set of loaded objects changed'''
+        column, row = self.chunk_at(x, y)
+        if (column, row) == self.center:
+            return False
+        self.center = (column, row)
+        wanted = {(c, r)
+                  for c in range(max(column - self.radius, 0), min(column + self.radius + 1, self.chunk_columns))
+                  for r in range(max(row - self.radius, 0), min(row + self.radius + 1, self.chunk_rows))}
+        changed = False
+
+        tiles = self.world.objects.tiles
+        for key in list(self.loaded):
+            if key not in wanted:
+                for x, y in self.tile_positions(*key):
+                    tiles.remove(x, y)
+                for obj in self.loaded.pop(key):
+                    self.world.objects.remove(obj)
+                    if obj.ANIMATED:
+                        self.world.traps.remove(obj)
+                changed = True
+
+        for key in wanted:
+            if key not in self.loaded:
+                for x, y in self.tile_positions(*key):
+                    tiles.add(x, y)
+                objects = self.loaded[key] = self.create_chunk(*key)
+                for obj in objects:
+                    self.world.objects.add(obj)
+                    if obj.ANIMATED:
+                        self.world.traps.append(obj)
+                changed = True
+
+        return changed
+
+
+def load_world(path=DEFAULT_LEVEL, radius=2, fps=FPS):
+    ''' Opens a level file and returns a World that streams its chunks around
+    the player, stepped at fps ticks a second'''
+    level = LevelStream(path, radius)
+    world = World(Player(*level.spawn, 50, 50), [], fps=fps, block_size=level.tile_size)
+    world.attach(level)
+    return world
+
+
+if __name__ == "__main__":
+    # regenerate the bundled level from the map defined in code
+    from utils import init_headless
+    from world import build_default_level
+
+    init_headless()
+    export_world(build_default_level(), DEFAULT_LEVEL)
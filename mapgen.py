@@ -0,0 +1,248 @@
+'''Seeded generator of jump quest maps of any size.
+
+A generated map is a tall grid walled in on both sides, with a floor at the
+bottom where the player spawns, and a route of platforms zig-zagging up to
+the flag at the top. Every step of the route is one the player can make:
+the rises and gaps come from the actual jump arc (see jump_arc), worked
+out from Player.jump, Player.loop, GRAVITY and PLAYER_VEL, with a safety
+margin. Side platforms branch off the route as shortcuts and dead ends,
+and Fires are scattered over the platforms. Example:
+
+    python mapgen.py levels/big.jql --tiles 1000000 --traps 0.2 --seed 7
+
+The size is the area of the grid in tiles, 10**2 to 10**6 and beyond. The
+map is generated from the top down and written straight into a .jql file a
+band of chunk rows at a time (see levels.LevelWriter), so only the rows
+near the current end of the route are ever held in memory. The same seed
+and options always give the same map.
+'''
+import argparse
+import math
+import random
+import time
+
+from utils import FPS, pixel_steps, run_speed
+from classes import Player
+from levels import LevelWriter, TERRAIN, FIRE, FLAG, FIRE_ON
+
+
+TILE_SIZE = 96
+# the player's sprite frames are 64 pixels square
+PLAYER_SIZE = 64
+# rises and jump distances only use this fraction of what the arc allows,
+# so the jumps don't need frame-perfect timing
+HEIGHT_MARGIN = 0.9
+DISTANCE_MARGIN = 0.75
+# a Fire is 16 by 32 drawn at twice the size, standing on a platform
+FIRE_SIZE = (16, 32)
+FLAG_SIZE = (32, 64)
+
+
+def jump_arc(fps=FPS, gravity=Player.GRAVITY):
+    '''The heights above the take-off point, tick by tick, of a double jump
+    with the second jump at the top of the first, until the player is back
+    down at the height it started from'''
+    heights = []
+    scale = FPS / fps
+    y, y_vel, fall_count = 0, 0, 0
+    second = False
+    for tick in range(fps * 8):
+        # the same steps as Player.jump and Player.loop
+        if tick == 0:
+            y_vel = -gravity * 8 * scale
+            fall_count = 0
+        elif not second and y_vel >= 0:
+            y_vel = -gravity * 8 * scale
+            second = True
+        y_vel += min(1, (fall_count / fps) * gravity) * scale * scale
+        fall_count += 1
+        y += pixel_steps(y, y_vel)
+        if y > 0:
+            break
+        heights.append(-y)
+    return heights
+
+
+class JumpLimits:
+    '''What the route may ask of the player, in tiles, worked out from the arc'''
+
+    def __init__(self, fps=FPS, tile_size=TILE_SIZE):
+        arc = jump_arc(fps)
+        self.max_rise = int(max(arc) * HEIGHT_MARGIN) // tile_size
+        # the widest gap for every rise: how far the player gets sideways
+        # while still above the platform it is jumping up to
+        self.max_gap = []
+        for rise in range(self.max_rise + 1):
+            ticks = max(tick for tick, height in enumerate(arc) if height >= rise * tile_size) + 1
+            reach = sum(run_speed(tick, fps) for tick in range(ticks)) * DISTANCE_MARGIN - PLAYER_SIZE
+            self.max_gap.append(max(1, int(reach) // tile_size))
+        # platforms over one another leave this many rows between them, so
+        # nobody hits their head on the one above in the middle of a jump
+        self.clearance = math.ceil((max(arc) + PLAYER_SIZE) / tile_size) + 1
+
+
+class Generator:
+    '''Lays out one map, top row first. See the module docstring'''
+
+    def __init__(self, tiles, traps=0.2, branches=2, seed=0, columns=None, fps=FPS):
+        self.columns = columns or max(10, math.isqrt(tiles))
+        self.rows = max(10, tiles // self.columns)
+        self.traps = traps          # chance of a Fire on every free tile of a platform
+        self.branches = branches    # side platforms tried for every step of the route
+        self.rng = random.Random(seed)
+        self.limits = JumpLimits(fps)
+        self.floor = self.rows - 1  # the bottom row is solid
+        self.pending = {}           # row -> bytearray of tile ids, for rows not written yet
+        self.entities = []          # entities not written yet
+        self.platforms = 0
+        self.fires = 0
+
+    def blank_row(self):
+        cells = bytearray(self.columns)
+        cells[0] = cells[-1] = TERRAIN  # the walls
+        return cells
+
+    def row(self, row):
+        if row not in self.pending:
+            self.pending[row] = self.blank_row()
+        return self.pending[row]
+
+    def free(self, row, left, right):
+        ''' True when a platform on row from column left to right (inclusive)
+        keeps its clearance from every platform near it'''
+        clearance = self.limits.clearance
+        if left < 1 or right > self.columns - 2 or row < 2 or row >= self.floor:
+            return False
+        for other in range(row - clearance + 1, min(row + clearance, self.floor)):
+            cells = self.pending.get(other)
+            if cells is not None and any(cells[max(1, left - 1):min(self.columns - 1, right + 2)]):
+                return False
+        return True
+
+    def place(self, row, left, right, traps=True):
+        cells = self.row(row)
+        cells[left:right + 1] = bytes([TERRAIN]) * (right - left + 1)
+        self.platforms += 1
+        if not traps:
+            return
+        # fires stand on the inner tiles with at least one free tile between
+        # them, so there is always room to land before jumping the next one
+        column = left + 1
+        while column < right:
+            if self.rng.random() < self.traps:
+                width, height = FIRE_SIZE
+                x = column * TILE_SIZE + (TILE_SIZE - width * 2) // 2
+                self.entities.append((FIRE, FIRE_ON, x, row * TILE_SIZE - height * 2, width, height))
+                self.fires += 1
+                column += 2
+            column += 1
+
+    def step(self, row, left, right, direction):
+        '''Picks the next platform of the route, below the one from left to
+        right on row (going down here is going up for the player). Returns
+        (row, left, right, direction)'''
+        rng = self.rng
+        limits = self.limits
+        for attempt in range(40):
+            if attempt == 20:
+                direction = -direction  # stuck against a wall or a platform, turn around
+            rise = rng.randint(1, limits.max_rise)
+            gap = rng.randint(1, limits.max_gap[rise])
+            length = rng.randint(2, 5)
+            if direction > 0:
+                new_left = right + gap + 1
+                new_right = new_left + length - 1
+            else:
+                new_right = left - gap - 1
+                new_left = new_right - length + 1
+            if self.free(row + rise, new_left, new_right):
+                return row + rise, new_left, new_right, direction
+            if new_left < 1 or new_right > self.columns - 2:
+                direction = -direction
+        # nothing fits: a single tile in reach will do, never mind the clearance
+        if right + 2 <= self.columns - 2:
+            return row + 1, right + 2, right + 2, 1
+        return row + 1, left - 2, left - 2, -1
+
+    def branch(self, row):
+        ''' Tries to add a side platform near a row of the route'''
+        rise = self.limits.max_rise
+        new_row = row + self.rng.randint(-rise, rise)
+        length = self.rng.randint(1, 4)
+        left = self.rng.randint(1, max(1, self.columns - 1 - length))
+        if self.free(new_row, left, left + length - 1):
+            self.place(new_row, left, left + length - 1, traps=length > 2)
+
+    def generate(self, writer):
+        ''' Lays the map out into a levels.LevelWriter and closes it'''
+        rng = self.rng
+        limits = self.limits
+        # the flag stands on the top platform
+        length = min(4, self.columns - 2)
+        left = rng.randint(1, self.columns - 1 - length)
+        row, right = 2, left + length - 1
+        self.place(row, left, right, traps=False)
+        width, height = FLAG_SIZE
+        self.entities.append((FLAG, 0, (left + length // 2) * TILE_SIZE, row * TILE_SIZE - height, width, height))
+        direction = rng.choice((-1, 1))
+
+        written = 0  # rows handed to the writer
+        while self.floor - row > limits.max_rise:
+            row, left, right, direction = self.step(row, left, right, direction)
+            self.place(row, left, right)
+            for _ in range(self.branches):
+                self.branch(row)
+            # nothing is placed or checked this far above the route any more
+            done = row - limits.max_rise - limits.clearance
+            written = self.flush(writer, written, done - done % writer.chunk_tiles)
+
+        self.pending[self.floor] = bytearray([TERRAIN]) * self.columns
+        self.flush(writer, written, self.rows)
+        writer.close()
+
+    def flush(self, writer, written, end):
+        ''' Writes the rows from written up to end. Returns the new written'''
+        if end <= written:
+            return written
+        empty = self.blank_row()
+        writer.write_rows(self.pending.pop(row, empty) for row in range(written, end))
+        bottom = end * TILE_SIZE
+        keep = []
+        for entity in self.entities:
+            if entity[3] < bottom:
+                writer.add_entity(*entity)
+            else:
+                keep.append(entity)
+        self.entities = keep
+        return end
+
+
+def generate_level(path, tiles, traps=0.2, branches=2, seed=0, columns=None, chunk_tiles=8):
+    '''Generates a map into a level file. Returns the Generator, for its
+    columns, rows, platforms and fires'''
+    generator = Generator(tiles, traps, branches, seed, columns)
+    # the player starts on the floor, next to the left wall
+    spawn = (TILE_SIZE + (TILE_SIZE - PLAYER_SIZE) // 2, (generator.floor - 1) * TILE_SIZE)
+    writer = LevelWriter(path, generator.columns, generator.rows, TILE_SIZE, (0, 0), spawn, chunk_tiles)
+    generator.generate(writer)
+    return generator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="the level file to write")
+    parser.add_argument("--tiles", type=int, default=10000, help="area of the map in tiles")
+    parser.add_argument("--columns", type=int, default=None, help="width of the map in tiles, square by default")
+    parser.add_argument("--traps", type=float, default=0.2, help="chance of a fire on each free platform tile")
+    parser.add_argument("--branches", type=int, default=2, help="side platforms tried per step of the route")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    generator = generate_level(args.path, args.tiles, args.traps, args.branches, args.seed, args.columns)
+    print(f"{args.path}: {generator.columns} x {generator.rows} tiles, {generator.platforms} platforms, "
+          f"{generator.fires} fires in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+'''The wire protocol between server.py and client.py.
+
+Every message is a 4 byte little-endian length followed by that many bytes,
+the first of which is the message type:
+
+    WELCOME   server -> client once, on connect: the client's player id, the
+              tick rate and the level file every client loads locally
+    INPUT     client -> server whenever its keys change: the client's frame
+              number and the held/pressed keys as one byte (world.input_keys)
+    SNAPSHOT  server -> client every tick: the tick number and the players
+              that changed since the last snapshot sent to that client
+
+Player states are quantized to what drawing them needs: whole pixel
+positions, the index of the animation frame (see snapshot.player_frame_table),
+the health and a few flag bits. A snapshot only carries the fields of a
+player that differ from the previous snapshot the client received, positions
+as varint-encoded deltas, so a player running along a platform costs about
+four bytes a tick. The map itself never changes and is not sent, and the
+traps need no state at all: their frames follow from the tick (see
+traps.TrapManager), which every snapshot carries.
+
+The server only sends over TCP, which delivers in order, so the previous
+snapshot a client received is always the one the next is relative to.
+'''
+import struct
+from collections import namedtuple
+
+from varint import write_varint, read_varint, write_signed, read_signed
+from world import input_keys, keys_input
+
+
+# message types
+WELCOME = 1
+INPUT = 2
+SNAPSHOT = 3
+
+LENGTH = struct.Struct("<I")
+WELCOME_HEADER = struct.Struct("<BHH")  # type, player id, tick rate; the level path follows
+INPUT_PACKET = struct.Struct("<BIB")    # type, client frame, keys
+
+# the largest message accepted, so a broken peer can't make us allocate gigabytes
+MAX_MESSAGE = 1 << 20
+
+# player flag bits
+HIT = 1
+WON = 2
+
+# snapshot record bits: which fields follow the player id. LEFT_GAME marks a
+# player that disconnected and carries no fields
+CHANGED_X = 1
+CHANGED_Y = 2
+CHANGED_FRAME = 4
+CHANGED_HEALTH = 8
+CHANGED_FLAGS = 16
+LEFT_GAME = 128
+
+PlayerState = namedtuple("PlayerState", ["x", "y", "frame", "health", "flags"])
+
+# what a player that wasn't in the previous snapshot is encoded against
+NEW_PLAYER = PlayerState(0, 0, 0, 0, 0)
+
+
+def frame_message(payload):
+    ''' Prefixes a message with its length'''
+    return LENGTH.pack(len(payload)) + payload
+
+async def read_message(reader):
+    ''' Reads one message from an asyncio StreamReader.
+    Raises asyncio.IncompleteReadError when the peer disconnects'''
+    length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    if length == 0 or length > MAX_MESSAGE:
+        raise ValueError(f"bad message length {length}")
+    return await reader.readexactly(length)
+
+
+def encode_welcome(player_id, tick_rate, level_path):
+    return frame_message(WELCOME_HEADER.pack(WELCOME, player_id, tick_rate) + level_path.encode())
+
+def decode_welcome(data):
+    ''' Returns (player id, tick rate, level path)'''
+    _, player_id, tick_rate = WELCOME_HEADER.unpack_from(data)
+    return player_id, tick_rate, data[WELCOME_HEADER.size:].decode()
+
+
+def encode_input(frame, inputs):
+    return frame_message(INPUT_PACKET.pack(INPUT, frame & 0xFFFFFFFF, input_keys(inputs)))
+
+def decode_input(data):
+    ''' Returns (client frame, Input)'''
+    _, frame, keys = INPUT_PACKET.unpack(data)
+    return frame, keys_input(keys)
+
+
+def player_state(player, won, frame_ids):
+    ''' Quantizes a Player for sending. frame_ids maps id(Frame) to its index'''
+    frame = 0 if player.frame is None else frame_ids[id(player.frame)]
+    flags = HIT * bool(player.hit) | WON * bool(won)
+    return PlayerState(player.rect.x, player.rect.y, frame, max(0, player.current_health), flags)
+
+
+def encode_snapshot(tick, previous, current):
+    '''Encodes the players of current as changes to previous.
+
+    Both are dictionaries of player id -> PlayerState. Returns the framed
+    message, ready to write.
+    '''
+    records = bytearray()
+    count = 0
+    for player_id, state in current.items():
+        old = previous.get(player_id, NEW_PLAYER)
+        if state == old and player_id in previous:
+            continue
+        count += 1
+        write_varint(records, player_id)
+        changed = (CHANGED_X * (state.x != old.x) | CHANGED_Y * (state.y != old.y)
+                   | CHANGED_FRAME * (state.frame != old.frame) | CHANGED_HEALTH * (state.health != old.health)
+                   | CHANGED_FLAGS * (state.flags != old.flags))
+        records.append(changed)
+        if changed & CHANGED_X:
+            write_signed(records, state.x - old.x)
+        if changed & CHANGED_Y:
+            write_signed(records, state.y - old.y)
+        if changed & CHANGED_FRAME:
+            write_varint(records, state.frame)
+        if changed & CHANGED_HEALTH:
+            records.append(state.health)
+        if changed & CHANGED_FLAGS:
+            records.append(state.flags)
+    for player_id in previous:
+        if player_id not in current:
+            count += 1
+            write_varint(records, player_id)
+            records.append(LEFT_GAME)
+
+    message = bytearray((SNAPSHOT,))
+    write_varint(message, tick)
+    write_varint(message, count)
+    message += records
+    return frame_message(bytes(message))
+
+
+def decode_snapshot(data, states):
+    '''Applies a snapshot message to states, the dictionary of player id ->
+    PlayerState the previous snapshots built up. Returns the tick'''
+    tick, pos = read_varint(data, 1)
+    count, pos = read_varint(data, pos)
+    for _ in range(count):
+        player_id, pos = read_varint(data, pos)
+        changed = data[pos]
+        pos += 1
+        if changed & LEFT_GAME:
+            states.pop(player_id, None)
+            continue
+        x, y, frame, health, flags = states.get(player_id, NEW_PLAYER)
+        if changed & CHANGED_X:
+            delta, pos = read_signed(data, pos)
+            x += delta
+        if changed & CHANGED_Y:
+            delta, pos = read_signed(data, pos)
+            y += delta
+        if changed & CHANGED_FRAME:
+            frame, pos = read_varint(data, pos)
+        if changed & CHANGED_HEALTH:
+            health = data[pos]
+            pos += 1
+        if changed & CHANGED_FLAGS:
+            flags = data[pos]
+            pos += 1
+        states[player_id] = PlayerState(x, y, frame, health, flags)
+    return tick
@@ -0,0 +1,132 @@
+import csv
+import json
+from array import array
+from time import perf_counter
+
+import pygame
+
+
+# the phases of one frame of game.main, in the order they run
+PHASES = ("events", "player", "traps", "collision", "draw", "flip")
+
+
+class FrameProfiler:
+    '''Times each phase of the frame loop into a fixed-size ring buffer.
+
+    Call start_frame() at the top of the frame, mark(phase) at the end of each
+    phase (the time since the previous mark is charged to that phase) and
+    end_frame() once the frame is done. Only the last size frames are kept, so
+    the memory use is fixed however long the game runs.
+    '''
+
+    enabled = True
+
+    def __init__(self, size=600, phases=PHASES):
+        self.size = size
+        self.phases = phases
+        # one ring buffer of milliseconds per phase, plus the whole frame
+        self.samples = {phase: array("d", bytes(8 * size)) for phase in (*phases, "frame")}
+        self.current = dict.fromkeys(phases, 0.0)
+        self.index = 0  # where the next frame is written
+        self.count = 0  # number of valid frames in the buffers
+        self.frame_start = self.last = perf_counter()
+        self.overlay = False  # draw the stats on screen, toggled from game.main
+        self.font = None
+        self.startup = {}  # one-off timings in milliseconds, e.g. the time to the first frame
+
+    def start_frame(self):
+        self.frame_start = self.last = perf_counter()
+        for phase in self.current:
+            self.current[phase] = 0.0
+
+    def mark(self, phase):
+        now = perf_counter()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        index = self.index
+        for phase, seconds in self.current.items():
+            self.samples[phase][index] = seconds * 1000
+        self.samples["frame"][index] = (perf_counter() - self.frame_start) * 1000
+        self.index = (index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def frames(self, phase):
+        ''' Returns the recorded milliseconds of a phase, oldest first'''
+        samples = self.samples[phase]
+        if self.count < self.size:
+            return samples[:self.count].tolist()
+        return samples[self.index:].tolist() + samples[:self.index].tolist()
+
+    def stats(self):
+        ''' Returns p50/p95/p99/worst/mean milliseconds for every phase'''
+        stats = {}
+        for phase in self.samples:
+            ordered = sorted(self.frames(phase))
+            if not ordered:
+                continue
+
+            def percentile(p):
+                return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+            stats[phase] = {
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "p99": percentile(99),
+                "worst": ordered[-1],
+                "mean": sum(ordered) / len(ordered),
+            }
+        return stats
+
+    def dump(self, path):
+        ''' Writes the recorded frames to a .csv file, or the frames and stats to .json'''
+        columns = (*self.phases, "frame")
+        rows = list(zip(*(self.frames(phase) for phase in columns)))
+        if path.endswith(".json"):
+            with open(path, "w") as file:
+                json.dump({"startup": self.startup,
+                           "stats": self.stats(),
+                           "frames": [dict(zip(columns, row)) for row in rows]}, file, indent=1)
+        else:
+            with open(path, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(columns)
+                writer.writerows(rows)
+
+    def draw_overlay(self, window):
+        ''' Draws the phase stats in the top left corner and returns the area covered'''
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+        lines = [f"{'phase':<10}{'p50':>7}{'p95':>7}{'p99':>7}{'worst':>7}"]
+        for phase, stat in self.stats().items():
+            lines.append(f"{phase:<10}{stat['p50']:7.2f}{stat['p95']:7.2f}{stat['p99']:7.2f}{stat['worst']:7.2f}")
+
+        area = pygame.Rect(0, 0, 0, 0)
+        for i, line in enumerate(lines):
+            text = self.font.render(line, True, (255, 255, 255), (0, 0, 0))
+            area.union_ip(window.blit(text, (5, 5 + i * 16)))
+        return area
+
+
+class NullProfiler:
+    '''Stands in for FrameProfiler when profiling is off, so the frame loop
+    keeps its calls but they do nothing'''
+
+    enabled = False
+    overlay = False
+
+    def __init__(self):
+        self.startup = {}
+
+    def start_frame(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
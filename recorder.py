@@ -0,0 +1,389 @@
+'''Session recordings: the inputs of every tick and what happened in the game.
+
+A Recorder is attached to a World (world.recorder) and sees the Input of
+every step plus the gameplay events, and writes them into a compact binary
+log. game.main records a session when JQ_RECORD is set to a file name.
+The log is enough to replay the session exactly, since the World is
+deterministic (at the tick rate it was recorded at), and to analyse it
+without replaying:
+
+    python recorder.py session.jqr            # summary of the session
+    python recorder.py session.jqr --replay   # replay it and check the events and the end
+
+The log is a header followed by records. Every record starts with a one
+byte tag and its numbers are varints (see varint.py):
+
+    header   magic, version, ticks a second, level file the session played
+    RUN      keys (world.input_keys), ticks: the same keys for that
+             many ticks in a row
+    HIT      ticks since the previous event, health left: a trap hit the player
+    DEATH    ticks since the previous event, x, y: the health ran out there
+    RESPAWN  ticks since the previous event, x, y: where the player restarted
+    FLAG     ticks since the previous event: the player reached the flag
+    GAP      ticks: that many ticks of inputs and events were lost
+    END      the world's tick, the player's x, y and an 8 byte state_hash of
+             the final state: how the session ended, for replays to check
+
+Holding a key for a second costs one RUN record of three bytes, so an hour
+of play is a few kilobytes.
+
+Recording must never stall the game, so the encoding happens on the game's
+thread into a small buffer, and about once a second that buffer is handed
+to a writer thread through a bounded queue. When the disk can't keep up and
+the queue is full, the game keeps buffering instead of waiting; only if the
+buffer grows past max_pending bytes is it dropped, leaving a GAP record.
+'''
+import argparse
+import queue
+import struct
+import threading
+from collections import namedtuple
+
+from world import input_keys, keys_input
+from varint import write_varint, read_varint, write_signed, read_signed
+
+
+MAGIC = b"JQRC"
+VERSION = 2  # version 1 had no END record
+HEADER = struct.Struct("<4sHHH")  # magic, version, ticks a second, length of the level path
+
+# record tags
+RUN = 1
+HIT = 2
+DEATH = 3
+RESPAWN = 4
+FLAG = 5
+GAP = 6
+END = 7
+
+EVENT_NAMES = {HIT: "hit", DEATH: "death", RESPAWN: "respawn", FLAG: "flag"}
+
+# a gameplay event. x and y are only set for deaths and respawns, health only for hits
+Event = namedtuple("Event", ["tick", "kind", "x", "y", "health"], defaults=(None, None, None))
+# a run of ticks with the same keys, starting at tick
+Run = namedtuple("Run", ["tick", "keys", "ticks"])
+# ticks that were lost, starting at tick
+Gap = namedtuple("Gap", ["tick", "ticks"])
+# the state the session ended in after tick ticks, see final_state
+End = namedtuple("End", ["tick", "x", "y", "state"])
+# what replay() found: the ticks played, the recorded and the replayed events,
+# the recorded End (None when the session didn't close its recording) and the replayed one
+Replay = namedtuple("Replay", ["ticks", "recorded", "replayed", "end", "replayed_end"])
+
+
+def final_state(world):
+    '''The End of a World: its tick, the player's position and a hash of its
+    snapshot without the traps. A trap that nobody can see sleeps (see
+    traps.TrapManager), and the game sees more of the map than a replay, so
+    the traps' frames differ while the game itself doesn't'''
+    from snapshot import Snapshotter, state_hash, TRAPS_START
+
+    data = Snapshotter(world).snapshot(world)
+    return End(world.tick, world.player.rect.x, world.player.rect.y, state_hash(data[:TRAPS_START]))
+
+
+class Recorder:
+    '''Records one World into a log file.
+
+    Set world.recorder to it; World.step calls tick() with every Input and
+    hit(), death(), respawn() and flag() when those happen. Call
+    close(world) when the session ends, which records the state it ended in,
+    writes what is still buffered and waits for the writer thread.
+    '''
+
+    def __init__(self, path, level="", fps=60, flush_ticks=60, queue_size=64, max_pending=1 << 20):
+        # fps has to be the World's, its rules depend on the tick rate
+        self.flush_ticks = flush_ticks  # ticks between handing the buffer to the writer
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.ticks = 0          # ticks recorded
+        self.keys = None        # the keys of the open run
+        self.run = 0            # ticks in the open run
+        self.event_tick = 0     # tick of the previous event
+        self.buffer_from = 0    # the first tick in the buffer
+        self.gap = 0            # ticks covered by a GAP record in the buffer
+        self.lost = 0           # ticks dropped because the writer fell behind
+        self.queue = queue.Queue(queue_size)
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, fps, len(level.encode())) + level.encode())
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def write(self):
+        ''' The writer thread: writes the chunks from the queue until it gets None'''
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            self.file.write(chunk)
+        self.file.close()
+
+    def tick(self, inputs):
+        ''' Records the Input of one tick'''
+        # flush before this tick rather than after the last one: World.step
+        # records the events of a tick after calling tick(), so only now are
+        # they all in the buffer, and a GAP can't land in the middle of them
+        if self.ticks and self.ticks % self.flush_ticks == 0:
+            self.flush()
+        keys = input_keys(inputs)
+        if keys != self.keys:
+            self.end_run()
+            self.keys = keys
+        self.run += 1
+        self.ticks += 1
+
+    def hit(self, health):
+        self.event(HIT, health=health)
+
+    def death(self, x, y):
+        self.event(DEATH, x, y)
+
+    def respawn(self, x, y):
+        self.event(RESPAWN, x, y)
+
+    def flag(self):
+        self.event(FLAG)
+
+    def end_run(self):
+        if self.run:
+            self.buffer.append(RUN)
+            self.buffer.append(self.keys)
+            write_varint(self.buffer, self.run)
+            self.run = 0
+
+    def event(self, kind, x=None, y=None, health=None):
+        ''' Records a gameplay event of the tick last passed to tick()'''
+        tick = self.ticks - 1  # ticks count from the start of the recording
+        buffer = self.buffer
+        buffer.append(kind)
+        write_varint(buffer, tick - self.event_tick)
+        self.event_tick = tick
+        if kind == HIT:
+            write_varint(buffer, max(0, health))
+        elif kind in (DEATH, RESPAWN):
+            write_signed(buffer, x)
+            write_signed(buffer, y)
+
+    def flush(self):
+        ''' Hands the buffer to the writer thread without waiting for it'''
+        # close the run, so a crash loses at most the last flush_ticks ticks
+        self.end_run()
+        try:
+            self.queue.put_nowait(bytes(self.buffer))
+        except queue.Full:
+            if len(self.buffer) <= self.max_pending:
+                return  # keep buffering, try again at the next flush
+            # too far behind: drop what's buffered and say so in the log. A
+            # gap already in the buffer is dropped too, the new one covers it
+            lost = self.ticks - self.buffer_from
+            self.lost += lost - self.gap
+            self.gap = lost
+            self.buffer = bytearray((GAP,))
+            write_varint(self.buffer, lost)
+            self.event_tick = self.ticks  # the next event is relative to the end of the gap
+            return
+        self.buffer = bytearray()
+        self.buffer_from = self.ticks
+        self.gap = 0
+
+    def close(self, world=None):
+        ''' Ends the recording. With the World, first records its final_state'''
+        self.end_run()
+        if world is not None:
+            end = final_state(world)
+            self.buffer.append(END)
+            write_varint(self.buffer, end.tick)
+            write_signed(self.buffer, end.x)
+            write_signed(self.buffer, end.y)
+            self.buffer += end.state.to_bytes(8, "little")
+        self.queue.put(bytes(self.buffer))  # the game is over, waiting is fine now
+        self.buffer = bytearray()
+        self.queue.put(None)
+        self.writer.join()
+
+
+class LogReader:
+    '''Reads a log back, a block at a time, so logs of any length can be read.
+
+    Iterating yields Run, Event and Gap records in the order they happened.
+    '''
+
+    def __init__(self, path, block_size=1 << 16):
+        self.path = path
+        self.block_size = block_size
+        with open(path, "rb") as file:
+            magic, version, self.fps, length = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or version not in (1, VERSION):
+                raise ValueError(f"{path} is not a version {VERSION} recording")
+            self.level = file.read(length).decode()
+            self.start = file.tell()
+
+    def __iter__(self):
+        with open(self.path, "rb") as file:
+            file.seek(self.start)
+            data = b""
+            pos = 0
+            tick = 0        # ticks of input read so far
+            event_tick = 0  # tick of the previous event
+            while True:
+                block = file.read(self.block_size)
+                data = data[pos:] + block
+                pos = 0
+                while pos < len(data):
+                    start = pos
+                    try:
+                        tag = data[pos]
+                        if tag == RUN:
+                            keys = data[pos + 1]
+                            ticks, pos = read_varint(data, pos + 2)
+                            record = Run(tick, keys, ticks)
+                            tick += ticks
+                        elif tag == GAP:
+                            ticks, pos = read_varint(data, pos + 1)
+                            record = Gap(tick, ticks)
+                            tick += ticks
+                            event_tick = tick
+                        elif tag == END:
+                            ticks, pos = read_varint(data, pos + 1)
+                            x, pos = read_signed(data, pos)
+                            y, pos = read_signed(data, pos)
+                            if pos + 8 > len(data):
+                                raise IndexError
+                            record = End(ticks, x, y, int.from_bytes(data[pos:pos + 8], "little"))
+                            pos += 8
+                        elif tag in EVENT_NAMES:
+                            delta, pos = read_varint(data, pos + 1)
+                            when = event_tick + delta
+                            if tag == HIT:
+                                health, pos = read_varint(data, pos)
+                                record = Event(when, tag, health=health)
+                            elif tag in (DEATH, RESPAWN):
+                                x, pos = read_signed(data, pos)
+                                y, pos = read_signed(data, pos)
+                                record = Event(when, tag, x, y)
+                            else:
+                                record = Event(when, tag)
+                            event_tick = when  # only once the whole record was read
+                        else:
+                            raise ValueError(f"unknown record {tag} in {self.path}")
+                    except IndexError:
+                        # the record continues in the next block
+                        pos = start
+                        break
+                    yield record
+                if not block:
+                    if pos < len(data):
+                        raise ValueError(f"{self.path} ends in the middle of a record")
+                    return
+
+    def inputs(self):
+        ''' Yields the Input of every tick. Raises ValueError at a gap,
+        past which the session can't be replayed'''
+        for record in self:
+            if isinstance(record, Gap):
+                raise ValueError(f"{self.path} lost {record.ticks} ticks at tick {record.tick}")
+            if isinstance(record, Run):
+                inputs = keys_input(record.keys)
+                for _ in range(record.ticks):
+                    yield inputs
+
+    def events(self):
+        return (record for record in self if isinstance(record, Event))
+
+    def end(self):
+        ''' Returns the End record, or None if the recording wasn't closed with the World'''
+        return next((record for record in self if isinstance(record, End)), None)
+
+
+class EventList(list):
+    '''Stands in for a Recorder to collect a World's events in memory'''
+
+    ticks = 0
+
+    def tick(self, inputs):
+        self.ticks += 1
+
+    def hit(self, health):
+        self.append(Event(self.ticks - 1, HIT, health=max(0, health)))  # the same value a Recorder writes
+
+    def death(self, x, y):
+        self.append(Event(self.ticks - 1, DEATH, x, y))
+
+    def respawn(self, x, y):
+        self.append(Event(self.ticks - 1, RESPAWN, x, y))
+
+    def flag(self):
+        self.append(Event(self.ticks - 1, FLAG))
+
+
+def replay(path):
+    '''Plays a recording on a fresh World of its level, at the tick rate it
+    was recorded at. Returns a Replay; it was faithful when the events and
+    the ends match'''
+    from levels import load_world
+
+    log = LogReader(path)
+    world = load_world(log.level, fps=log.fps)
+    world.recorder = EventList()
+    ticks = world.run(log.inputs(), stop_on_win=False)
+    return Replay(ticks, list(log.events()), list(world.recorder), log.end(), final_state(world))
+
+
+def summarize(path):
+    ''' Returns counts of what happened in a recording'''
+    log = LogReader(path)
+    summary = {"level": log.level, "ticks": 0, "hits": 0, "deaths": 0, "respawns": 0,
+               "ticks_to_flag": None, "lost_ticks": 0}
+    for record in log:
+        if isinstance(record, End):
+            continue
+        if isinstance(record, Run):
+            summary["ticks"] += record.ticks
+        elif isinstance(record, Gap):
+            summary["ticks"] += record.ticks
+            summary["lost_ticks"] += record.ticks
+        elif record.kind == FLAG:
+            if summary["ticks_to_flag"] is None:
+                summary["ticks_to_flag"] = record.tick + 1
+        else:
+            summary[EVENT_NAMES[record.kind] + "s"] += 1
+    summary["seconds"] = round(summary["ticks"] / log.fps, 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("logs", nargs="+", help="recordings to read")
+    parser.add_argument("--replay", action="store_true", help="replay each recording and compare its events and how it ended")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.logs:
+        summary = summarize(path)
+        print(f"{path}: " + ", ".join(f"{key} {value}" for key, value in summary.items()))
+        if args.replay:
+            from utils import init_headless
+
+            init_headless()
+            ticks, recorded, replayed, end, replayed_end = replay(path)
+            if recorded != replayed:
+                failed = True
+                first = next((i for i, pair in enumerate(zip(recorded, replayed)) if pair[0] != pair[1]),
+                             min(len(recorded), len(replayed)))
+                print(f"  replay DIVERGED at event {first}: recorded {recorded[first:first + 1]}, "
+                      f"replayed {replayed[first:first + 1]}")
+            elif end is None:
+                print(f"  replayed {ticks} ticks, all {len(recorded)} events match; the recording has no "
+                      f"final state to check")
+            elif end != replayed_end:
+                failed = True
+                print(f"  replay DIVERGED: the session ended at ({end.x}, {end.y}) after {end.tick} ticks, "
+                      f"the replay at ({replayed_end.x}, {replayed_end.y}) after {replayed_end.tick}"
+                      + ("" if (end.x, end.y) != (replayed_end.x, replayed_end.y) else " in a different state"))
+            else:
+                print(f"  replayed {ticks} ticks, all {len(recorded)} events and the final state match")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import math
+
+import pygame
+
+from utils import get_candidates
+from profiler import NULL_PROFILER
+
+
+class Renderer:
+    '''Draws the game using dirty rectangles instead of full-screen updates.
+
+    The background and every static object are composed once into a static
+    layer for the current scroll position. On a normal frame only the animated
+    objects and the player are redrawn: the areas they covered last frame are
+    restored from the static layer and just those rects are passed to
+    pygame.display.update. Whenever offset_x changes (or invalidate() is called
+    after the map itself changed) the static layer is rebuilt and the whole
+    window is redrawn.
+
+    Only what intersects the camera is drawn. Static tiles (Blocks) are baked
+    into square chunk surfaces of chunk_size pixels the first time a chunk comes
+    into view, so a full redraw is a handful of chunk blits instead of one blit
+    per tile. Chunks that scroll well out of view are dropped again.
+
+    With a scale below 1 (see set_scale) the frame is drawn into a smaller
+    render target with scaled copies of the images. The dirty rectangles then
+    live in the target, and only they are stretched onto the window and
+    presented, widened to the pixel grid the target and the window share, so
+    the pieces line up exactly with a stretch of the whole target.
+    '''
+
+    def __init__(self, window, background, chunk_size=96 * 8):
+        self.window = window
+        self.background = background  # a pre-composed surface, see utils.compose_background
+        self.chunk_size = chunk_size
+        self.chunks = {}      # (column, row) -> baked surface, or None for an empty chunk
+        self.offset_x = None  # None forces a full redraw on the first frame
+        self.animated = []    # animated objects found during the last full redraw
+        self.dirty = []       # target areas covered by moving things last frame
+        self.profiler = NULL_PROFILER  # times the draw and flip phases, and draws its overlay
+        self.overlay_area = None  # window area the overlay covered last frame, when scaled
+        self.set_scale(1.0)
+
+    def set_scale(self, scale):
+        ''' Draws at scale times the window's resolution from the next frame on.
+        scale has to be a multiple of 1/8, so the chunks scale to whole pixels
+        and every 8 window pixels are a whole number of target pixels'''
+        if not 0 < scale <= 1 or (scale * 8) % 1:
+            raise ValueError(f"render scale {scale} is not one of 1/8, 2/8, ... 1")
+        self.scale = scale
+        width, height = self.window.get_size()
+        if scale == 1:
+            self.target = self.window
+            self.scaled_background = self.background
+        else:
+            size = (round(width * scale), round(height * scale))
+            self.target = pygame.Surface(size).convert()
+            self.scaled_background = pygame.transform.scale(self.background, size)
+        self.static_layer = pygame.Surface(self.target.get_size()).convert()
+        self.scaled_images = {}  # id(image) -> (image, its scaled copy)
+        self.invalidate()
+
+    def invalidate(self):
+        ''' Forces a full redraw on the next frame, re-baking the chunks.
+        Call it when objects were added to or removed from the map'''
+        self.offset_x = None
+        self.chunks.clear()
+
+    def scaled(self, image):
+        ''' Returns image at the current scale. Images are shared between
+        objects, so each one is only scaled once'''
+        if self.scale == 1:
+            return image
+        entry = self.scaled_images.get(id(image))
+        # the image is kept in the entry, so its id can't be reused while cached
+        if entry is None or entry[0] is not image:
+            width, height = image.get_size()
+            size = (max(1, round(width * self.scale)), max(1, round(height * self.scale)))
+            entry = self.scaled_images[id(image)] = (image, pygame.transform.scale(image, size))
+        return entry[1]
+
+    def blit_object(self, surface, obj, offset_x):
+        ''' Draws an object onto a target-sized surface and returns the area covered'''
+        if self.scale == 1:
+            return obj.draw(surface, offset_x)
+        return surface.blit(self.scaled(obj.image), (round((obj.rect.x - offset_x) * self.scale),
+                                                      round(obj.rect.y * self.scale)))
+
+    def get_chunk(self, column, row, objects):
+        ''' Returns the baked surface of a chunk, baking it on first use'''
+        key = (column, row)
+        if key not in self.chunks:
+            size = self.chunk_size
+            area = pygame.Rect(column * size, row * size, size, size)
+            tiles = [obj for obj in get_candidates(objects, area) if obj.STATIC_TILE]
+            surface = None
+            if tiles:
+                surface = pygame.Surface((size, size), pygame.SRCALPHA).convert_alpha()
+                for tile in tiles:
+                    # tiles that straddle the chunk edge are simply clipped
+                    surface.blit(tile.image, (tile.rect.x - area.x, tile.rect.y - area.y))
+                if self.scale != 1:
+                    scaled_size = round(size * self.scale)
+                    surface = pygame.transform.scale(surface, (scaled_size, scaled_size))
+            self.chunks[key] = surface
+        return self.chunks[key]
+
+    def draw_static(self, objects, offset_x):
+        ''' Rebuilds the static layer for a new scroll position'''
+        camera = pygame.Rect((offset_x, 0), self.window.get_size())
+        size = self.chunk_size
+        columns = range(camera.left // size, (camera.right - 1) // size + 1)
+        rows = range(camera.top // size, (camera.bottom - 1) // size + 1)
+
+        # every chunk shifts by the same rounded offset, so no seams open between them
+        scaled_size = round(size * self.scale)
+        scaled_offset = round(offset_x * self.scale)
+        self.static_layer.blit(self.scaled_background, (0, 0))
+        for column in columns:
+            for row in rows:
+                chunk = self.get_chunk(column, row, objects)
+                if chunk is not None:
+                    self.static_layer.blit(chunk, (column * scaled_size - scaled_offset, row * scaled_size))
+
+        # drop baked chunks more than one chunk away from the camera
+        for column, row in list(self.chunks):
+            if not (columns.start - 1 <= column <= columns.stop and rows.start - 1 <= row <= rows.stop):
+                del self.chunks[(column, row)]
+
+        self.animated = []
+        for obj in get_candidates(objects, camera):
+            if obj.ANIMATED:
+                self.animated.append(obj)
+            elif not obj.STATIC_TILE:
+                self.blit_object(self.static_layer, obj, offset_x)
+
+    def draw(self, player, objects, offset_x, player_position=None, others=()):
+        ''' Draws a frame. player_position overrides where the player is drawn,
+        others are more players to draw, e.g. the other clients of a server'''
+        screen = self.target.get_rect()
+
+        if offset_x != self.offset_x:
+            # the screen scrolled, so everything moved: rebuild the static layer
+            self.offset_x = offset_x
+            self.draw_static(objects, offset_x)
+            self.target.blit(self.static_layer, (0, 0))
+            self.dirty = self.draw_moving(player, offset_x, player_position, others)
+            self.profiler.mark("draw")
+            self.present()
+            self.profiler.mark("flip")
+            return
+
+        # erase what moved last frame by copying the static layer back over it
+        for rect in self.dirty:
+            self.target.blit(self.static_layer, rect, rect)
+        drawn = self.draw_moving(player, offset_x, player_position, others)
+        self.profiler.mark("draw")
+        self.present([rect.clip(screen) for rect in self.dirty + drawn])
+        self.profiler.mark("flip")
+        self.dirty = drawn
+
+    def present(self, areas=None):
+        ''' Puts the frame on the display: the given target areas, or all of it'''
+        if self.scale == 1:
+            if areas is None:
+                pygame.display.update()
+            else:
+                pygame.display.update(areas)
+            return
+
+        if areas is None:
+            pygame.transform.scale(self.target, self.window.get_size(), self.window)
+            updates = None
+        else:
+            # the overlay covered part of the window last frame, put that back too
+            if self.overlay_area is not None:
+                areas = areas + [self.target_area(self.overlay_area)]
+            updates = []
+            for area in areas:
+                area, window_area = self.grid_areas(area)
+                if window_area.width and window_area.height:
+                    pygame.transform.scale(self.target.subsurface(area), window_area.size,
+                                           self.window.subsurface(window_area))
+                    updates.append(window_area)
+        # the overlay goes on top at full resolution, so it stays readable
+        self.overlay_area = None
+        if self.profiler.overlay:
+            self.overlay_area = self.profiler.draw_overlay(self.window)
+            if updates is not None:
+                updates.append(self.overlay_area)
+        if updates is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(updates)
+
+    def grid_areas(self, area):
+        '''Widens a target area to the grid where target and window pixels
+        line up: at a scale of n/8, every n target pixels are 8 window pixels.
+        Returns (target area, window area), which scale exactly onto each other'''
+        n = round(self.scale * 8)
+        left, top = area.left // n * n, area.top // n * n
+        right, bottom = -(-area.right // n) * n, -(-area.bottom // n) * n
+        area = pygame.Rect(left, top, right - left, bottom - top).clip(self.target.get_rect())
+        window_area = pygame.Rect(area.x * 8 // n, area.y * 8 // n, area.width * 8 // n, area.height * 8 // n)
+        return area, window_area.clip(self.window.get_rect())
+
+    def target_area(self, window_area):
+        ''' The target area a window area was stretched from'''
+        left, top = int(window_area.left * self.scale), int(window_area.top * self.scale)
+        right, bottom = math.ceil(window_area.right * self.scale), math.ceil(window_area.bottom * self.scale)
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def draw_player(self, player, offset_x, player_position):
+        ''' Draws the player and its health bar onto the target'''
+        if self.scale == 1:
+            return player.draw(self.window, offset_x, player_position)
+        # draw it at full resolution onto a small scratch surface, then scale
+        # that: the health bar and text are drawn up to 35 pixels above the sprite
+        x, y = player_position if player_position is not None else player.rect.topleft
+        above = 40
+        width, height = player.rect.width, player.rect.height + above
+        scratch = pygame.Surface((width, height), pygame.SRCALPHA)
+        player.draw(scratch, x, (x, above))
+        scratch = pygame.transform.scale(scratch, (round(width * self.scale), round(height * self.scale)))
+        return self.target.blit(scratch, (round((x - offset_x) * self.scale), round((y - above) * self.scale)))
+
+    def draw_moving(self, player, offset_x, player_position=None, others=()):
+        ''' Draws the animated objects, the players and the profiler overlay,
+        returning the rects they covered'''
+        drawn = [self.blit_object(self.target, obj, offset_x) for obj in self.animated]
+        drawn += [self.draw_player(other, offset_x, None) for other in others]
+        drawn.append(self.draw_player(player, offset_x, player_position))
+        if self.profiler.overlay and self.scale == 1:
+            drawn.append(self.profiler.draw_overlay(self.window))
+        return drawn
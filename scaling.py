@@ -0,0 +1,84 @@
+from collections import deque
+
+
+class ResolutionScaler:
+    '''Picks the render scale that keeps frames within a time budget.
+
+    Feed it the time every frame took with update(). Once a full window of
+    frames averages over budget_ms the scale drops a step; once the average
+    has stayed under headroom times the budget for patience frames it rises a
+    step again. The gap between the two thresholds, and starting a fresh
+    window after every change, keeps the scale from flickering between two
+    steps. If a raise puts the frames straight back over budget, the next
+    raise waits twice as long.
+
+    A lower scale doesn't always make frames cheaper: just below 1 the
+    stretch onto the window can cost more than the smaller frame saves. So
+    the first full window after a drop is compared with the one before it,
+    and a drop that didn't save at least min_gain of the frame time is
+    undone. The scale then stays above it until the frames are back within
+    budget, when the scene may have changed.
+
+    The scales are multiples of 1/8, which Renderer.set_scale needs.
+    '''
+
+    def __init__(self, budget_ms, min_scale=0.5, max_scale=1.0, step=0.125, window=30, headroom=0.75,
+                 min_gain=0.05):
+        for name, value in (("min_scale", min_scale), ("max_scale", max_scale), ("step", step)):
+            if not 0 < value <= 1 or (value * 8) % 1:
+                raise ValueError(f"{name} {value} is not one of 1/8, 2/8, ... 1")
+        if min_scale > max_scale:
+            raise ValueError(f"min_scale {min_scale} is above max_scale {max_scale}")
+        self.budget_ms = budget_ms
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.step = step
+        self.window = window
+        self.headroom = headroom
+        self.scale = max_scale
+        self.samples = deque(maxlen=window)
+        self.patience = window  # frames with headroom needed before a raise
+        self.calm = 0           # frames the average has had headroom for
+        self.raised = False     # the last change was a raise, not yet proven to fit
+        self.min_gain = min_gain
+        self.dropped = None     # the average before the last drop, until the drop is judged
+        self.floor = min_scale  # the lowest scale drops may go to, raised by a drop that didn't help
+
+    def update(self, frame_ms):
+        ''' Records a frame time. Returns True when the scale changed'''
+        self.samples.append(frame_ms)
+        if len(self.samples) < self.window:
+            return False
+        average = sum(self.samples) / self.window
+
+        if self.dropped is not None:
+            # the first full window since a drop: were the frames any cheaper?
+            before, self.dropped = self.dropped, None
+            if average > before * (1 - self.min_gain):
+                self.floor = min(self.max_scale, self.scale + self.step)
+                return self.change(self.floor)
+
+        if average > self.budget_ms:
+            if self.scale <= self.floor:
+                return False
+            # a raise that didn't fit makes the next one wait longer
+            self.patience = min(self.patience * 2, self.window * 16) if self.raised else self.window
+            self.raised = False
+            self.dropped = average
+            return self.change(max(self.floor, self.scale - self.step))
+
+        # within budget again, so lower scales are worth another try later
+        self.floor = self.min_scale
+        # a full window at the raised scale without a drop: the raise fits
+        self.raised = False
+        self.calm = self.calm + 1 if average < self.budget_ms * self.headroom else 0
+        if self.calm >= self.patience and self.scale < self.max_scale:
+            self.raised = True
+            return self.change(min(self.max_scale, self.scale + self.step))
+        return False
+
+    def change(self, scale):
+        self.scale = scale
+        self.samples.clear()
+        self.calm = 0
+        return True
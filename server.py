@@ -0,0 +1,219 @@
+'''Headless multiplayer server.
+
+Runs one map for many players at once. Every connected client gets its own
+Player on the shared map and sends its keys; the server steps every player
+with the usual World rules at a fixed tick rate and sends each client a
+snapshot of all the players after every tick (see netcode.py for the
+format). The server is authoritative: clients only send keys, never
+positions. Example:
+
+    python server.py levels/default.jql --port 7777
+    python client.py --port 7777               # in another terminal, or
+    python client.py --port 7777 --bots 100    # a load test
+
+Players pass through each other, like in the jump quests this is based on,
+so a player only ever collides with the map. The map is one SpatialHash
+(with its TileStore) shared by every player, so stepping a player looks at
+the few cells around it rather than at every object, and the traps are
+animated from the shared tick, waking for whichever players are near them.
+'''
+import argparse
+import asyncio
+import socket
+import time
+
+from utils import FPS, init_headless
+from classes import Player
+from world import World, NO_INPUT, Input
+from levels import DEFAULT_LEVEL, load_world
+from snapshot import player_frame_table
+import netcode
+
+
+# snapshots queue up in the socket buffer of a client that can't keep up. Past
+# this many bytes its snapshots are skipped until it catches up; the next one
+# it gets is relative to the last one it got, so nothing is lost
+MAX_BACKLOG = 256 * 1024
+
+
+class Arena:
+    '''One map and the players on it, stepped together.
+
+    Each player gets a World of its own for the rules (jumping, collision,
+    victory, respawning), but all of them share the Arena's objects and
+    traps, and step at the Arena's tick.
+    '''
+
+    def __init__(self, path=DEFAULT_LEVEL, fps=FPS):
+        # a radius larger than any level keeps all of its chunks alive, so the
+        # map doesn't depend on where any one player is
+        base = load_world(path, radius=1 << 20)
+        self.path = path
+        self.fps = fps
+        self.objects = base.objects
+        self.traps = base.traps
+        self.spawn = base.level.spawn
+        self.tick = 0
+        self.worlds = {}  # player id -> the World of that player
+        frames = player_frame_table()
+        self.frame_ids = {id(frame): i for i, frame in enumerate(frames)}
+
+    def join(self, player_id):
+        world = World(Player(*self.spawn, 50, 50), self.objects, fps=self.fps)
+        world.traps = self.traps
+        self.worlds[player_id] = world
+        return world
+
+    def leave(self, player_id):
+        self.worlds.pop(player_id, None)
+
+    def step(self, inputs):
+        ''' Advances every player by one tick. inputs maps player id -> Input'''
+        for player_id, world in self.worlds.items():
+            world.tick = self.tick  # the traps are animated from it
+            world.step(inputs.get(player_id, NO_INPUT))
+        self.tick += 1
+
+    def states(self):
+        ''' Returns player id -> quantized netcode.PlayerState'''
+        return {player_id: netcode.player_state(world.player, world.won, self.frame_ids)
+                for player_id, world in self.worlds.items()}
+
+
+class Connection:
+    '''A connected client: its socket, its keys and what it was last sent'''
+
+    def __init__(self, player_id, writer):
+        self.player_id = player_id
+        self.writer = writer
+        self.left = self.right = False
+        self.jump = False  # a press is latched until a tick has used it
+        self.frame = 0     # the client's frame number of the last input
+        self.sent = {}     # the states of the last snapshot it was sent
+
+    def take_input(self):
+        inputs = Input(self.left, self.right, self.jump)
+        self.jump = False
+        return inputs
+
+
+class Server:
+    '''Accepts clients and runs the Arena at a fixed tick rate.
+
+    The snapshot of a tick is usually the same for every client, since they
+    all got the previous one, so it is encoded once and written to each of
+    them. Only a client that skipped snapshots or just joined gets one of its
+    own.
+    '''
+
+    def __init__(self, arena, host="127.0.0.1", port=7777, tick_rate=FPS):
+        self.arena = arena
+        self.host = host
+        self.port = port
+        self.tick_rate = tick_rate
+        self.clients = {}   # player id -> Connection
+        self.next_id = 1
+        self.previous = {}  # the states sent after the last tick
+        self.tick_seconds = 0.0  # time the last tick took to step and send
+
+    async def handle(self, reader, writer):
+        ''' Serves one client until it disconnects'''
+        sock = writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            # inputs and snapshots are tiny and late ones are useless, don't batch them
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if len(self.clients) >= 0xFFFF:
+            writer.close()  # every player id is taken
+            return
+        # the ids wrap around after 0xFFFF, skip the ones still connected
+        player_id = self.next_id
+        while player_id in self.clients:
+            player_id = player_id % 0xFFFF + 1
+        self.next_id = player_id % 0xFFFF + 1
+        client = Connection(player_id, writer)
+        self.clients[player_id] = client
+        self.arena.join(player_id)
+        writer.write(netcode.encode_welcome(player_id, self.tick_rate, self.arena.path))
+        try:
+            while True:
+                data = await netcode.read_message(reader)
+                if data[0] != netcode.INPUT:
+                    continue  # unknown messages are ignored, for newer clients
+                client.frame, inputs = netcode.decode_input(data)
+                client.left, client.right = inputs.left, inputs.right
+                client.jump = client.jump or inputs.jump
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            del self.clients[player_id]
+            self.arena.leave(player_id)
+            writer.close()
+
+    def tick(self):
+        ''' Steps the arena once and sends the snapshot'''
+        start = time.perf_counter()
+        inputs = {player_id: client.take_input() for player_id, client in self.clients.items()}
+        self.arena.step(inputs)
+        states = self.arena.states()
+
+        shared = netcode.encode_snapshot(self.arena.tick, self.previous, states)
+        for client in self.clients.values():
+            if client.writer.transport.get_write_buffer_size() > MAX_BACKLOG:
+                continue
+            if client.sent is self.previous:
+                client.writer.write(shared)
+            else:
+                client.writer.write(netcode.encode_snapshot(self.arena.tick, client.sent, states))
+            client.sent = states
+        self.previous = states
+        self.tick_seconds = time.perf_counter() - start
+
+    async def run(self, stats_every=0):
+        ''' Serves forever. With stats_every, prints the tick time that often (in seconds)'''
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        loop = asyncio.get_running_loop()
+        period = 1 / self.tick_rate
+        deadline = loop.time()
+        worst = total = ticks = 0
+        report = loop.time() + stats_every
+        async with server:
+            print(f"serving {self.arena.path} on {self.host}:{self.port} at {self.tick_rate} Hz")
+            while True:
+                self.tick()
+                ticks += 1
+                total += self.tick_seconds
+                worst = max(worst, self.tick_seconds)
+                if stats_every and loop.time() >= report:
+                    print(f"tick {self.arena.tick}: {len(self.clients)} players, "
+                          f"{total / ticks * 1000:.2f} ms a tick on average, {worst * 1000:.2f} ms at worst")
+                    worst = total = ticks = 0
+                    report = loop.time() + stats_every
+
+                deadline += period
+                delay = deadline - loop.time()
+                if delay < -period * 5:
+                    # far behind: drop the backlog rather than run ticks back to back
+                    deadline = loop.time()
+                # sleep(0) still lets the clients' inputs in between ticks
+                await asyncio.sleep(max(0.0, delay))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("level", nargs="?", default=DEFAULT_LEVEL, help="the level file to host")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--tick-rate", type=int, default=FPS, help="simulation ticks per second")
+    parser.add_argument("--stats", type=float, default=5, help="seconds between tick time reports, 0 for none")
+    args = parser.parse_args()
+
+    init_headless()
+    server = Server(Arena(args.level, fps=args.tick_rate), args.host, args.port, args.tick_rate)
+    try:
+        asyncio.run(server.run(args.stats))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
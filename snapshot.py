@@ -0,0 +1,148 @@
+'''Compact snapshots of the game state.
+
+The state of a World lives in pygame Sprites holding Rects, Surfaces and
+Masks, which are slow to deep-copy and far bigger than the handful of numbers
+that actually change. A Snapshotter packs those numbers into one fixed-layout
+bytes object with a precompiled struct: the animation frames are stored as
+indices into the player's and the traps' sprite sheets instead of the
+surfaces themselves. Taking or restoring a snapshot is a single pack or
+unpack, cheap enough to do every tick, and the snapshots are immutable,
+hashable and picklable, so they can be used as dictionary keys or sent to
+other processes.
+'''
+import struct
+from hashlib import blake2b
+
+from classes import Player
+
+
+# tick, won
+WORLD = "I?"
+# whether the world streams its level, and the chunk (column, row) its LevelStream is loaded around
+STREAM = "?ii"
+# rect x, y, width, height, x_vel, y_vel, frame (-1 for none), direction (0 is
+# left), animation_count, fall_count, jump_count, hit, hit_count, current_health
+PLAYER = "iiHHidhBIIB?Ib"
+# rect width, height, animation name, frame, animation_count
+TRAP = "HHBBI"
+# where the traps start in a snapshot, everything before is the world and the player
+TRAPS_START = struct.calcsize("<" + WORLD + STREAM + PLAYER)
+
+DIRECTIONS = ("left", "right")
+
+
+def player_frame_table():
+    ''' The player's animation frames in a fixed order, the same in every
+    process, so a frame can be sent or stored as its index'''
+    sprites = Player.load_sprites()
+    return [frame for name in sorted(sprites) for frame in sprites[name]]
+
+
+def trap_key(trap):
+    ''' What identifies a trap: its entity in the level file when it was
+    streamed from one (a chunk that loads again makes a new object for it),
+    the object itself otherwise'''
+    return ("entity", trap.entity_id) if trap.entity_id is not None else ("object", id(trap))
+
+
+class Snapshotter:
+    '''Snapshots and restores one World.
+
+    The layout depends on the traps, so a Snapshotter is made for a World
+    and only used with it. The state of every trap is stored in the slot of
+    that trap (see trap_key), and snapshot() and restore() raise ValueError
+    when the world's traps are no longer the ones the Snapshotter was made
+    for. A World streamed from a level file keeps its traps only while their
+    chunks are loaded, so either keep every chunk loaded (see
+    solver.level_world) or only snapshot while the same chunks are. The
+    snapshot also records which chunks were loaded, and restore() streams
+    them back in, so the map around a restored player is the one it had.
+    '''
+
+    __slots__ = ("layout", "size", "player_frames", "frame_ids", "trap_slots", "trap_sheets", "trap_names",
+                 "trap_frames")
+
+    def __init__(self, world):
+        self.layout = struct.Struct("<" + WORLD + STREAM + PLAYER + TRAP * len(world.traps))
+        self.size = self.layout.size
+
+        # the player's frames in a fixed order; the id() of the shared Frame
+        # objects finds the index of the current one
+        self.player_frames = player_frame_table()
+        self.frame_ids = {id(frame): i for i, frame in enumerate(self.player_frames)}
+
+        # every trap keeps its own sheet dictionary, but the frames in it are
+        # shared. A trap only remembers the image it shows, so look frames up by that
+        self.trap_slots = {}
+        self.trap_sheets = []
+        self.trap_names = []
+        self.trap_frames = []
+        for slot, trap in enumerate(world.traps):
+            self.trap_slots[trap_key(trap)] = slot
+            names = sorted(trap.fire)
+            self.trap_sheets.append([(name, trap.fire[name]) for name in names])
+            self.trap_names.append({name: i for i, name in enumerate(names)})
+            self.trap_frames.append({id(frame.image): i for name in names for i, frame in enumerate(trap.fire[name])})
+
+    def slots(self, world):
+        ''' Returns (slot, trap) for every trap of the world, in slot order.
+        Raises ValueError when they aren't the traps this Snapshotter is for'''
+        traps = sorted(((self.trap_slots.get(trap_key(trap), -1), trap) for trap in world.traps),
+                       key=lambda pair: pair[0])
+        if len(traps) != len(self.trap_slots) or any(slot != i for i, (slot, _) in enumerate(traps)):
+            raise ValueError(f"the world has {len(world.traps)} traps that don't match the "
+                             f"{len(self.trap_slots)} this Snapshotter was made for")
+        return traps
+
+    def snapshot(self, world):
+        ''' Returns the state of the world as bytes'''
+        p = world.player
+        rect = p.rect
+        frame = -1 if p.frame is None else self.frame_ids[id(p.frame)]
+        center = world.level.center if world.level is not None else None
+        values = [world.tick, world.won, center is not None, *(center or (0, 0)),
+                  rect.x, rect.y, rect.width, rect.height, p.x_vel, p.y_vel, frame,
+                  p.direction == "right", p.animation_count, p.fall_count, p.jump_count,
+                  p.hit, p.hit_count, p.current_health]
+        for slot, trap in self.slots(world):
+            values += (trap.rect.width, trap.rect.height, self.trap_names[slot][trap.animation_name],
+                       self.trap_frames[slot][id(trap.image)], trap.animation_count)
+        return self.layout.pack(*values)
+
+    def restore(self, world, data):
+        ''' Puts the world back in the state a snapshot was taken in'''
+        values = self.layout.unpack(data)
+        p = world.player
+        (world.tick, world.won, streamed, column, row, x, y, width, height, p.x_vel, p.y_vel, frame, right,
+         p.animation_count, p.fall_count, p.jump_count, p.hit, p.hit_count, p.current_health) = values[:19]
+        p.rect.update(x, y, width, height)
+        p.direction = DIRECTIONS[right]
+        if frame < 0:
+            p.frame = p.mask = None
+        else:
+            p.frame = self.player_frames[frame]
+            p.sprite = p.frame.image
+            p.mask = p.frame.mask
+
+        # load the chunks that were loaded, which also brings back their traps
+        level = world.level
+        if streamed and level is not None and level.center != (column, row):
+            size = level.chunk_pixels
+            if level.update(level.origin[0] + column * size, level.origin[1] + row * size):
+                world.map_changed = True
+
+        for slot, trap in self.slots(world):
+            width, height, name, frame, trap.animation_count = values[19 + slot * 5:24 + slot * 5]
+            trap.rect.size = (width, height)
+            trap.animation_name, frames = self.trap_sheets[slot][name]
+            trap.image = frames[frame].image
+            trap.mask = frames[frame].mask
+            # a trap that was never animated still has its initial size, and its first frame resizes it
+            trap.frame_key = (trap.animation_name, frame) if trap.rect.size == frames[frame].rect.size else None
+            world.objects.update(trap)  # the size may have changed, re-file it
+
+
+def state_hash(data):
+    '''A 64 bit hash of a snapshot. Unlike hash() it is the same in every
+    process and every run, so hashes from replays can be compared'''
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "little")
@@ -0,0 +1,380 @@
+'''Checks that a map can be completed.
+
+The solver plays the map with the real World/Player/handle_move rules and
+searches the player's states with A*, preferring states close to (and level
+with) the flag. It returns either a witness, the Inputs that reach the flag,
+or, when every state it can get to has been explored without touching the
+flag, a proof that the map cannot be completed. Example:
+
+    python solver.py levels/default.jql other_map.jql --processes 8
+
+Before searching, the solver checks a cheap bound: climbing from surface to
+surface with the highest double jump the physics allow, ignoring walls and
+horizontal distance. A flag above everything that bound can reach is proven
+unreachable without any search. Otherwise the search decides, and three
+things keep it small:
+
+* the player picks one of six inputs (nothing, left or right, each with or
+  without a jump) and holds it for `hold` ticks,
+* states are merged when they agree on the position rounded to `resolution`
+  pixels, the rounded vertical speed, the jump counter, the hit
+  state and the health. With --resolution 0 they are only merged when
+  everything that decides the future is the same (see exact_key),
+* nothing is searched past `max_ticks`.
+
+The merge and the tick limit both throw states away, so a search that
+used either of them and still found no witness is only "undecided". The
+search only proves a map unreachable when it explored every exact state
+its moves lead to, and the proof is with respect to those moves.
+
+A witness is always replayed on a fresh World before it is returned, so a
+"reachable" answer does not depend on any of this.
+'''
+import argparse
+import heapq
+import math
+import multiprocessing
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from itertools import count
+
+from utils import FPS, PLAYER_VEL, init_headless, pixel_steps
+from classes import Player, Flag
+from world import Input, build_default_level, encode_inputs
+from levels import DEFAULT_LEVEL, load_world
+from snapshot import Snapshotter
+
+
+# the inputs the solver chooses from. A jump is only pressed on the first tick
+# of a move, like tapping the key while holding the arrow
+MOVES = (Input(), Input(left=True), Input(right=True),
+         Input(jump=True), Input(left=True, jump=True), Input(right=True, jump=True))
+
+# reachable is True (inputs is the witness), False (proof says why) or None
+# (undecided, proof says what cut the search short)
+Solution = namedtuple("Solution", ["reachable", "inputs", "expanded", "seconds", "proof"])
+
+
+def level_world(path):
+    ''' Opens a level file with every chunk loaded, so stepping never streams'''
+    # a radius larger than any level keeps all of its chunks alive
+    return load_world(path, radius=1 << 20)
+
+
+def state_key(world, resolution):
+    ''' The key states are merged on, see the module docstring'''
+    p = world.player
+    return (p.rect.x // resolution, p.rect.y // resolution, round(p.y_vel), p.jump_count,
+            p.hit, p.current_health)
+
+
+class ExactKey:
+    '''Everything about a World that decides how it plays on from here.
+
+    That is the whole player and the phase of the traps' animations, which
+    follow from the tick (see traps.TrapManager). The counters that only
+    grow are cut down to what can still make a difference: the animation
+    count picks the sprite (and so the mask) modulo the length of every
+    sheet, and the fall count stops adding to the gravity once
+    fall_count / fps * GRAVITY reaches 1.
+    '''
+
+    def __init__(self, world):
+        # the animations and utils.run_speed go by ticks at FPS, so at another
+        # rate they repeat after a multiple of this many of the world's ticks
+        ticks = world.fps // math.gcd(world.fps, FPS)
+        self.trap_period = ticks
+        for trap in world.traps:
+            self.trap_period = math.lcm(self.trap_period, trap.period() * ticks)
+        sheets = world.player.load_sprites().values()
+        self.animation_period = Player.ANIMATION_DELAY * math.lcm(*(len(frames) for frames in sheets)) * ticks
+        self.fall_limit = math.ceil(world.fps / Player.GRAVITY)
+
+    def __call__(self, world):
+        p = world.player
+        return (world.tick % self.trap_period, world.won, tuple(p.rect), p.x_vel, p.y_vel, id(p.frame),
+                p.direction, p.animation_count % self.animation_period, min(p.fall_count, self.fall_limit),
+                p.jump_count, p.hit, p.hit_count if p.hit else 0, p.current_health)
+
+
+def max_rise(fps, gravity=Player.GRAVITY):
+    ''' The most pixels a double jump can lift the player, over every timing of the second jump'''
+    best = 0
+    scale = FPS / fps
+    for second in range(1, fps * 4):
+        y, y_vel, fall_count = 0, 0, 0
+        for tick in range(fps * 8):
+            if tick in (0, second):
+                y_vel = -gravity * 8 * scale
+                if tick == 0:
+                    fall_count = 0  # only the first jump cancels the gravity gathered so far
+            y_vel += min(1, (fall_count / fps) * gravity) * scale * scale
+            fall_count += 1
+            y += pixel_steps(y, y_vel)
+            best = min(best, y)
+            if y_vel > 0 and tick > second:
+                break
+    return -best
+
+
+def highest_reach(world):
+    '''An upper bound on how high the player's rect can ever get: the smallest
+    rect.top it can reach.
+
+    Starting from the spawn, any surface (the top of any object) no higher
+    than the highest jump from a reached standing height counts as reached, and
+    standing on it (or being popped out onto it) puts the player's top at most
+    one frame height above it. Walls, horizontal distances and the timing of
+    the jumps are ignored, which only makes the bound higher.
+    '''
+    player = world.player
+    rise = max_rise(world.fps)
+    height = max(frame.rect.height for frames in player.load_sprites().values() for frame in frames)
+    best = player.rect.top
+    # from the lowest surface up; once one is out of reach, so are the ones above it
+    for top in sorted({obj.rect.top for obj in world.objects}, reverse=True):
+        if top < best - rise:
+            break
+        best = min(best, top - height)
+    return best - rise
+
+
+def distance_to_flag(world, flag):
+    '''A lower bound on the ticks left before the player can touch the flag:
+    the horizontal gap at PLAYER_VEL, or the height still to climb at the
+    speed of a jump, whichever is larger'''
+    rect = world.player.rect
+    dx = max(flag.left - rect.right, rect.left - flag.right, 0)
+    dy = max(rect.top - flag.bottom, 0)
+    scale = FPS / world.fps  # the speeds are per tick at FPS
+    return max(dx / (PLAYER_VEL * scale), dy / (world.player.GRAVITY * 8 * scale))
+
+
+def play(world, moves, hold):
+    ''' Steps the world through a list of moves, each held for hold ticks'''
+    for move in moves:
+        world.run([move] + [move._replace(jump=False)] * (hold - 1))
+        if world.won:
+            break
+
+
+def moves_to_inputs(moves, hold):
+    return [tick for move in moves for tick in [move] + [move._replace(jump=False)] * (hold - 1)]
+
+
+def search(make_world, prefix=(), max_ticks=3000, hold=4, resolution=8, max_nodes=200000, weight=2.0, stop=None):
+    '''A* from the state reached by playing prefix (a list of moves).
+
+    Returns (reachable, moves, expanded, why). The priority is the ticks
+    played so far plus weight times distance_to_flag; a weight above 1 finds
+    a witness much faster at the price of it not being the shortest one.
+    reachable is only False when the search was exhaustive over exact states,
+    see the module docstring; otherwise a failed search returns None and why
+    says what cut it short.
+    resolution: pixels per position step in the merge key, 0 to merge exact states only
+    stop: an optional multiprocessing Event, set when another shard succeeded
+    '''
+    world = make_world()
+    flags = [obj.rect for obj in world.objects if isinstance(obj, Flag)]
+    if not flags:
+        return False, None, 0, "the map has no flag"
+    flag = flags[0]
+    # nothing is below the lowest object, so a player under it falls forever
+    floor = max(obj.rect.bottom for obj in world.objects)
+
+    play(world, prefix, hold)
+    if world.won:
+        return True, list(prefix), 0, None
+
+    exact_key = ExactKey(world)
+    if resolution:
+        key_of = partial(state_key, resolution=resolution)
+    else:
+        key_of = exact_key
+    snapshots = Snapshotter(world)
+    start = snapshots.snapshot(world)
+    key = key_of(world)
+    parents = {key: None}
+    # the exact state each key stands for, to tell when a merge lost something
+    merged_into = {key: exact_key(world)}
+    tie = count()  # keeps the heap from ever comparing states
+    frontier = [(0, next(tie), start, key, len(prefix) * hold)]
+    expanded = 0
+    cut_short = set()  # what kept the search from being exhaustive
+
+    while frontier:
+        if expanded >= max_nodes:
+            return None, None, expanded, f"gave up after {max_nodes} states"
+        if stop is not None and expanded % 256 == 0 and stop.is_set():
+            return None, None, expanded, "stopped"
+        _, _, state, key, ticks = heapq.heappop(frontier)
+        expanded += 1
+        if ticks + hold > max_ticks:
+            cut_short.add(f"states past {max_ticks} ticks were not searched")
+            continue
+
+        for move in MOVES:
+            snapshots.restore(world, state)
+            play(world, [move], hold)
+            if world.won:
+                moves = [move]
+                while key is not None:
+                    parent = parents[key]
+                    if parent is None:
+                        break
+                    key, parent_move = parent
+                    moves.append(parent_move)
+                return True, list(prefix) + moves[::-1], expanded, None
+
+            # falling past the lowest object never ends, so that branch is dead
+            if world.player.rect.top > floor:
+                continue
+            child_key = key_of(world)
+            if child_key in parents:
+                if resolution and merged_into[child_key] != exact_key(world):
+                    cut_short.add(f"states that differ by less than {resolution} pixels were merged")
+                continue
+            parents[child_key] = (key, move)
+            if resolution:
+                merged_into[child_key] = exact_key(world)
+            priority = ticks + hold + weight * distance_to_flag(world, flag)
+            heapq.heappush(frontier, (priority, next(tie), snapshots.snapshot(world), child_key, ticks + hold))
+
+    if cut_short:
+        return None, None, expanded, ", ".join(sorted(cut_short))
+    return False, None, expanded, None
+
+
+_stop = None  # the Event of the solve() a worker process serves
+
+
+def _init_worker(stop):
+    global _stop
+    _stop = stop
+    # the sprites need a display mode, even one nobody sees
+    init_headless()
+
+def _search_shard(make_world, prefix, options):
+    return search(make_world, prefix, stop=_stop, **options)
+
+
+def solve(make_world, processes=1, **options):
+    '''Decides whether the World returned by make_world can be completed.
+
+    make_world: a picklable callable returning a fresh World, for example
+        world.build_default_level or partial(level_world, path)
+    processes: with more than one, the first moves are split between worker
+        processes, each searching its own part of the tree with its own visited
+        states. The shards race for a witness, which helps on big maps, but
+        states shared between shards are explored more than once, so proving
+        a map unreachable costs more in total. To check many maps, give each
+        its own process with solve_levels instead
+    options: passed on to search()
+    Returns a Solution whose witness has been replayed on a fresh World.
+    '''
+    started = time.perf_counter()
+    hold = options.get("hold", 4)
+
+    world = make_world()
+    flags = [obj.rect for obj in world.objects if isinstance(obj, Flag)]
+    if not flags:
+        return Solution(False, None, 0, time.perf_counter() - started, "the map has no flag")
+    reach = highest_reach(world)
+    if all(flag.bottom <= reach for flag in flags):
+        return Solution(False, None, 0, time.perf_counter() - started,
+                        f"the flag's bottom (y={max(flag.bottom for flag in flags)}) is above the highest "
+                        f"point the player can reach (y={reach})")
+
+    if processes <= 1:
+        reachable, moves, expanded, why = search(make_world, **options)
+    else:
+        # one shard per sequence of first moves, enough of them to keep every process busy
+        shards = [()]
+        while len(shards) < processes:
+            shards = [shard + (move,) for shard in shards for move in MOVES]
+        stop = multiprocessing.Event()
+        reachable, moves, expanded, why = False, None, 0, None
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(stop,)) as pool:
+            pending = {pool.submit(_search_shard, make_world, shard, options) for shard in shards}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard_reachable, shard_moves, shard_expanded, shard_why = future.result()
+                    expanded += shard_expanded
+                    if shard_reachable and not reachable:
+                        reachable, moves = True, shard_moves
+                        stop.set()
+                    elif shard_reachable is None and not reachable:
+                        reachable, why = None, why or shard_why
+
+    inputs = None
+    proof = why
+    if reachable is False:
+        proof = f"all {expanded} exact states reachable with inputs held for {hold} ticks were explored"
+    if reachable:
+        inputs = moves_to_inputs(moves, hold)
+        world = make_world()
+        world.run(inputs)
+        if not world.won:
+            raise RuntimeError("the witness found by the solver does not reach the flag when replayed")
+        inputs = inputs[:world.tick]
+    return Solution(reachable, inputs, expanded, time.perf_counter() - started, proof)
+
+
+def _solve_level(path, options):
+    return path, solve(partial(level_world, path), **options)
+
+def solve_levels(paths, processes=None, **options):
+    '''Solves many level files, one per worker process.
+    Yields (path, Solution) pairs as they finish'''
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(None,)) as pool:
+        futures = [pool.submit(_solve_level, path, options) for path in paths]
+        for future in futures:
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("levels", nargs="*", default=[DEFAULT_LEVEL], help="level files to check")
+    parser.add_argument("--code-map", action="store_true", help="check the map built in world.build_default_level instead")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, one per core by default")
+    parser.add_argument("--max-ticks", type=int, default=3000, help="longest witness searched for")
+    parser.add_argument("--max-nodes", type=int, default=200000, help="states expanded per search before giving up")
+    parser.add_argument("--hold", type=int, default=4, help="ticks each input is held")
+    parser.add_argument("--resolution", type=int, default=8,
+                        help="pixels per position step in the state key, 0 to only merge identical states")
+    parser.add_argument("--witness", help="write the witness of the first level as a benchmark.py replay file")
+    args = parser.parse_args()
+
+    options = {"max_ticks": args.max_ticks, "max_nodes": args.max_nodes, "hold": args.hold,
+               "resolution": args.resolution}
+    if args.code_map:
+        init_headless()
+        results = [("world.build_default_level", solve(build_default_level, args.processes or 1, **options))]
+    elif len(args.levels) == 1:
+        init_headless()
+        results = [(args.levels[0], solve(partial(level_world, args.levels[0]), args.processes or 1, **options))]
+    else:
+        results = solve_levels(args.levels, args.processes, **options)
+
+    failed = False
+    for i, (name, solution) in enumerate(results):
+        if solution.reachable:
+            verdict = f"reachable in {len(solution.inputs)} ticks"
+        elif solution.reachable is False:
+            verdict = f"UNREACHABLE, {solution.proof}"
+        else:
+            verdict = f"undecided, {solution.proof}"
+        failed = failed or not solution.reachable
+        print(f"{name}: {verdict} ({solution.expanded} states, {solution.seconds:.1f}s)")
+        if i == 0 and args.witness and solution.reachable:
+            with open(args.witness, "wb") as file:
+                file.write(encode_inputs(solution.inputs))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+from itertools import chain
+
+from tiles import Tile, TileStore
+
+
+class SpatialHash:
+    '''A uniform grid over the level used as a collision broad-phase.
+
+    Every object is filed under each block_size cell its rect touches, so a
+    query only has to look at the few cells around the player instead of
+    scanning the whole map. Objects that move or change size (e.g. the Fire
+    animation) must be passed to update() afterwards so they get re-filed.
+    Iterating over the hash yields the objects other than tiles first, in
+    insertion order, and then the tiles in TileStore order (which removing a
+    tile reshuffles), so it can stand in for the plain list of objects when
+    drawing. Tiles no longer come back where they were added among the other
+    objects: anything drawn in iteration order now draws the tiles over them.
+
+    Static tiles (Blocks) of cell_size that line up with each other are not
+    kept as objects at all: add() turns them into rows of a TileStore, and
+    queries and iteration hand them back as Tile views. Everything else stays
+    an object in the grid.
+    '''
+
+    def __init__(self, cell_size, objects=()):
+        self.cell_size = cell_size
+        self.cells = {}     # (column, row) -> list of objects in that cell
+        self.objects = {}   # object -> the cells it is currently filed under
+        self.tiles = TileStore(cell_size)
+        for obj in objects:
+            self.add(obj)
+
+    def __iter__(self):
+        return chain(self.objects, self.tiles)
+
+    def __len__(self):
+        return len(self.objects) + len(self.tiles)
+
+    def __contains__(self, obj):
+        if obj in self.objects:
+            return True
+        return obj.STATIC_TILE and obj.rect.topleft in self.tiles
+
+    def cells_for(self, rect):
+        ''' Returns the (column, row) keys of every cell the rect touches'''
+        size = self.cell_size
+        # right and bottom are exclusive, hence the - 1
+        return [(column, row)
+                for column in range(rect.left // size, (rect.right - 1) // size + 1)
+                for row in range(rect.top // size, (rect.bottom - 1) // size + 1)]
+
+    def add(self, obj):
+        rect = obj.rect
+        if obj.STATIC_TILE and rect.width == rect.height and self.tiles.fits(rect.x, rect.y, rect.width):
+            self.tiles.add(rect.x, rect.y, obj.kind if isinstance(obj, Tile) else self.tiles.kind_of(obj))
+            return
+        cells = self.cells_for(obj.rect)
+        self.objects[obj] = cells
+        for cell in cells:
+            self.cells.setdefault(cell, []).append(obj)
+
+    def remove(self, obj):
+        if obj not in self.objects and obj.STATIC_TILE:
+            self.tiles.remove(*obj.rect.topleft)
+            return
+        for cell in self.objects.pop(obj):
+            bucket = self.cells[cell]
+            bucket.remove(obj)
+            if not bucket:
+                del self.cells[cell]
+
+    def update(self, obj):
+        ''' Re-files an object after its rect moved or changed size'''
+        if self.cells_for(obj.rect) != self.objects[obj]:
+            self.remove(obj)
+            self.add(obj)
+
+    def query(self, rect, tiles=True):
+        ''' Returns every object whose rect overlaps the given rect.
+        With tiles=False the static tiles are left out'''
+        found = []
+        seen = set()
+        for cell in self.cells_for(rect):
+            for obj in self.cells.get(cell, ()):
+                if obj not in seen:
+                    seen.add(obj)
+                    if rect.colliderect(obj.rect):
+                        found.append(obj)
+        return found + self.tiles.query(rect) if tiles else found
@@ -0,0 +1,45 @@
+'''Tests of recorder.py: python -m pytest test_recorder.py'''
+import threading
+
+from world import Input, NO_INPUT
+from recorder import Recorder, LogReader, Event, Gap, Run, HIT
+
+
+class BlockedFile:
+    '''Stands in for a Recorder's file: writes wait until released, like a stalled disk'''
+
+    def __init__(self, file):
+        self.file = file
+        self.released = threading.Event()
+
+    def write(self, data):
+        self.released.wait()
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def test_event_in_the_tick_of_a_dropped_batch(tmp_path):
+    path = tmp_path / "session.jqr"
+    recorder = Recorder(path, "levels/default.jql", flush_ticks=2, queue_size=1, max_pending=0)
+    blocked = recorder.file = BlockedFile(recorder.file)
+    hits = []
+    for tick in range(12):
+        recorder.tick(Input(False, tick % 3 == 0, False) if tick % 2 else NO_INPUT)
+        # a hit in every tick, so one lands in the tick whose flush drops the buffer
+        recorder.hit(100 - tick)
+        hits.append(Event(tick, HIT, health=100 - tick))
+    assert recorder.lost
+    blocked.released.set()
+    recorder.close()
+
+    records = list(LogReader(path))
+    gaps = [record for record in records if isinstance(record, Gap)]
+    events = [record for record in records if isinstance(record, Event)]
+    assert gaps
+    # every event that wasn't lost is read back at its own tick
+    lost = {tick for gap in gaps for tick in range(gap.tick, gap.tick + gap.ticks)}
+    assert events == [hit for hit in hits if hit.tick not in lost]
+    runs = [record for record in records if isinstance(record, Run)]
+    assert sum(record.ticks for record in gaps + runs) == 12
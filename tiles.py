@@ -0,0 +1,149 @@
+from array import array
+
+import pygame
+
+from asset_cache import Frame
+from utils import get_block
+
+
+# tile kinds. Every tile of a kind shares one image and one mask
+TERRAIN = 1
+
+
+class Tile:
+    '''A lightweight view of one row of a TileStore.
+
+    Queries hand these out so collision and drawing code can treat a tile like
+    any other object (rect, image, mask, name). They are created on demand and
+    compare equal when they refer to the same position.
+    '''
+
+    __slots__ = ("rect", "image", "mask", "kind")
+
+    name = None
+    ANIMATED = False
+    STATIC_TILE = True
+
+    def __init__(self, x, y, size, kind, frame):
+        self.rect = pygame.Rect(x, y, size, size)
+        self.image = frame.image
+        self.mask = frame.mask
+        self.kind = kind
+
+    def __eq__(self, other):
+        return isinstance(other, Tile) and self.rect.topleft == other.rect.topleft
+
+    def __hash__(self):
+        return hash(self.rect.topleft)
+
+    def draw(self, win, offset_x):
+        return win.blit(self.image, (self.rect.x - offset_x, self.rect.y))
+
+
+class TileStore:
+    '''The static tiles of a map as rows of typed arrays.
+
+    A Block is a whole Sprite with a Rect and an instance dictionary, several
+    kilobytes each, when all that differs between two blocks is where they
+    are. Here a tile is an x, a y, a kind and a flags byte in four arrays, plus
+    one entry in the (column, row) index that makes queries a lookup per cell.
+    The tiles sit on a lattice of tile_size cells whose origin is set by the
+    first tile added; fits() tells whether a tile can be stored.
+    '''
+
+    def __init__(self, tile_size):
+        self.tile_size = tile_size
+        self.origin = None
+        self.xs = array("i")
+        self.ys = array("i")
+        self.kinds = array("B")
+        self.flags = array("B")  # per-tile bits, free for tile behaviours
+        self.index = {}          # (column, row) -> row in the arrays
+        self.frames = {}         # kind -> Frame shared by every tile of that kind
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __iter__(self):
+        ''' Yields a Tile for every stored tile'''
+        for i in range(len(self.xs)):
+            yield self.tile(i)
+
+    def frame(self, kind):
+        ''' Returns the Frame drawn for a kind, loading the terrain block on first use'''
+        if kind not in self.frames and kind == TERRAIN:
+            self.frames[kind] = get_block(self.tile_size)
+        return self.frames[kind]
+
+    def kind_of(self, obj):
+        ''' Returns the kind of tile that looks like obj, registering a new kind if needed'''
+        self.frame(TERRAIN)  # Blocks share the cached terrain frame, so it is found first
+        for kind, frame in self.frames.items():
+            if frame.image is obj.image and frame.mask is obj.mask:
+                return kind
+        kind = max(self.frames) + 1
+        self.frames[kind] = Frame(obj.image, obj.mask, obj.image.get_rect())
+        return kind
+
+    def cell(self, x, y):
+        ''' Returns the (column, row) of the lattice cell containing a pixel position'''
+        return ((x - self.origin[0]) // self.tile_size, (y - self.origin[1]) // self.tile_size)
+
+    def fits(self, x, y, size):
+        ''' True when a tile of size at x, y lies on the lattice'''
+        if size != self.tile_size:
+            return False
+        if self.origin is None:
+            return True
+        return (x - self.origin[0]) % size == 0 and (y - self.origin[1]) % size == 0
+
+    def add(self, x, y, kind=TERRAIN, flags=0):
+        ''' Stores a tile, replacing the one already at x, y if there is one'''
+        if self.origin is None:
+            self.origin = (x % self.tile_size, y % self.tile_size)
+        if not self.fits(x, y, self.tile_size):
+            raise ValueError(f"a tile at ({x}, {y}) is not on the {self.tile_size} pixel lattice at {self.origin}")
+        key = self.cell(x, y)
+        if key in self.index:
+            i = self.index[key]
+            self.kinds[i] = kind
+            self.flags[i] = flags
+            return
+        self.index[key] = len(self.xs)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.kinds.append(kind)
+        self.flags.append(flags)
+
+    def remove(self, x, y):
+        ''' Removes the tile at x, y. The last row takes its place, so the arrays stay packed'''
+        i = self.index.pop(self.cell(x, y))
+        last = len(self.xs) - 1
+        if i != last:
+            self.xs[i], self.ys[i] = self.xs[last], self.ys[last]
+            self.kinds[i], self.flags[i] = self.kinds[last], self.flags[last]
+            self.index[self.cell(self.xs[i], self.ys[i])] = i
+        for column in (self.xs, self.ys, self.kinds, self.flags):
+            column.pop()
+
+    def __contains__(self, position):
+        return self.origin is not None and self.cell(*position) in self.index
+
+    def tile(self, i):
+        kind = self.kinds[i]
+        return Tile(self.xs[i], self.ys[i], self.tile_size, kind, self.frame(kind))
+
+    def query(self, rect):
+        ''' Returns a Tile for every tile overlapping the given rect'''
+        if self.origin is None or rect.width <= 0 or rect.height <= 0:
+            return []
+        left, top = self.cell(rect.left, rect.top)
+        right, bottom = self.cell(rect.right - 1, rect.bottom - 1)
+        index = self.index
+        found = []
+        for column in range(left, right + 1):
+            for row in range(top, bottom + 1):
+                i = index.get((column, row))
+                if i is not None:
+                    found.append(self.tile(i))
+        return found
@@ -0,0 +1,81 @@
+from utils import FPS
+
+
+class TrapManager:
+    '''Animates the traps of a World from the world's tick.
+
+    Fire.loop keeps a counter per trap and swaps the image, rect and mask on
+    every call, whether anybody can see the trap or not. The manager instead
+    works out each trap's animation count from the shared tick (a trap's
+    animation repeats every trap.period() ticks, so the count is just the
+    tick modulo the period), and only touches the traps that matter:
+
+    * traps near the player, which the collision code may look at, and
+    * traps in the view, the camera rect game.main sets every frame.
+
+    The others sleep. Since the frame is derived from the tick rather than
+    counted, a trap that wakes up shows exactly the frame it would have shown
+    had it been animated all along, so sleeping never changes the game.
+    Fire.show only swaps the image and mask when the frame actually changes.
+
+    The manager behaves like the list of traps it replaces: append, remove,
+    iterate and len all work on the traps it manages.
+    '''
+
+    def __init__(self, traps=(), wake_margin=192):
+        self.traps = list(traps)
+        self.wake_margin = wake_margin  # pixels around the player within which traps are awake
+        self.view = None                # the part of the map on screen, if anything draws it
+        self.awake = 0                  # traps animated by the last update
+
+    def __iter__(self):
+        return iter(self.traps)
+
+    def __len__(self):
+        return len(self.traps)
+
+    def append(self, trap):
+        self.traps.append(trap)
+
+    def remove(self, trap):
+        self.traps.remove(trap)
+
+    def wake_areas(self, player):
+        ''' The areas whose traps are animated this tick'''
+        # stretch the area by the player's speed, so even a fast fall only
+        # sweeps into traps that are awake
+        margin = self.wake_margin
+        reach = abs(int(player.y_vel)) + 1
+        areas = [player.rect.inflate(2 * margin, 2 * (margin + reach))]
+        if self.view is not None:
+            areas.append(self.view)
+        return areas
+
+    def update(self, tick, player, objects, fps=FPS):
+        ''' Brings the awake traps to the frame of tick.
+        objects is the World's SpatialHash, which the traps are filed in.
+        fps: the ticks a second of the World. The animations are written per
+        tick at FPS, so at another rate tick is converted to FPS ticks first'''
+        tick = tick * FPS // fps
+        if hasattr(objects, "query"):
+            nearby = [obj for area in self.wake_areas(player)
+                      for obj in objects.query(area, tiles=False) if obj.ANIMATED]
+        else:
+            areas = self.wake_areas(player)
+            nearby = [trap for trap in self.traps if any(area.colliderect(trap.rect) for area in areas)]
+
+        seen = set()
+        for trap in nearby:
+            if trap in seen:
+                continue
+            seen.add(trap)
+            size = trap.rect.size
+            period = trap.period()
+            count = tick % period
+            trap.show(count)
+            # keep the trap's own counter where loop() would have left it
+            trap.animation_count = (count + 1) % period
+            if trap.rect.size != size and hasattr(objects, "update"):
+                objects.update(trap)  # a bigger frame can reach into other cells
+        self.awake = len(seen)
+
@@ -1,20 +1,33 @@
+import os
 import pygame
 from os import listdir
 from os.path import isfile, join
 
+from asset_cache import ASSETS
+
 
 ## define global variables
 # background colour in RGB
 BG_COLOUR = (255, 255, 255)
 # game window size
 WIDTH, HEIGHT = 1000, 800
-# frames per second for the game
+# frames per second for the game. The game's rules are written per tick at this
+# rate; a World stepped at another rate scales them (see Player.loop)
 FPS = 60
-# player movespeed, defined in pixels per second
+# player movespeed, defined in pixels per tick at FPS
 PLAYER_VEL = 5
 
-# creates the game window using pygame module
-window = pygame.display.set_mode((WIDTH, HEIGHT))
+
+def init_headless(size=(1, 1)):
+    '''Initializes pygame without a visible window, for tools that step the World.
+    Converting the sprites for blitting needs a display mode, so a (by default
+    tiny) one is opened on SDL's dummy video driver. Returns that surface.
+    Importing the game modules never opens a window by itself.
+    '''
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.init()
+    return pygame.display.set_mode(size)
 
 def flip(sprites):
 
@@ -26,48 +39,45 @@ def flip(sprites):
 
 def load_sprite_sheets(dir1, dir2, width, height, direction=False): # so we can load other images that aren't our main character
 
-    '''
+    '''Slices every sprite sheet in assets/dir1/dir2 into animation frames.
+    Returns a dictionary mapping each animation name to a list of Frames, so the
+    masks are built here once instead of every tick by the sprites using them.
+    The frames come from the shared asset cache, so calling this again for
+    another sprite of the same kind does not decode anything.
     '''
     path = join("assets", dir1, dir2)
-    images = [f for f in listdir(path) if isfile(join(path,f))]
+    images = ASSETS.listdir(path)
 
     all_sprites = {}
 
     for image in images:
-        sprite_sheet = pygame.image.load(join(path, image)).convert_alpha() # convert_alpha sets background transparent
+        sprite_path = join(path, image)
+        sheet_width, _ = ASSETS.image_size(sprite_path)
 
-    # now we need to get all the sprites in the sprite sheet
-        sprites = []
-        
-        for i in range(sprite_sheet.get_width() // width):
-            # Creates a surface that is the size of our intended animation frame, and 'blits' it onto the surface
-            # We grab the animation picture, and then draw it onto this surface, then we export the surface
-            surface = pygame.Surface((width, height), pygame.SRCALPHA, 32) # load transparent images, 32 is depth
-            rect = pygame.Rect(i * width, 0, width, height)
-            surface.blit(sprite_sheet, (0,0), rect)
-            sprites.append(pygame.transform.scale2x(surface)) # we double the animations in size
+        # now we need to get all the sprites in the sprite sheet.
+        # Each one is cut out of the sheet and doubled in size with scale2x
+        regions = [(i * width, 0, width, height) for i in range(sheet_width // width)]
 
         # if we want a multi-directional animation, then we need to add two keys to our dictionary
         # for every one of our animations
         if direction:
-            all_sprites[image.replace(".png", "") + "_right"] = sprites
-            all_sprites[image.replace(".png", "") + "_left"] = flip(sprites)
+            all_sprites[image.replace(".png", "") + "_right"] = [ASSETS.frame(sprite_path, region, 2) for region in regions]
+            all_sprites[image.replace(".png", "") + "_left"] = [ASSETS.frame(sprite_path, region, 2, flip=True) for region in regions]
 
         else:
-            all_sprites[image.replace(".png", "")] = sprites
+            all_sprites[image.replace(".png", "")] = [ASSETS.frame(sprite_path, region, 2) for region in regions]
 
     return all_sprites
 
 def get_block(size):
+    '''Returns the shared Frame for a terrain block of the given size'''
     path = join("assets", "Terrain", "Terrain.png")
-    image = pygame.image.load(path).convert_alpha()
-    surface = pygame.Surface((size,size), pygame.SRCALPHA, 32)
 
     # (96, 0) for the green block in the png
     # (96, 64) for the red block
-    rect = pygame.Rect(96, 64, size, size) # 96,0 gives the pixel coordinates of the top left hand of block in the terrain png
-    surface.blit(image, (0, 0), rect)
-    return pygame.transform.scale2x(surface)
+    # 96,64 gives the pixel coordinates of the top left hand of block in the terrain png.
+    # The region is doubled with scale2x and cropped back down to the block size
+    return ASSETS.frame(path, (96, 64, size, size), 2, crop=(size, size))
 
 def get_background(name):
     """This function generates a background for the game
@@ -97,56 +107,132 @@ def get_background(name):
 
     return tiles, image
 
-def draw(window, background, bg_image, player, objects, offset_x):
-    """Function for drawing the background itself"""
-
-    # loops through every tile we have and draw the tile
-    # at that position, which will fill the screen with tiles
-    for tile in background:
-        window.blit(bg_image, tile)
+def compose_background(name):
+    """Blits the background tiles once into a single screen-sized surface,
+    converted to the display format, so a frame only needs one blit for it.
 
-    for obj in objects:
-        obj.draw(window, offset_x)
-
-    player.draw(window, offset_x)
-
-    pygame.display.update()
+    name: capitalised colour of background, corresponds to PNG name
+    """
+    tiles, image = get_background(name)
+    image = image.convert()
+    surface = pygame.Surface((WIDTH, HEIGHT)).convert()
+    for tile in tiles:
+        surface.blit(image, tile)
+    return surface
+
+def get_candidates(objects, rect):
+    '''Returns the objects whose rect overlaps the given rect.
+    objects can be a SpatialHash, which only looks at the cells around the rect,
+    or a plain list, which falls back to checking every rect.
+    '''
+    if hasattr(objects, "query"):
+        return objects.query(rect)
+    return [obj for obj in objects if rect.colliderect(obj.rect)]
+
+def pixel_steps(position, delta):
+    '''Returns how many whole pixels a rect coordinate at position moves when
+    delta is added to it. pygame rounds float coordinates half away from zero,
+    so a velocity of 0.4 does not move the rect at all while 0.5 moves it a pixel'''
+    target = position + delta
+    target = int(target + 0.5) if target >= 0 else -int(0.5 - target)
+    return target - position
+
+def overlap_steps(start, end, other_start, other_end, direction):
+    '''Returns the first and last step at which the span [start, end) moving
+    one pixel per step in direction (1 or -1) overlaps [other_start, other_end)'''
+    if direction > 0:
+        return other_start - end + 1, other_end - start - 1
+    return start - other_end + 1, end - other_start - 1
+
+def is_ahead(rect, other, step_x, step_y):
+    '''True when other lies past the centre of rect in the direction of motion'''
+    if step_x:
+        return (other.centerx - rect.centerx) * step_x > 0
+    return (other.centery - rect.centery) * step_y > 0
+
+def sweep(player, objects, dx, dy):
+    '''Sweeps the player's mask along one axis to find the exact contact point.
+
+    dx, dy: the whole pixels to move, one of them has to be 0
+    Returns (distance, hits): how many pixels the player can move before its mask
+    touches something, and the objects it touches there (empty if the way is clear).
+    The player is neither moved nor re-masked, and every pixel along the way is
+    checked, so even a very fast fall cannot tunnel through a block.
+    '''
+    rect = player.rect
+    mask = player.mask
+    distance = abs(dx or dy)
+    step_x = (dx > 0) - (dx < 0)
+    step_y = (dy > 0) - (dy < 0)
+
+    contact = distance + 1  # the first step at which the masks overlap
+    hits = []
+    # the candidates are the objects touching the area swept by the player's rect
+    area = pygame.Rect(rect.x + min(dx, 0), rect.y + min(dy, 0), rect.width + abs(dx), rect.height + abs(dy))
+    for obj in get_candidates(objects, area):
+        other = obj.rect
+        # only the steps where the rects overlap can have overlapping masks
+        if step_x:
+            first, last = overlap_steps(rect.left, rect.right, other.left, other.right, step_x)
+        elif step_y:
+            first, last = overlap_steps(rect.top, rect.bottom, other.top, other.bottom, step_y)
+        else:
+            first, last = 0, 0
+
+        for step in range(max(first, 0), min(last, contact, distance) + 1):
+            offset = (other.x - rect.x - step * step_x, other.y - rect.y - step * step_y)
+            if mask.overlap(obj.mask, offset):
+                if step == 0 and distance and not is_ahead(rect, other, step_x, step_y):
+                    break  # already overlapping, but moving away from it
+                if step < contact:
+                    contact = step
+                    hits = [obj]
+                else:
+                    hits.append(obj)
+                break
+
+    if not hits:
+        return distance, hits
+    return max(contact - 1, 0), hits
 
 def handle_vertical_collision(player, objects, dy):
 
-    '''This prevents the character from falling through blocks, and enables walking on them'''
-    collided_objects = []
-    for obj in objects:
+    '''This moves the player dy pixels vertically, stopping exactly where it
+    touches a block. This prevents the character from falling through blocks,
+    and enables walking on them'''
+    rect = player.rect
+    # a new animation frame can poke into the block the player stands on (or
+    # the one above). Pop the player back out onto the block's edge first
+    for obj in get_candidates(objects, rect):
         if pygame.sprite.collide_mask(player, obj):
-            if dy > 0:
-                player.rect.bottom = obj.rect.top
-                player.landed()
-            elif dy < 0:
-                player.rect.top = obj.rect.bottom
-                player.hit_head()
+            if obj.rect.top >= rect.centery:
+                rect.bottom = obj.rect.top
+            elif obj.rect.bottom <= rect.centery:
+                rect.top = obj.rect.bottom
 
-            collided_objects.append(obj)
+    steps = pixel_steps(rect.y, dy)
+    distance, collided_objects = sweep(player, objects, 0, steps)
+    rect.y += distance if steps >= 0 else -distance
+
+    if collided_objects:
+        if dy > 0:
+            player.landed()
+        elif dy < 0:
+            player.hit_head()
 
     return collided_objects
 
 
 def collide(player, objects, dx):
-    ''' This function is required to handle the edge case where the player Sprite
-    instantly pops up a adjacent block due to a gravity-contact glitch
+    ''' Returns the first object the player would touch moving dx pixels
+    horizontally, or None if the way is clear
     '''
-    player.move(dx, 0) # starts by moving my player
-    player.update() # need to update the rectangle in the mask
-    collided_object = None 
-    for obj in objects:
-        if pygame.sprite.collide_mask(player, obj):
-            collided_object = obj
-            break
-    player.move(-dx, 0)
-    player.update()
-    return collided_object
+    _, hits = sweep(player, objects, dx, 0)
+    return hits[0] if hits else None
 
 def show_victory_screen():
     """Displays a victory message and waits before exiting."""
+    window = pygame.display.get_surface()
     font = pygame.font.Font(None, 64)
     victory_text = font.render("You Win!", True, (0, 255, 0))  # Green victory text
     window.fill((0, 0, 0))  # Clear the screen with black
@@ -155,34 +241,50 @@ def show_victory_screen():
     pygame.time.delay(3000)  # Wait for 3 seconds
 
 
-def handle_move(player, objects):
+def run_speed(tick, fps=FPS):
+    ''' The whole pixels the player runs on a tick at fps ticks a second.
+    That's PLAYER_VEL * FPS / fps, which needn't be whole, so the pixels are
+    spread over the ticks: at 120 ticks a second it alternates between 2 and 3'''
+    return ((tick + 1) * PLAYER_VEL * FPS) // fps - (tick * PLAYER_VEL * FPS) // fps
+
+
+def handle_move(player, objects, inputs=None, speed=PLAYER_VEL):
 
     ''' This function handles both movements and collisions 
+    inputs: an object with left and right flags (see world.Input). When it is
+    None the keyboard is read instead.
+    speed: the pixels to run this tick, see run_speed
+    Returns the objects the player touched, so the caller can check for the flag
     '''
         
-    keys = pygame.key.get_pressed()
+    if inputs is None:
+        keys = pygame.key.get_pressed()
+        left, right = keys[pygame.K_LEFT], keys[pygame.K_RIGHT]
+    else:
+        left, right = inputs.left, inputs.right
     # If we don't set player velocity to 0. Otherwise, the player will continually
     # move left after the left button is pressed. We don't want that.
     player.x_vel = 0
-    collide_left = collide(player, objects, -PLAYER_VEL)
-    collide_right = collide(player, objects, PLAYER_VEL)
-    
-    if keys[pygame.K_LEFT] and not collide_left: # if the player hits the left key
-        player.move_left(PLAYER_VEL)
-    if keys[pygame.K_RIGHT] and not collide_right: # if the player hits the right key
-        player.move_right(PLAYER_VEL)
 
+    # fall (or rise) first, so the sideways checks start from where the player ends up
     vertical_collide = handle_vertical_collision(player, objects, player.y_vel)
-    to_check = [collide_left, collide_right, *vertical_collide]
 
-    for obj in to_check:
+    # find how far the player can go each way before touching something
+    room_left, collide_left = sweep(player, objects, -speed, 0)
+    room_right, collide_right = sweep(player, objects, speed, 0)
+    
+    if left and room_left: # if the player hits the left key
+        player.move_left(room_left)
+    if right and room_right: # if the player hits the right key
+        player.move_right(room_right)
+
+    touched = [*collide_left, *collide_right, *vertical_collide]
+
+    for obj in touched:
 
-        if obj and obj.name == "fire":
+        if obj.name == "fire":
             player.make_hit()
             player.current_health -= 1  # Reduce health by 1
             player.current_health = max(0, player.current_health)  # Prevent negative health
 
-        elif obj and obj.name == "flag": # Victory Condition
-            show_victory_screen()
-            pygame.quit()
-            quit()
+    return touched
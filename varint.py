@@ -0,0 +1,47 @@
+'''Variable-length integers for the binary formats.
+
+An unsigned integer is written 7 bits per byte, lowest bits first, with the
+top bit of every byte but the last set. Small numbers, which is what deltas
+between ticks mostly are, take a single byte. Signed numbers are zigzag
+mapped first (0, -1, 1, -2, ... become 0, 1, 2, 3, ...) so small negative
+numbers stay small too.
+'''
+
+
+def zigzag(n):
+    ''' Maps a signed integer onto an unsigned one'''
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def write_varint(out, n):
+    ''' Appends an unsigned integer to a bytearray'''
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    ''' Reads an unsigned integer from data at pos. Returns (value, position after it).
+    Raises IndexError when data ends in the middle of the number'''
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1  # the common case
+    value = byte & 0x7F
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos + 1
+        shift += 7
+
+def write_signed(out, n):
+    write_varint(out, zigzag(n))
+
+def read_signed(data, pos):
+    value, pos = read_varint(data, pos)
+    return unzigzag(value), pos
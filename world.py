@@ -0,0 +1,166 @@
+import random
+from collections import namedtuple
+
+from utils import HEIGHT, WIDTH, FPS, handle_move, run_speed
+from classes import Player, Block, Fire, Flag
+from spatial import SpatialHash
+from traps import TrapManager
+from profiler import NULL_PROFILER
+
+
+# The input for one simulation step. jump is a key *press* (the KEYDOWN event
+# in game.main), left and right are the keys being held down.
+Input = namedtuple("Input", ["left", "right", "jump"], defaults=(False, False, False))
+
+NO_INPUT = Input()
+
+## An Input packed into one byte, as stored in benchmark replays and session
+## recordings and sent by clients to the server
+LEFT = 1
+RIGHT = 2
+JUMP = 4
+
+# the Input of every byte, so decoding doesn't make a new one per tick
+KEY_INPUTS = tuple(Input(bool(keys & LEFT), bool(keys & RIGHT), bool(keys & JUMP)) for keys in range(8))
+
+
+def input_keys(inputs):
+    ''' Packs one Input into its byte'''
+    return LEFT * bool(inputs.left) | RIGHT * bool(inputs.right) | JUMP * bool(inputs.jump)
+
+def keys_input(keys):
+    ''' Unpacks a byte back into an Input'''
+    return KEY_INPUTS[keys & (LEFT | RIGHT | JUMP)]
+
+def encode_inputs(inputs):
+    ''' Packs a sequence of Inputs into the one byte per tick replay format'''
+    return bytes(input_keys(i) for i in inputs)
+
+def decode_inputs(data):
+    ''' Unpacks replay bytes back into Inputs'''
+    return [keys_input(b) for b in data]
+
+def scripted_inputs(ticks, seed=0):
+    '''A deterministic input script: runs left and right in bursts of random
+    length and jumps (sometimes twice) at random moments'''
+    rng = random.Random(seed)
+    inputs = []
+    direction = RIGHT
+    while len(inputs) < ticks:
+        direction = LEFT if direction == RIGHT else RIGHT
+        for _ in range(rng.randint(30, 120)):
+            jump = rng.random() < 0.03
+            inputs.append(Input(direction == LEFT, direction == RIGHT, jump))
+    return inputs[:ticks]
+
+
+class World:
+    '''The game state and its rules, stepped one tick at a time.
+
+    The world knows nothing about the display, the clock or the keyboard: every
+    step() is driven by an explicit Input. game.main feeds it from the keyboard
+    and draws the result, but it can just as well be stepped as fast as the CPU
+    allows for map validation and regression runs. Loading the sprites still
+    needs a display mode, so headless users call utils.init_headless() first.
+    fps is the ticks a second the world is stepped at. The rules are written
+    for utils.FPS, and scaled to fps so the game plays at the same speed.
+    '''
+
+    def __init__(self, player, objects, traps=(), fps=FPS, block_size=96):
+        self.player = player
+        self.traps = TrapManager(traps)  # animates the traps near the player or on screen
+        # index the map so collisions only check the objects near the player
+        self.objects = objects if isinstance(objects, SpatialHash) else SpatialHash(block_size, objects)
+        self.fps = fps
+        self.tick = 0
+        self.won = False  # set once the player touches the flag
+        self.level = None  # optional LevelStream feeding chunks around the player
+        self.map_changed = False  # True when the last step loaded or retired chunks
+        self.profiler = NULL_PROFILER  # times the player, traps and collision phases
+        self.recorder = None  # optional recorder.Recorder logging the inputs and events
+
+    def attach(self, level):
+        ''' Streams the objects of a levels.LevelStream in around the player'''
+        self.level = level
+        level.world = self
+        level.update(*self.player.rect.center)
+
+    def step(self, inputs=NO_INPUT):
+        ''' Advances the game by one tick and returns the objects the player touched'''
+        player = self.player
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.tick(inputs)
+        if self.level is not None:
+            self.map_changed = self.level.update(*player.rect.center)
+
+        if inputs.jump and player.jump_count < 2:
+            player.jump(self.fps)
+
+        # call the player loop function. This is the one that actually moves the player
+        player.loop(self.fps)
+        self.profiler.mark("player")
+
+        # animates the traps that are near the player or on screen, the rest sleep
+        self.traps.update(self.tick, player, self.objects, self.fps)
+        self.profiler.mark("traps")
+
+        health = player.current_health
+        touched = handle_move(player, self.objects, inputs, run_speed(self.tick, self.fps))
+        self.profiler.mark("collision")
+        if recorder is not None and player.current_health < health:
+            recorder.hit(player.current_health)
+        if any(obj.name == "flag" for obj in touched): # Victory Condition
+            if recorder is not None and not self.won:
+                recorder.flag()
+            self.won = True
+
+        # Reset the player when health reaches zero
+        if player.current_health <= 0:
+            if recorder is not None:
+                recorder.death(*player.rect.topleft)
+            player.reset_to_spawn()
+            if recorder is not None:
+                recorder.respawn(*player.rect.topleft)
+
+        self.tick += 1
+        return touched
+
+    def run(self, inputs, stop_on_win=True):
+        ''' Steps through a sequence of Inputs and returns the number of ticks run'''
+        start = self.tick
+        for tick_input in inputs:
+            self.step(tick_input)
+            if stop_on_win and self.won:
+                break
+        return self.tick - start
+
+
+def build_default_level(block_size=96):
+    ''' Builds the hand-made jump quest map and returns it as a World'''
+    # create player
+    player = Player(100, 100, 50, 50) # pass in x, y, width and height
+
+    # create fire
+    fire = Fire(200, HEIGHT - block_size - 64, 16, 32) # change from 100 to 200
+    fire.on()
+
+    ## Make the map, which is represented as a list of items
+    ##  We make the floor first before adding it as an object
+    ## to a list of other objects
+    # make the floor
+    floor = [Block(i * block_size, HEIGHT - block_size, block_size)
+             for i in range(-WIDTH // block_size, WIDTH * 2 // block_size)]
+
+    # make the flag
+    flag = Flag(block_size * 3, HEIGHT - block_size * 7 - 64, 32, 64)  # Position the flag at (700, ground level - height)
+
+    # the * breaks down floor into its individual elements and passes them inside the of objects
+    objects = [*floor, Block(0, HEIGHT - block_size * 2, block_size),
+               Block(block_size*3, HEIGHT - block_size * 4, block_size),
+               fire,
+               Block(0, HEIGHT - block_size * 6, block_size),
+               Block(block_size*3, HEIGHT - block_size * 7, block_size),
+               flag]
+
+    return World(player, objects, traps=[fire], block_size=block_size)